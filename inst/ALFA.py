@@ -6,369 +6,3612 @@ import argparse
 import multiprocessing
 import os
 from os import listdir
-from os.path import isfile, isdir, join
+from os.path import isfile, join
 import tempfile
 import csv
-import numpy as np
+import struct
+import sqlite3
+import hashlib
+import time
+import concurrent.futures
+import contextlib
+import contextvars
+import json
+import io
+import zlib
 import shutil
-from pandas.core.frame import DataFrame
-from skimage import measure
-import piexif
-import exif as ef
-import cv2
-import pandas as pd
+import signal
+import threading
+import heapq
+import math
+from typing import NamedTuple, TYPE_CHECKING
+
+# numpy, OpenCV, pandas and scipy are imported where they are needed, so that starting the script, e.g. once per image
+# from R, or merely importing it, does not pay for all of them
+if TYPE_CHECKING:
+    import numpy as np
+    from pandas import DataFrame
+
+# connected-component backends understood by label_components
+LABELLERS = ('opencv', 'bincount')
+
+
+class Components(NamedTuple):
+    """Connected components of a thresholded scan. The background (label 0) is excluded from every field."""
+    labels: 'np.ndarray'     # label image, in the most compact dtype that can hold every label
+    areas: 'np.ndarray'      # number of pixels in each component
+    bboxes: 'np.ndarray'     # x, y, width and height of each component
+    centroids: 'np.ndarray'  # x and y of the centre of mass of each component
+
+
+def _label_dtype(shape) -> type:
+    """
+    Pick the smallest label dtype that cannot overflow for an image of the given shape.
+
+    With 8-connectivity, no two components can share a 2x2 block, which bounds the number of labels.
+    @param shape: shape of the binary image
+    @return numpy dtype for the label image
+    """
+    import numpy as np
+    max_labels = ((shape[0] + 1) // 2) * ((shape[1] + 1) // 2)
+    return np.uint16 if max_labels < np.iinfo(np.uint16).max else np.int32
+
+
+def label_components(binary: 'np.ndarray', labeller: str = 'opencv') -> Components:
+    """
+    Label the 8-connected components of a binary image and measure them in a single pass.
+
+    Labels are assigned in raster order, as by skimage.measure.label, so the areas come back in the same order.
+    @param binary: 2D uint8 image where non-zero pixels are foreground
+    @param labeller: 'opencv' uses OpenCV's connected-component statistics; 'bincount' uses scipy.ndimage and np.bincount
+    @return Components
+    """
+    import numpy as np
+    import cv2
+    dtype = _label_dtype(binary.shape)
+
+    if labeller == 'opencv':
+        ltype = cv2.CV_16U if dtype == np.uint16 else cv2.CV_32S
+        # SAUF scans pixel by pixel, so unlike the block-based default its labels follow raster order
+        _, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(binary, 8, ltype, cv2.CCL_WU)
+        return Components(labels, stats[1:, cv2.CC_STAT_AREA].astype(np.int64),
+                          stats[1:, :cv2.CC_STAT_AREA], centroids[1:])
+
+    if labeller == 'bincount':
+        from scipy import ndimage
+        labels = np.empty(binary.shape, dtype=dtype)
+        n = ndimage.label(binary, structure=np.ones((3, 3), dtype=bool), output=labels)
+
+        bboxes = np.array([(s[1].start, s[0].start, s[1].stop - s[1].start, s[0].stop - s[0].start)
+                           for s in ndimage.find_objects(labels)], dtype=np.int32).reshape(-1, 4)
+
+        # count pixels and sum their coordinates in strips of rows, so that bincount's
+        # intp copy of the labels and its weights stay small
+        sums = np.zeros((3, n + 1))
+        step = max(1, (1 << 18) // max(1, binary.shape[1]))
+        cols = np.arange(binary.shape[1], dtype=np.float64)
+        for top in range(0, binary.shape[0], step):
+            strip = labels[top:top + step].ravel()
+            rows = np.arange(top, min(top + step, binary.shape[0]), dtype=np.float64)
+            sums[0] += np.bincount(strip, minlength=n + 1)
+            sums[1] += np.bincount(strip, weights=np.tile(cols, len(rows)), minlength=n + 1)
+            sums[2] += np.bincount(strip, weights=np.repeat(rows, binary.shape[1]), minlength=n + 1)
+        areas = sums[0, 1:].astype(np.int64)
+        centroids = (sums[1:, 1:] / np.maximum(areas, 1)).T
+
+        return Components(labels, areas, bboxes, centroids)
+
+    raise ValueError(f'Unknown labeller {labeller}. Choose one of {", ".join(LABELLERS)}.')
+
+
+def tiled_component_areas(gray: 'np.ndarray', threshold: int, tile_rows: int, labeller: str = 'opencv') -> 'np.ndarray':
+    """
+    Threshold and label a grayscale scan in horizontal strips, merging components that cross strip boundaries.
+
+    Only one strip is ever thresholded and labelled at a time. Components touching across a boundary, including
+    diagonally, are joined with union-find, so the areas and their order are exactly those of label_components on
+    the whole image.
+    @param gray: 2D uint8 grayscale image
+    @param threshold: pixels at or below this value are leaf
+    @param tile_rows: height of the strips
+    @param labeller: connected-component backend, one of LABELLERS
+    @return number of pixels in each component, in raster order
+    """
+    import numpy as np
+    import cv2
+    height, width = gray.shape
+    tile_rows = max(1, int(tile_rows))
+    strip_areas, pairs = [], []
+    labelled = 0  # global ids of the current strip's components start after this
+    previous_row = None
+    for top in range(0, height, tile_rows):
+        binary = cv2.threshold(gray[top:top + tile_rows], threshold, 255, cv2.THRESH_BINARY_INV)[1]
+        components = label_components(binary, labeller)
+        first_row = components.labels[0].astype(np.int64)
+        first_row[first_row > 0] += labelled
+
+        # 8-connected neighbours across the boundary: straight down and both diagonals
+        if previous_row is not None:
+            for above, below in ((previous_row, first_row), (previous_row[:-1], first_row[1:]),
+                                 (previous_row[1:], first_row[:-1])):
+                touching = (above > 0) & (below > 0)
+                pairs.append(np.stack([above[touching], below[touching]], axis=1))
+
+        previous_row = components.labels[-1].astype(np.int64)
+        previous_row[previous_row > 0] += labelled
+        strip_areas.append(components.areas)
+        labelled += len(components.areas)
+        del binary, components
+
+    # union-find, always keeping the smaller id as the root, so that roots follow raster order
+    parent = np.arange(labelled + 1)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if pairs:
+        for a, b in np.unique(np.concatenate(pairs), axis=0):
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+    while True:
+        flattened = parent[parent]
+        if np.array_equal(flattened, parent):
+            break
+        parent = flattened
+
+    areas = np.concatenate([np.zeros(1, dtype=np.int64)] + strip_areas)
+    totals = np.zeros(labelled + 1, dtype=np.int64)
+    np.add.at(totals, parent, areas)
+    roots = np.unique(parent[1:])
+    return totals[roots]
+
+
+# methods of choosing the threshold of each scan from its histogram
+THRESHOLD_METHODS = ('otsu', 'triangle', 'valley')
+# pixels of a scan that make a histogram representative enough to choose its threshold from
+HISTOGRAM_SAMPLE = 2000000
+
+
+def gray_histogram(gray: 'np.ndarray') -> 'np.ndarray':
+    """
+    Count the pixels of each of the 256 gray levels of a scan, for histogram_threshold.
+
+    Scans of more than HISTOGRAM_SAMPLE pixels are sampled every few rows, up to every fourth, which keeps the cost
+    to about that of thresholding them. The saturated levels 0 and 255 are left out: preprocess paints masked
+    scales pure white, and clipped highlights would otherwise make the largest peak, away from the background.
+    """
+    import cv2
+    step = max(1, min(4, gray.size // HISTOGRAM_SAMPLE))
+    hist = cv2.calcHist([gray[::step]], [0], None, [256], [0, 256]).ravel()
+    hist[[0, 255]] = 0
+    return hist
+
+
+def histogram_threshold(hist: 'np.ndarray', method: str):
+    """
+    Choose the threshold between leaf and background from the histogram of a grayscale scan.
+
+    'otsu' maximises the variance between the two classes. 'triangle' takes the level farthest below the line from
+    the highest peak to the far end of the histogram, which suits a large background peak with a long tail of leaf.
+    On white-background scans, whose background peak has a tail of off-white paper and shadow, it lands at the foot
+    of that peak, close to white, and counts much of the paper as leaf; it is not meant for ALFA's usual scans.
+    'valley' smooths the histogram until it has exactly two peaks and takes the lowest point between them; if it
+    never does, Otsu's threshold is used. On the same histogram, Otsu and triangle choose the thresholds of
+    cv2.threshold.
+    @param hist: 256 pixel counts, as from gray_histogram
+    @param method: one of THRESHOLD_METHODS
+    @return threshold at or below which pixels are leaf, or None if the scan has fewer than two gray levels
+    """
+    import numpy as np
+    hist = np.asarray(hist, dtype=np.float64)
+    levels = np.arange(256)
+    if np.count_nonzero(hist) < 2:
+        return None
+
+    if method == 'valley':
+        smooth = hist
+        for _ in range(1000):
+            peaks = np.flatnonzero((smooth[1:-1] > smooth[:-2]) & (smooth[1:-1] > smooth[2:])) + 1
+            if len(peaks) == 2:
+                return int(peaks[0] + np.argmin(smooth[peaks[0]:peaks[1] + 1]))
+            smooth = np.convolve(smooth, np.ones(3) / 3, mode='same')
+        method = 'otsu'
+
+    if method == 'otsu':
+        weight = np.cumsum(hist) / hist.sum()
+        mean = np.cumsum(hist * levels) / hist.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            between = (mean[-1] * weight - mean) ** 2 / (weight * (1 - weight))
+        return int(np.argmax(np.nan_to_num(between, nan=-1, posinf=-1)))
+
+    if method == 'triangle':
+        nonzero = np.flatnonzero(hist)
+        left, right = max(nonzero[0] - 1, 0), min(nonzero[-1] + 1, 255)
+        peak = int(np.argmax(hist))
+        # work on the longer side of the peak, mirroring the histogram if that is above it
+        flip = peak - left < right - peak
+        if flip:
+            hist, left, peak = hist[::-1], 255 - right, 255 - peak
+        candidates = levels[left + 1:peak + 1]
+        distance = hist[peak] * candidates + (left - peak) * hist[candidates]
+        threshold = (int(candidates[np.argmax(distance)]) if len(candidates) and distance.max() > 0 else left) - 1
+        return 255 - threshold if flip else threshold
+
+    raise ValueError(f'Unknown threshold method {method}. Choose one of {", ".join(THRESHOLD_METHODS)}.')
+
+
+def component_features(components: Components, keep, image: 'np.ndarray') -> dict:
+    """
+    Measure the outline and colour of some of the components of a scan, from their labels.
+
+    Each component is only looked at within its bounding box. The perimeter follows the outer contour through the
+    centres of the boundary pixels, so holes do not count. The convex hull is that of the pixels' corners, so it is
+    never smaller than the component.
+    @param components: Components of the thresholded scan
+    @param keep: indices of the components to measure, into the fields of components
+    @param image: the scan the components were thresholded from, in BGR colour or grayscale
+    @return dict of 'perimeter' and 'convex_area', in pixels, and 'color', the mean BGR of each component's pixels
+    """
+    import numpy as np
+    import cv2
+    keep = np.asarray(keep, dtype=np.int64)
+    perimeter = np.zeros(len(keep))
+    convex_area = np.zeros(len(keep))
+    color = np.zeros((len(keep), 3))
+    corners = np.array([[0, 0], [1, 0], [0, 1], [1, 1]], dtype=np.int32)
+    for j, i in enumerate(keep):
+        x, y, w, h = components.bboxes[i]
+        mask = (components.labels[y:y + h, x:x + w] == i + 1).astype(np.uint8)
+        outline = max(cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2], key=len)
+        perimeter[j] = cv2.arcLength(outline, True)
+        convex_area[j] = cv2.contourArea(cv2.convexHull((outline.reshape(-1, 1, 2) + corners).reshape(-1, 2)))
+        mean = cv2.mean(image[y:y + h, x:x + w], mask)
+        color[j] = mean[:3] if image.ndim == 3 else mean[0]
+    return {'perimeter': perimeter, 'convex_area': convex_area, 'color': color}
+
+
+def qa_overlay(image: 'np.ndarray', components: Components, keep, areas, size: int) -> 'np.ndarray':
+    """
+    Draw a small overlay of a scan for review by eye: the scan shrunk to at most size pixels on its longer side, with
+    the outlines of the leaves counted in red and the area of each at its centre.
+
+    The outlines are traced on the labels sampled at the centre of every pixel of the overlay, which costs no more
+    than the overlay itself; leaves thinner than one of its pixels may show broken.
+    @param image: the scan the components were thresholded from, in BGR colour or grayscale
+    @param components: Components of the thresholded scan
+    @param keep: indices of the components counted, into the fields of components
+    @param areas: area of each of those, in cm2
+    @param size: longer side of the overlay, in pixels
+    @return the overlay, in BGR colour
+    """
+    import numpy as np
+    import cv2
+    height, width = image.shape[:2]
+    scale = min(1.0, size / max(height, width))
+    rows, cols = max(1, round(height * scale)), max(1, round(width * scale))
+    # averaging every pixel costs ten times as much as the rest of the overlay; about 2 x 2 per overlay pixel will do
+    step = max(1, int(1 / scale) // 2)
+    overlay = cv2.resize(image[::step, ::step], (cols, rows), interpolation=cv2.INTER_AREA)
+    if overlay.ndim == 2:
+        overlay = cv2.cvtColor(overlay, cv2.COLOR_GRAY2BGR)
+
+    keep = np.asarray(keep, dtype=np.int64)
+    counted = np.zeros(len(components.areas) + 1, dtype=np.uint8)
+    counted[keep + 1] = 255
+    mask = counted[components.labels[((np.arange(rows) + 0.5) * height / rows).astype(np.intp)[:, None],
+                                     ((np.arange(cols) + 0.5) * width / cols).astype(np.intp)]]
+    outlines = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    cv2.drawContours(overlay, outlines, -1, (0, 0, 255), 1, cv2.LINE_AA)
+
+    for (x, y), area in zip(components.centroids[keep] * (cols / width, rows / height), areas):
+        text = f'{area:.1f}'
+        (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.35, 1)
+        origin = (int(x - text_width / 2), int(y + text_height / 2))
+        # dark under light, to stay legible on leaves and background alike
+        cv2.putText(overlay, text, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 0), 2, cv2.LINE_AA)
+        cv2.putText(overlay, text, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 255, 255), 1, cv2.LINE_AA)
+    return overlay
+
+
+class ImageMetadata(NamedTuple):
+    """
+    What the header of an image file tells about it. Resolutions are in dots per inch; None when absent.
+
+    strips locates the pixels of an uncompressed 8-bit TIFF, which can then be mapped rather than decoded.
+    """
+    path: str
+    width: int
+    height: int
+    x_resolution: float
+    y_resolution: float
+    size: int
+    mtime: float
+    strips: 'TiffStrips' = None
+
+
+# TIFF field types: struct format and size of one value. Rationals are read as two unsigned longs
+_TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 7: ('B', 1),
+               9: ('i', 4), 10: ('ii', 8), 16: ('Q', 8)}
+
+# TIFF tags needed to place a scan
+_IMAGE_WIDTH, _IMAGE_LENGTH, _X_RESOLUTION, _Y_RESOLUTION, _RESOLUTION_UNIT = 256, 257, 282, 283, 296
+
+# TIFF tags needed to map the pixels of an uncompressed scan
+(_BITS_PER_SAMPLE, _COMPRESSION, _PHOTOMETRIC, _STRIP_OFFSETS, _ORIENTATION, _SAMPLES_PER_PIXEL, _ROWS_PER_STRIP,
+ _STRIP_BYTE_COUNTS, _PLANAR_CONFIGURATION, _TILE_WIDTH, _SAMPLE_FORMAT) = (
+    258, 259, 262, 273, 274, 277, 278, 279, 284, 322, 339)
+
+
+def _read_ifd(f, base: int, offset: int, endian: str) -> dict:
+    """
+    Read the values of the first image file directory of a TIFF structure.
+
+    @param f: file open for binary reading
+    @param base: file offset of the TIFF header, to which all offsets are relative
+    @param offset: offset of the directory
+    @param endian: '<' or '>'
+    @return dict of tag to tuple of values; rationals are divided out
+    """
+    f.seek(base + offset)
+    count = struct.unpack(endian + 'H', f.read(2))[0]
+    entries = f.read(12 * count)
+    tags = {}
+    for i in range(count):
+        tag, kind, n, raw = struct.unpack(endian + 'HHI4s', entries[12 * i:12 * i + 12])
+        if kind not in _TIFF_TYPES:
+            continue
+        fmt, size = _TIFF_TYPES[kind]
+        if size * n <= 4:
+            data = raw[:size * n]
+        else:
+            position = f.tell()
+            f.seek(base + struct.unpack(endian + 'I', raw)[0])
+            data = f.read(size * n)
+            f.seek(position)
+        if kind == 2:
+            tags[tag] = (data.rstrip(b'\0').decode('latin-1'),)
+            continue
+        values = struct.unpack(endian + fmt * n, data)
+        if kind in (5, 10):
+            values = tuple(num / den if den else None for num, den in zip(values[::2], values[1::2]))
+        tags[tag] = values
+    return tags
+
+
+def _tiff_resolution(tags: dict):
+    """X and Y resolution in DPI from TIFF/EXIF tags, honouring ResolutionUnit (2: inch, 3: cm)."""
+    x, y = tags.get(_X_RESOLUTION, (None,))[0], tags.get(_Y_RESOLUTION, (None,))[0]
+    if tags.get(_RESOLUTION_UNIT, (2,))[0] == 3:
+        x, y = (v * 2.54 if v is not None else None for v in (x, y))
+    return x, y
+
+
+class TiffStrips(NamedTuple):
+    """Where the pixels of an uncompressed, 8-bit, interleaved TIFF lie: file offsets of its strips, top first."""
+    offsets: tuple
+    rows_per_strip: int
+    samples: int
+
+
+def _tiff_strips(tags: dict, width: int, height: int):
+    """
+    Layout of the pixels of a TIFF that can be mapped straight from the file, from the tags of its first directory.
+
+    Only what cv2 would decode to the same pixels qualifies: uncompressed, unsigned 8 bits per sample, strips rather
+    than tiles, interleaved grayscale (BlackIsZero) or RGB, and no rotation.
+    @return TiffStrips, or None if the pixels have to be decoded
+    """
+    samples = tags.get(_SAMPLES_PER_PIXEL, (1,))[0]
+    photometric = tags.get(_PHOTOMETRIC, (None,))[0]
+    if (not width or not height or tags.get(_COMPRESSION, (1,))[0] != 1 or _TILE_WIDTH in tags
+            or (samples, photometric) not in ((1, 1), (3, 2))
+            or any(bits != 8 for bits in tags.get(_BITS_PER_SAMPLE, (1,)))
+            or any(kind != 1 for kind in tags.get(_SAMPLE_FORMAT, (1,)))
+            or (samples > 1 and tags.get(_PLANAR_CONFIGURATION, (1,))[0] != 1)
+            or tags.get(_ORIENTATION, (1,))[0] != 1):
+        return None
+    offsets, counts = tags.get(_STRIP_OFFSETS, ()), tags.get(_STRIP_BYTE_COUNTS, ())
+    rows = min(tags.get(_ROWS_PER_STRIP, (height,))[0], height)
+    if not offsets or len(offsets) != len(counts) or len(offsets) != -(-height // rows):
+        return None
+    # every strip but possibly the last holds rows_per_strip full rows
+    for i, count in enumerate(counts):
+        if count < min(rows, height - i * rows) * width * samples:
+            return None
+    return TiffStrips(tuple(offsets), rows, samples)
+
+
+def _read_tiff_header(f, base: int):
+    """Endianness and first directory of the TIFF structure at base, or None if there is none."""
+    f.seek(base)
+    head = f.read(8)
+    if len(head) < 8 or head[:2] not in (b'II', b'MM'):
+        return None
+    endian = '<' if head[:2] == b'II' else '>'
+    if struct.unpack(endian + 'H', head[2:4])[0] != 42:
+        return None
+    return endian, _read_ifd(f, base, struct.unpack(endian + 'I', head[4:])[0], endian)
+
+
+def read_metadata(path: str) -> ImageMetadata:
+    """
+    Read the dimensions and resolution of a JPEG, PNG or TIFF image from its header, without decoding it.
+
+    For JPEGs only the segments before the image data are read. The EXIF resolution takes precedence over the JFIF
+    density. Resolutions in dots per cm are converted to dots per inch. For a TIFF, the same directory also tells
+    whether its pixels can be mapped from the file (see read_tiff_gray).
+    @param path: path to the image. respects tilde expansion
+    @return ImageMetadata; fields that cannot be read are None
+    @raise OSError if the file cannot be read
+    """
+    path = os.path.expanduser(path)
+    stat = os.stat(path)
+    width = height = strips = None
+    exif_res = jfif_res = (None, None)
+    with open(path, 'rb') as f:
+        head = f.read(8)
+        try:
+            if head[:2] == b'\xff\xd8':
+                f.seek(2)
+                while True:
+                    marker = f.read(4)
+                    if len(marker) < 4 or marker[0] != 0xFF:
+                        break
+                    start = f.tell()
+                    length = struct.unpack('>H', marker[2:])[0]
+                    if marker[1] == 0xE0:
+                        jfif = f.read(min(length - 2, 14))
+                        if jfif[:5] == b'JFIF\0':
+                            units, x, y = struct.unpack('>BHH', jfif[7:12])
+                            if units in (1, 2):
+                                jfif_res = tuple(v * (2.54 if units == 2 else 1) for v in (x, y))
+                    elif marker[1] == 0xE1:
+                        if f.read(6) == b'Exif\0\0':
+                            tiff = _read_tiff_header(f, start + 6)
+                            if tiff is not None:
+                                exif_res = _tiff_resolution(tiff[1])
+                    # start of frame markers, except DHT, JPG and DAC; the image data follows
+                    elif 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack('>xHH', f.read(5))
+                        break
+                    f.seek(start + length - 2)
+            elif head == b'\x89PNG\r\n\x1a\n':
+                while True:
+                    length, kind = struct.unpack('>I4s', f.read(8))
+                    if kind == b'IHDR':
+                        width, height = struct.unpack('>II', f.read(8))
+                        f.seek(length - 8 + 4, 1)
+                    elif kind == b'pHYs':
+                        x, y, unit = struct.unpack('>IIB', f.read(9))
+                        if unit == 1:  # pixels per metre, which do not convert back to whole DPI exactly
+                            jfif_res = (round(x * 0.0254, 2), round(y * 0.0254, 2))
+                        f.seek(4, 1)
+                    elif kind == b'eXIf':
+                        start = f.tell()
+                        tiff = _read_tiff_header(f, start)
+                        if tiff is not None:
+                            exif_res = _tiff_resolution(tiff[1])
+                        f.seek(start + length + 4)
+                    elif kind in (b'IDAT', b'IEND'):
+                        break
+                    else:
+                        f.seek(length + 4, 1)
+            else:
+                tiff = _read_tiff_header(f, 0)
+                if tiff is not None:
+                    tags = tiff[1]
+                    width, height = tags.get(_IMAGE_WIDTH, (None,))[0], tags.get(_IMAGE_LENGTH, (None,))[0]
+                    exif_res = _tiff_resolution(tags)
+                    strips = _tiff_strips(tags, width, height)
+        except (struct.error, UnicodeDecodeError, ValueError):
+            # truncated or corrupt header: keep whatever was read before it
+            pass
+    x_res, y_res = exif_res if exif_res[0] else jfif_res
+    # a truncated file is left to cv2, which reports it
+    if strips is not None and any(
+            offset + min(strips.rows_per_strip, height - i * strips.rows_per_strip) * width * strips.samples
+            > stat.st_size for i, offset in enumerate(strips.offsets)):
+        strips = None
+    return ImageMetadata(path, width, height, x_res, y_res, stat.st_size, stat.st_mtime, strips)
+
+
+class MetadataIndex:
+    """
+    Header metadata of many images, read once per run and shared by every command that needs it.
+
+    Entries are checked against the file's size and modification time, so changed files are read again.
+    """
+
+    def __init__(self, threads: int = 16):
+        """
+        @param threads: how many headers to read at once when building; header reads are IO-bound
+        """
+        self.threads = threads
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def build(self, images) -> 'MetadataIndex':
+        """
+        Read the headers of many images in one pass.
+
+        @param images: paths to the images
+        @return self
+        """
+        def read(img):
+            try:
+                return read_metadata(img)
+            except OSError:
+                return None
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+            for img, metadata in zip(images, executor.map(read, images)):
+                if metadata is not None:
+                    self._entries[os.path.abspath(os.path.expanduser(img))] = metadata
+        return self
+
+    def get(self, img: str, validate: bool = True) -> ImageMetadata:
+        """
+        Return the metadata of an image, reading its header if it is not indexed or has changed.
+
+        @param validate: check that the file has not changed since it was indexed, which costs a stat call
+        @raise OSError if the file cannot be read
+        """
+        path = os.path.abspath(os.path.expanduser(img))
+        metadata = self._entries.get(path)
+        if metadata is not None and not validate:
+            return metadata
+        if metadata is not None:
+            stat = os.stat(path)
+            if stat.st_size == metadata.size and stat.st_mtime == metadata.mtime:
+                return metadata
+        metadata = read_metadata(path)
+        self._entries[path] = metadata
+        return metadata
+
+
+# rows of an RGB TIFF converted to grayscale at a time, in bytes
+TIFF_BAND_BYTES = 16 << 20
+
+
+def read_tiff_gray(path: str, metadata: ImageMetadata) -> 'np.ndarray':
+    """
+    Read an uncompressed TIFF in grayscale by mapping the file into memory rather than decoding it.
+
+    A grayscale TIFF whose strips follow one another is returned as a view of the mapping itself, so its pixels are
+    read from the page cache as they are thresholded and labelled; writes to it stay private to the process. Other
+    strips are copied into place, and RGB is converted to grayscale a band of rows at a time, so the colour image is
+    never held in memory. The pixels are the same as those of cv2.imread in colour followed by cv2.cvtColor.
+    @param path: path to the image. respects tilde expansion
+    @param metadata: ImageMetadata of the image, with its strips
+    @return 2D uint8 grayscale image
+    @raise OSError or ValueError if the file cannot be mapped
+    """
+    import numpy as np
+    import cv2
+    width, height, strips = metadata.width, metadata.height, metadata.strips
+    row = width * strips.samples
+    data = np.memmap(os.path.expanduser(path), np.uint8, 'c')
+    first = strips.offsets[0]
+    if all(offset == first + i * strips.rows_per_strip * row for i, offset in enumerate(strips.offsets)):
+        pieces = [(0, data[first:first + height * row].reshape(height, width, strips.samples))]
+    else:
+        pieces = [(top, data[offset:offset + min(strips.rows_per_strip, height - top) * row].reshape(
+                       -1, width, strips.samples))
+                  for top, offset in zip(range(0, height, strips.rows_per_strip), strips.offsets)]
+    if strips.samples == 1 and len(pieces) == 1:
+        return pieces[0][1][:, :, 0]
+
+    gray = np.empty((height, width), np.uint8)
+    band = max(1, TIFF_BAND_BYTES // row)
+    for top, piece in pieces:
+        for start in range(0, len(piece), band):
+            rows = piece[start:start + band]
+            gray[top + start:top + start + len(rows)] = (
+                rows[:, :, 0] if strips.samples == 1 else cv2.cvtColor(rows, cv2.COLOR_RGB2GRAY))
+    return gray
+
+
+# formats in which processed and thresholded images can be saved, and their extensions
+OUTPUT_FORMATS = {'jpg': '.jpg', 'png': '.png', 'tiff': '.tif'}
+
+
+def read_exif_segment(path: str):
+    """
+    Read the raw EXIF segment of a JPEG, reading only the segments before the image data.
+
+    @param path: path to the image. respects tilde expansion
+    @return bytes of the APP1 segment, marker included, or None if the file is not a JPEG or has no EXIF
+    """
+    with open(os.path.expanduser(path), 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+                return None
+            length = struct.unpack('>H', marker[2:])[0]
+            if marker[1] == 0xE1:
+                payload = f.read(length - 2)
+                if payload[:6] == b'Exif\0\0':
+                    return marker + payload
+            else:
+                f.seek(length - 2, 1)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_image(image, ext: str = '.jpg', res: float = None, exif: bytes = None, quality: int = 95,
+                 compression: int = None, bilevel: bool = False) -> bytes:
+    """
+    Encode an image in memory, carrying its resolution and the source EXIF, ready to be written in one go.
+
+    @param image: the image as read by cv2
+    @param ext: extension of the file, which selects the format
+    @param res: resolution in DPI, stored as the JFIF density, PNG pHYs or TIFF resolution tags; None to leave it out
+    @param exif: EXIF segment as returned by read_exif_segment, spliced into JPEGs and stored as a PNG eXIf chunk
+    @param quality: JPEG quality, 0 to 100
+    @param compression: PNG compression level, 0 to 9 (def: 1), or TIFF compression scheme (def: 8, deflate)
+    @param bilevel: store a PNG as one bit per pixel; only for images holding nothing but 0 and 255
+    @return the encoded bytes
+    @raise ValueError if the image cannot be encoded
+    """
+    import cv2
+    ext = ext.lower()
+    params = []
+    if ext in ('.jpg', '.jpeg'):
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif ext == '.png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1 if compression is None else compression]
+        if bilevel:
+            params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+    elif ext in ('.tif', '.tiff'):
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, 8 if compression is None else compression]
+        if res:
+            params += [cv2.IMWRITE_TIFF_RESUNIT, 2,
+                       cv2.IMWRITE_TIFF_XDPI, round(res), cv2.IMWRITE_TIFF_YDPI, round(res)]
+    ok, buffer = cv2.imencode(ext, image, params)
+    if not ok:
+        raise ValueError(f'Unable to encode image as {ext}.')
+    data = buffer.tobytes()
+
+    if ext in ('.jpg', '.jpeg'):
+        # opencv writes a JFIF APP0 segment straight after the start of image
+        start = 2
+        if data[2:4] == b'\xff\xe0' and data[6:11] == b'JFIF\0':
+            start = 4 + struct.unpack('>H', data[4:6])[0]
+            if res:
+                dpi = min(65535, round(res))
+                data = data[:13] + struct.pack('>BHH', 1, dpi, dpi) + data[18:]
+        if exif:
+            data = data[:start] + exif + data[start:]
+    elif ext == '.png':
+        # ancillary chunks go between the header chunk and the image data
+        chunks = b''
+        if res:
+            ppm = round(res / 0.0254)
+            chunks += _png_chunk(b'pHYs', struct.pack('>IIB', ppm, ppm, 1))
+        if exif:
+            chunks += _png_chunk(b'eXIf', exif[10:])
+        data = data[:33] + chunks + data[33:]
+    return data
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Write a file in a single write, through a temporary file in the same directory, so that it is either complete or
+    absent even if the process is interrupted.
+
+    @param path: where to write
+    @param data: the contents
+    @raise OSError if the file cannot be written
+    """
+    # unique to this write, so threads saving the same name and files left by a killed run with a reused pid do not
+    # collide; not mkstemp, which would leave the output readable by its owner only instead of following the umask
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.{os.urandom(4).hex()}.tmp'
+    try:
+        with open(temporary, 'xb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        raise
+
+
+def available_memory_mb():
+    """Memory available to new processes, in MB, or None if it cannot be found."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class StageTimes:
+    """
+    The wall time of the stages of one job, each measured since the previous mark, with the bytes read and written
+    and the pixels decoded along the way.
+    """
+    __slots__ = ('job', 'images', 'pixels', 'seconds', 'read', 'written', '_start', '_last')
+
+    def __init__(self, job, images: int = 1):
+        """
+        @param job: path of the image, or list of paths of a batch
+        @param images: number of images in the job
+        """
+        self.job = job
+        self.images = images
+        self.pixels = 0
+        self.seconds = {}
+        self.read = {}
+        self.written = {}
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, stage: str, read: str = None, written: int = 0, pixels: int = 0):
+        """
+        End a stage.
+
+        @param stage: name of the stage, e.g. 'decode'; the times of repeated stages add up
+        @param read: path of a file the stage read, to count its size
+        @param written: number of bytes the stage wrote
+        @param pixels: number of pixels the stage decoded
+        """
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0) + now - self._last
+        self._last = now
+        if read:
+            with contextlib.suppress(OSError):
+                self.read[stage] = self.read.get(stage, 0) + os.path.getsize(os.path.expanduser(read))
+        if written:
+            self.written[stage] = self.written.get(stage, 0) + written
+        self.pixels += pixels
+
+    def finish(self) -> dict:
+        """End the job; whatever followed the last mark counts as 'other'. @return the times as a dict"""
+        self.mark('other')
+        # the thread id is the pid for worker processes, and tells threads of one process apart
+        return {'job': self.job, 'worker': threading.get_native_id(), 'images': self.images, 'pixels': self.pixels,
+                'seconds': time.perf_counter() - self._start, 'stages': self.seconds, 'read': self.read,
+                'written': self.written}
+
+
+class _NoStageTimes:
+    """Stands in for StageTimes when profiling is off, at the cost of a call that does nothing."""
+    __slots__ = ()
+
+    def mark(self, stage: str, read: str = None, written: int = 0, pixels: int = 0):
+        pass
+
+
+# the StageTimes of the job running in this thread
+_stage_times = contextvars.ContextVar('stage_times', default=_NoStageTimes())
+
+# the single-image methods that draw QA overlays (see qa_overlay), and the list of path and overlay to which the job
+# running in this thread adds them; None when no overlays are wanted
+QA_METHODS = ('_estimate_image', '_process_image')
+_qa_overlays = contextvars.ContextVar('qa_overlays', default=None)
+
+
+def _percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of a sorted list."""
+    return values[max(0, min(len(values) - 1, int(-(-len(values) * q // 100)) - 1))] if values else 0.0
+
+
+class Profile:
+    """The stage times of the jobs of one or more runs, from all workers, and what they add up to."""
+
+    def __init__(self):
+        self.jobs = []
+        # wall time of the runs, and the most workers any of them used
+        self.wall = 0.0
+        self.workers = 1
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def summary(self) -> dict:
+        """
+        Aggregate the jobs.
+
+        @return dict of the totals, throughput and worker utilisation, and of the min, median, 95th percentile and
+                max time of each stage per job, with its total time, share of the busy time and bytes
+        """
+        busy = sum(job['seconds'] for job in self.jobs)
+        images = sum(job['images'] for job in self.jobs)
+        pixels = sum(job['pixels'] for job in self.jobs)
+        stages = {}
+        for stage in dict.fromkeys(stage for job in self.jobs for stage in job['stages']):
+            seconds = sorted(job['stages'].get(stage, 0.0) for job in self.jobs)
+            stages[stage] = {'total': sum(seconds), 'share': sum(seconds) / busy if busy else 0.0,
+                             'min': seconds[0], 'median': _percentile(seconds, 50), 'p95': _percentile(seconds, 95),
+                             'max': seconds[-1],
+                             'read_bytes': sum(job['read'].get(stage, 0) for job in self.jobs),
+                             'written_bytes': sum(job['written'].get(stage, 0) for job in self.jobs)}
+        per_worker = {}
+        for job in self.jobs:
+            per_worker[job['worker']] = per_worker.get(job['worker'], 0) + job['seconds']
+        return {'jobs': len(self.jobs), 'images': images, 'megapixels': pixels / 1e6, 'wall_seconds': self.wall,
+                'busy_seconds': busy, 'workers': self.workers,
+                'images_per_second': images / self.wall if self.wall else None,
+                'megapixels_per_second': pixels / 1e6 / self.wall if self.wall else None,
+                # the share of the workers' time spent on jobs rather than waiting or passing data
+                'utilisation': busy / (self.wall * self.workers) if self.wall else None,
+                'busy_seconds_per_worker': per_worker, 'stages': stages}
+
+    def format(self) -> str:
+        """The summary as a table, for people."""
+        summary = self.summary()
+        lines = [f"{summary['images']} images, {summary['megapixels']:.1f} Mpx in {summary['wall_seconds']:.2f} s "
+                 f"on {summary['workers']} workers"]
+        if summary['wall_seconds']:
+            lines[0] += (f": {summary['images_per_second']:.1f} images/s, "
+                         f"{summary['megapixels_per_second']:.1f} Mpx/s, {100 * summary['utilisation']:.0f}% busy")
+        lines.append(f"{'stage':>10} {'total s':>9} {'share':>6} {'min ms':>9} {'median ms':>10} {'p95 ms':>9} "
+                     f"{'max ms':>9} {'read MB':>8} {'written MB':>10}")
+        for stage, times in summary['stages'].items():
+            lines.append(f"{stage:>10} {times['total']:9.3f} {100 * times['share']:5.1f}% {1000 * times['min']:9.2f} "
+                         f"{1000 * times['median']:10.2f} {1000 * times['p95']:9.2f} {1000 * times['max']:9.2f} "
+                         f"{times['read_bytes'] / 1e6:8.1f} {times['written_bytes'] / 1e6:10.1f}")
+        return '\n'.join(lines)
+
+    def write(self, path: str):
+        """Save the summary and the times of every job as JSON."""
+        with open(os.path.expanduser(path), 'w') as out:
+            json.dump({'summary': self.summary(), 'jobs': self.jobs}, out, indent=1)
+
+
+def _call(estimator, method: str, path, args: tuple):
+    """
+    Apply a single-image method, timing its stages if the estimator profiles, and keeping the QA overlays it draws
+    if the estimator has a qa_dir.
+
+    @return the method's return value, or, when profiling or drawing overlays, a tuple of it, the StageTimes as a
+            dict (None unless profiling) and a list of tuples of path and overlay (None unless the method draws them)
+    """
+    if not estimator.profile and not estimator.qa_dir:
+        return getattr(estimator, method)(path, *args)
+    overlays = [] if estimator.qa_dir and method in QA_METHODS else None
+    overlays_token = _qa_overlays.set(overlays)
+    try:
+        if not estimator.profile:
+            return getattr(estimator, method)(path, *args), None, overlays
+        # the first job of a worker would otherwise count the imports in its first stage
+        import numpy
+        import cv2
+        times = StageTimes(list(path) if isinstance(path, tuple) else path,
+                           len(path) if isinstance(path, tuple) else 1)
+        token = _stage_times.set(times)
+        try:
+            result = getattr(estimator, method)(path, *args)
+        finally:
+            _stage_times.reset(token)
+        return result, times.finish(), overlays
+    finally:
+        _qa_overlays.reset(overlays_token)
+
+
+class EstimateRecord(NamedTuple):
+    """
+    One row of estimate output: the area of one leaf, or of all the leaves in an image if combined. An image without
+    leaves has a single row of no area either way.
+    """
+    filename: str
+    Area: float
+    Resolution: float
+    Error: str
+
+
+class LeafRecord(NamedTuple):
+    """
+    One row of estimate output with features: the area of one leaf, where it lies, its shape and its colour.
+
+    Positions and sizes are in pixels of the scan at its full resolution, the centroid x and y and the bounding box
+    left, top, width and height. The perimeter is in cm and the convex hull area in cm2. blue, green and red are the
+    means over the leaf's pixels, 0 to 255, and greenness is green / (red + green + blue). Threshold is the one the
+    scan was thresholded at. Error rows have no features.
+    """
+    filename: str
+    Area: float
+    Resolution: float
+    Error: str
+    x: float = None
+    y: float = None
+    left: int = None
+    top: int = None
+    width: int = None
+    height: int = None
+    perimeter: float = None
+    convex_area: float = None
+    blue: float = None
+    green: float = None
+    red: float = None
+    greenness: float = None
+    Threshold: int = None
+
+
+class AutoThresholdRecord(NamedTuple):
+    """One row of estimate output with auto_threshold: as EstimateRecord, with the threshold chosen for the image."""
+    filename: str
+    Area: float
+    Resolution: float
+    Error: str
+    Threshold: int = None
+
+
+class SweepRecord(NamedTuple):
+    """One row of estimate_sweep output: an area for one combination of threshold and cut_off."""
+    filename: str
+    threshold: int
+    cut_off: int
+    Area: float
+    Resolution: float
+    Error: str
+
+
+class PreprocessRecord(NamedTuple):
+    """One row of preprocess output."""
+    filename: str
+    result: str
+
+
+# column names of the tables built from each kind of record
+ESTIMATE_COLUMNS = ('filename', 'Area', 'Resolution', 'Error')
+LEAF_COLUMNS = LeafRecord._fields
+AUTO_THRESHOLD_COLUMNS = AutoThresholdRecord._fields
+PREPROCESS_COLUMNS = ('filename', 'Pre-process Result')
+SWEEP_COLUMNS = SweepRecord._fields
+
+
+def records_to_frame(results, columns) -> 'DataFrame':
+    """
+    Collect per-image lists of records into a single table.
+
+    The index counts the rows of each image from zero, as if the per-image tables had been concatenated.
+    @param results: iterable of lists of records, one list per image
+    @param columns: column names, one per record field
+    @return pandas DF
+    """
+    import pandas as pd
+    records, index = [], []
+    for image_records in results:
+        records.extend(image_records)
+        index.extend(range(len(image_records)))
+    return pd.DataFrame.from_records(records, columns=columns, index=pd.Index(index))
+
+
+class ResultWriter:
+    """
+    Write records to a CSV, JSON Lines or Parquet file as each image is finished.
+
+    CSV and JSON Lines are flushed after every image, so everything written survives an interrupted run. Parquet
+    needs pyarrow, buffers rows into row groups and is only readable once the writer has been closed.
+    """
+
+    FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl', '.parquet': 'parquet'}
+
+    def __init__(self, path: str, columns, fmt: str = None, append: bool = False, row_group_size: int = 10000):
+        """
+        Open the output file.
+
+        @param path: where to write the results. respects tilde expansion
+        @param columns: column names, one per record field
+        @param fmt: 'csv', 'jsonl' or 'parquet'; def: guessed from the file extension, falling back to csv
+        @param append: add to an existing file instead of replacing it (not for parquet)
+        @param row_group_size: how many rows to buffer before writing a parquet row group
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.columns = list(columns)
+        self.fmt = fmt or self.FORMATS.get(os.path.splitext(path)[1].lower(), 'csv')
+        self.row_group_size = row_group_size
+        self.rows = 0
+
+        if self.fmt == 'parquet':
+            if append:
+                raise ValueError('Parquet results cannot be appended to. Use csv or jsonl to resume a run.')
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('Writing parquet requires pyarrow. Install it with pip install pyarrow, '
+                                  'or write csv or jsonl instead.')
+            self._pa = pyarrow
+            self._buffer = []
+            self._writer = None
+        elif self.fmt in ('csv', 'jsonl'):
+            exists = append and os.path.isfile(self.path) and os.path.getsize(self.path) > 0
+            if exists:
+                self._drop_incomplete_tail()
+                exists = os.path.getsize(self.path) > 0
+            self._file = open(self.path, 'a' if append else 'w', newline='')
+            if self.fmt == 'csv':
+                self._csv = csv.writer(self._file, lineterminator='\n')
+                if not exists:
+                    # leading empty column for the per-image row number, as pandas writes the index
+                    self._csv.writerow([''] + self.columns)
+        else:
+            raise ValueError(f'Unknown results format {self.fmt}. Choose one of csv, jsonl or parquet.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _rows(path: str) -> list:
+        """
+        Offset and file name of every complete data row of a CSV or JSON Lines results file.
+
+        The last entry is the offset at which the complete lines end, with no file name; a run killed in the middle
+        of a write can leave half a line after it.
+        """
+        jsonl = ResultWriter.FORMATS.get(os.path.splitext(path)[1].lower(), 'csv') == 'jsonl'
+        rows, offset = [], 0
+        with open(path, 'rb') as f:
+            for i, line in enumerate(f):
+                if not line.endswith(b'\n'):
+                    break
+                if line.strip() and (jsonl or i > 0):
+                    text = line.decode('utf-8')
+                    filename = json.loads(text)['filename'] if jsonl else next(csv.reader([text]))[1]
+                    rows.append((offset, filename))
+                offset += len(line)
+        return rows + [(offset, None)]
+
+    def _drop_incomplete_tail(self):
+        # only the last image can be incomplete, as each image is written in one go; drop all of its rows
+        rows = self._rows(self.path)
+        end = len(rows) - 1
+        while end > 0 and rows[end - 1][1] == rows[-2][1]:
+            end -= 1
+        with open(self.path, 'rb+') as f:
+            f.truncate(rows[end][0])
+
+    @staticmethod
+    def completed(path: str) -> set:
+        """
+        List the images that already have results in a CSV or JSON Lines file written by a previous run.
+
+        Every image that was run has at least one row, an image without leaves a row of no area, so the rows tell
+        which images are done. The last image in the file is left out, as it may have been interrupted; appending to
+        the file with a ResultWriter drops its rows, so that it can be processed again.
+        @param path: results file. respects tilde expansion
+        @return set of file names; empty if the file does not exist
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isfile(path):
+            return set()
+        rows = ResultWriter._rows(path)[:-1]
+        return {filename for _, filename in rows} - {rows[-1][1]} if rows else set()
+
+    @staticmethod
+    def last_image(path: str):
+        """
+        The image whose rows appending to a CSV or JSON Lines results file drops, as it may have been interrupted.
+
+        @param path: results file. respects tilde expansion
+        @return file name, or None if the file does not exist or has no rows
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isfile(path):
+            return None
+        rows = ResultWriter._rows(path)
+        return rows[-2][1] if len(rows) > 1 else None
+
+    def write(self, records: list):
+        """Write the records of one image."""
+        if self.fmt == 'csv':
+            self._csv.writerows([i] + list(record) for i, record in enumerate(records))
+            self._file.flush()
+        elif self.fmt == 'jsonl':
+            self._file.writelines(json.dumps(dict(zip(self.columns, record))) + '\n' for record in records)
+            self._file.flush()
+        else:
+            self._buffer.extend(records)
+            if len(self._buffer) >= self.row_group_size:
+                self._write_row_group()
+        self.rows += len(records)
+
+    def _write_row_group(self):
+        table = self._pa.Table.from_pydict({c: list(v) for c, v in zip(self.columns, zip(*self._buffer))})
+        if self._writer is None:
+            self._writer = self._pa.parquet.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table.cast(self._writer.schema))
+        self._buffer = []
+
+    def close(self):
+        if self.fmt == 'parquet':
+            if self._buffer:
+                self._write_row_group()
+            if self._writer is not None:
+                self._writer.close()
+        elif not self._file.closed:
+            self._file.close()
+
+
+def stream_results(results, columns, writers=()) -> int:
+    """
+    Print records in the ###Data### format read by the R interface as each image is finished, and pass them on.
+
+    @param results: iterable of lists of records, one list per image
+    @param columns: column names, one per record field
+    @param writers: ResultWriters that should also receive every image's records
+    @return number of images
+    """
+    out = csv.writer(sys.stdout, lineterminator='\n')
+    print('###Data###')
+    out.writerow([''] + list(columns))
+    images = 0
+    for records in results:
+        out.writerows([i] + list(record) for i, record in enumerate(records))
+        sys.stdout.flush()
+        for writer in writers:
+            writer.write(records)
+        images += 1
+    print()
+    return images
+
+
+QA_INDEX_COLUMNS = ('page', 'tile', 'filename', 'Area', 'Error')
+
+
+def _fit_text(text: str, width: int, scale: float, keep_end: bool = False) -> str:
+    """Shorten text with ... until it fits in width pixels, keeping its start, or its end, e.g. of a file name."""
+    import cv2
+    while len(text) > 4 and cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 1)[0][0] > width:
+        text = '...' + text[4:] if keep_end else text[:-4] + '...'
+    return text
+
+
+class ContactSheets:
+    """
+    Tile the QA overlays of many images (see qa_overlay) into numbered pages, with an index of the page and tile of
+    every image, for reviewing a run by eye.
+
+    Each tile is captioned with the file name and the total area of its image, or its error; an image that could not
+    be estimated gets a tile with nothing but the caption. Pages are JPEGs, written once full and when closed, and
+    their tiles are added to the index once the page is written, so the index only lists pages that exist. In a
+    directory that already holds pages with the same prefix, new pages are numbered after them and the index is
+    appended to.
+    """
+
+    # pixels below each overlay, for two lines of caption
+    CAPTION = 30
+
+    def __init__(self, directory: str, size: int = 320, per_page: int = 30, prefix: str = 'qa_',
+                 quality: int = 85):
+        """
+        @param directory: where to write the pages and the index. respects tilde expansion
+        @param size: longer side of the overlays, in pixels
+        @param per_page: tiles per page, in a grid about as wide as it is tall
+        @param prefix: start of the names of the pages, e.g. qa_0001.jpg, and of the index, e.g. qa_index.csv
+        @param quality: JPEG quality of the pages
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = size
+        self.per_page = max(1, per_page)
+        self.columns = math.isqrt(self.per_page - 1) + 1
+        self.prefix = prefix
+        self.quality = quality
+        self.page = max((int(name[len(prefix):-4]) for name in os.listdir(self.directory)
+                         if name.startswith(prefix) and name.endswith('.jpg') and name[len(prefix):-4].isdigit()),
+                        default=0)
+        self.pages = 0
+        self._tiles = []
+        index = os.path.join(self.directory, prefix + 'index.csv')
+        exists = os.path.isfile(index) and os.path.getsize(index) > 0
+        self._index_file = open(index, 'a', newline='')
+        self._index = csv.writer(self._index_file, lineterminator='\n')
+        if not exists:
+            self._index.writerow(QA_INDEX_COLUMNS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, filename: str, overlay, records: list):
+        """
+        Add the tile of an image, writing the page once it is full.
+
+        @param filename: path of the image
+        @param overlay: its overlay, or None if it could not be estimated
+        @param records: its records, for the caption and the index
+        """
+        errors = [record.Error for record in records if record.Error != 'No Error']
+        area = None if errors else float(sum(record.Area for record in records))
+        self._tiles.append((filename, overlay, area, errors[0] if errors else None))
+        if len(self._tiles) >= self.per_page:
+            self._write_page()
+
+    def _write_page(self):
+        import numpy as np
+        import cv2
+        self.page += 1
+        name = f'{self.prefix}{self.page:04d}.jpg'
+        height = self.size + self.CAPTION
+        sheet = np.full((-(-len(self._tiles) // self.columns) * height, self.columns * self.size, 3), 32,
+                        dtype=np.uint8)
+        rows = []
+        for tile, (filename, overlay, area, error) in enumerate(self._tiles):
+            top, left = tile // self.columns * height, tile % self.columns * self.size
+            if overlay is not None:
+                y, x = top + (self.size - overlay.shape[0]) // 2, left + (self.size - overlay.shape[1]) // 2
+                sheet[y:y + overlay.shape[0], x:x + overlay.shape[1]] = overlay
+            caption = error if error else f'{area:.2f} cm2'
+            cv2.putText(sheet, _fit_text(os.path.basename(filename), self.size - 8, 0.4, keep_end=True),
+                        (left + 4, top + self.size + 12), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1,
+                        cv2.LINE_AA)
+            cv2.putText(sheet, _fit_text(caption, self.size - 8, 0.4), (left + 4, top + self.size + 26),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (80, 80, 255) if error else (160, 255, 160), 1, cv2.LINE_AA)
+            rows.append([name, tile + 1, filename, area, error])
+        write_atomic(os.path.join(self.directory, name), encode_image(sheet, '.jpg', quality=self.quality))
+        self._index.writerows(rows)
+        self._index_file.flush()
+        self._tiles = []
+        self.pages += 1
+
+    def close(self):
+        """Write the last page, however few tiles it has, and close the index."""
+        if self._tiles:
+            self._write_page()
+        if not self._index_file.closed:
+            self._index_file.close()
+
+
+def default_cache_path() -> str:
+    """Location of the result cache when none is given: the user's cache directory."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.join('~', '.cache')
+    return os.path.join(os.path.expanduser(base), 'ALFA', 'results.sqlite')
+
+
+class ResultCache:
+    """
+    On-disk cache of estimate results.
+
+    Results are keyed on the image file and on every parameter that affects its areas, so that unchanged images are
+    not decoded, thresholded and labelled again when a directory is re-run. Only successful results are cached.
+    """
+
+    def __init__(self, path: str = None, key: str = 'stat'):
+        """
+        Open, or create, the cache.
+
+        @param path: SQLite file to keep the results in. respects tilde expansion; def: default_cache_path()
+        @param key: 'stat' identifies a file by its path, size and modification time; 'hash' by a hash of its
+                    content, which survives moving or touching the archive at the cost of reading every file
+        """
+        if key not in ('stat', 'hash'):
+            raise ValueError(f'Unknown cache key {key}. Choose stat or hash.')
+        self.path = os.path.abspath(os.path.expanduser(path or default_cache_path()))
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS results (file TEXT, params TEXT, records TEXT, '
+                         'bytes INTEGER, created REAL, accessed REAL, PRIMARY KEY (file, params))')
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def file_key(self, img: str) -> str:
+        """Identify the current content of an image file."""
+        path = os.path.abspath(os.path.expanduser(img))
+        if self.key == 'hash':
+            digest = hashlib.blake2b(digest_size=20)
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            return digest.hexdigest()
+        stat = os.stat(path)
+        return f'{path}|{stat.st_size}|{stat.st_mtime_ns}'
+
+    def file_keys(self, images: list, threads: int = 8) -> dict:
+        """
+        Identify many image files; hashing is IO-bound, so it is spread over threads.
+
+        @return dict of path to key; files that can no longer be read are left out
+        """
+        def key(img):
+            try:
+                return img, self.file_key(img)
+            except OSError:
+                return img, None
+        with concurrent.futures.ThreadPoolExecutor(threads if self.key == 'hash' else 1) as executor:
+            return {img: k for img, k in executor.map(key, images) if k is not None}
+
+    def get(self, file_key: str, params: str, img: str, record_type: type = None):
+        """
+        Look up the results of an image.
+
+        @param file_key: from file_key
+        @param params: serialised parameters, as from ALFA.cache_params
+        @param img: path to report in the returned records
+        @param record_type: type of the records, as from ALFA.record_type; def: EstimateRecord
+        @return list of records, or None on a miss
+        """
+        row = self._db.execute('SELECT records FROM results WHERE file = ? AND params = ?',
+                               (file_key, params)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute('UPDATE results SET accessed = ? WHERE file = ? AND params = ?',
+                         (time.time(), file_key, params))
+        return [(record_type or EstimateRecord)(img, *fields) for fields in json.loads(row[0])]
+
+    def put(self, file_key: str, params: str, records: list):
+        """Store the results of an image, unless any of them is an error."""
+        if any(record.Error != 'No Error' for record in records):
+            return
+        blob = json.dumps([list(record[1:]) for record in records])
+        now = time.time()
+        self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                         (file_key, params, blob, len(blob), now, now))
+        # commit straight away, so that an interrupted run can be resumed from here
+        self._db.commit()
+
+    def evict(self, max_age: float = None, max_mb: float = None) -> int:
+        """
+        Drop old entries.
+
+        @param max_age: drop entries not used for this many days
+        @param max_mb: then drop the least recently used entries until the stored results fit in this many MB
+        @return number of entries dropped
+        """
+        dropped = 0
+        if max_age is not None:
+            dropped += self._db.execute('DELETE FROM results WHERE accessed < ?',
+                                        (time.time() - max_age * 86400,)).rowcount
+        if max_mb is not None:
+            total = self._db.execute('SELECT COALESCE(SUM(bytes), 0) FROM results').fetchone()[0]
+            excess = total - max_mb * 1024 * 1024
+            if excess > 0:
+                rows = self._db.execute('SELECT rowid, bytes FROM results ORDER BY accessed').fetchall()
+                doomed = []
+                for rowid, size in rows:
+                    if excess <= 0:
+                        break
+                    doomed.append((rowid,))
+                    excess -= size
+                self._db.executemany('DELETE FROM results WHERE rowid = ?', doomed)
+                dropped += len(doomed)
+        self._db.commit()
+        if dropped:
+            self._db.execute('VACUUM')
+        return dropped
+
+
+# decode modes for estimate: whether to decode colour and convert, or decode straight to grayscale
+DECODES = ('color', 'gray')
+
+# reduced-resolution decoding; JPEGs are scaled in the DCT domain, which is much cheaper than decoding in full
+# the values name cv2.IMREAD_ flags, so that OpenCV need not be imported to list them
+REDUCTIONS = {
+    ('color', 1): 'IMREAD_COLOR',
+    ('color', 2): 'IMREAD_REDUCED_COLOR_2',
+    ('color', 4): 'IMREAD_REDUCED_COLOR_4',
+    ('color', 8): 'IMREAD_REDUCED_COLOR_8',
+    ('gray', 1): 'IMREAD_GRAYSCALE',
+    ('gray', 2): 'IMREAD_REDUCED_GRAYSCALE_2',
+    ('gray', 4): 'IMREAD_REDUCED_GRAYSCALE_4',
+    ('gray', 8): 'IMREAD_REDUCED_GRAYSCALE_8',
+}
+
+
+# files with any other extension are skipped when a directory is processed
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+# batches of small images: at most this many images per job, and this many megapixels stacked for one labelling.
+# larger stacks cost more per pixel to label, once the labels no longer fit in the caches
+BATCH_IMAGES = 256
+BATCH_MPX = 4
+
+
+def find_images(root: str, exclude=None) -> list:
+    """
+    Recursively list the images below a directory, largest first.
+
+    Processing the biggest scans first keeps them from straggling at the end of a parallel run.
+    @param root: directory to search. respects tilde expansion
+    @param exclude: directory, or list of directories, to skip along with everything below them, e.g. the output
+                    directory
+    @return list of paths
+    """
+    if isinstance(exclude, str):
+        exclude = [exclude]
+    exclude = {os.path.abspath(os.path.expanduser(d)) for d in exclude or () if d}
+    images = []
+    for dir_path, dir_names, file_names in os.walk(os.path.expanduser(root)):
+        dir_names[:] = sorted(d for d in dir_names if os.path.abspath(os.path.join(dir_path, d)) not in exclude)
+        for file_name in file_names:
+            if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    images.append((-os.path.getsize(path), path))
+                except OSError:
+                    # vanished since it was listed
+                    continue
+    return [path for _, path in sorted(images)]
+
+
+# the file, in a planned directory, that lists its images and the shard of each
+MANIFEST = 'alfa_manifest.csv'
+
+
+class ManifestEntry(NamedTuple):
+    """
+    An image of a planned run. path is relative to the planned directory, with / separators, so that the manifest
+    holds wherever the directory is mounted. shard is 'i/N', the ith of N counting from 1.
+    """
+    path: str
+    size: int
+    width: int
+    height: int
+    dpi: float
+    shard: str
+
+
+class MergedResults(NamedTuple):
+    """
+    The results of the shards of a planned run, combined by merge_results.
+
+    images holds the rows of each image, by its path in the manifest and then the images not in it; missing the
+    ManifestEntry of the images without results, unknown the file names of those not in the manifest, and duplicates
+    how many results of an image were dropped in favour of another.
+    """
+    columns: list
+    images: list
+    missing: list
+    unknown: list
+    duplicates: int
+
+
+def parse_shard(shard) -> tuple:
+    """
+    Parse a shard given as 'i/N' or as a tuple (i, N), the ith of N counting from 1.
+
+    @return tuple (i, N)
+    @raise ValueError if it is malformed or there is no such shard
+    """
+    try:
+        index, count = (int(value) for value in (shard.split('/') if isinstance(shard, str) else shard))
+    except (ValueError, TypeError):
+        raise ValueError(f'{shard} is not a shard. Give it as i/N, e.g. 2/4.')
+    if not 1 <= index <= count:
+        raise ValueError(f'There is no shard {index}/{count}; i must be between 1 and N.')
+    return index, count
+
+
+def manifest_path(root: str, manifest: str = None) -> str:
+    """Where the manifest of a planned directory is: manifest if given, else MANIFEST in the directory."""
+    return os.path.expanduser(manifest) if manifest else os.path.join(os.path.expanduser(root), MANIFEST)
+
+
+def split_shards(weights: list, count: int) -> list:
+    """
+    Split work into shards of about equal weight: heaviest first, each item goes to the lightest shard so far.
+
+    This greedy split (longest processing time first) is deterministic and at worst 4/3 of the best possible.
+    @param weights: the weight of each item, e.g. its pixels
+    @param count: number of shards
+    @return the shard of each item, from 1 to count
+    """
+    shards = [0] * len(weights)
+    # total weight and number of every shard; in this order, already a heap
+    loads = [(0, shard) for shard in range(1, count + 1)]
+    for i in sorted(range(len(weights)), key=lambda i: -weights[i]):
+        load, shard = heapq.heappop(loads)
+        shards[i] = shard
+        heapq.heappush(loads, (load + weights[i], shard))
+    return shards
+
+
+def plan_shards(root: str, count: int, index: 'MetadataIndex' = None, exclude=None) -> list:
+    """
+    Plan a run over several machines or processes: list the images below a directory, with what their headers tell,
+    and split them into shards of about equal pixels (see split_shards).
+
+    Images whose dimensions are not in their header are weighed by their size in bytes.
+    @param root: the directory. respects tilde expansion
+    @param count: number of shards
+    @param index: MetadataIndex to read the headers with; def: a new one
+    @param exclude: directories to leave out, as for find_images
+    @return list of ManifestEntry, by shard and largest first within each
+    @raise ValueError if root is not a directory or count is below 1
+    """
+    if count < 1:
+        raise ValueError('A run needs at least one shard.')
+    root = os.path.expanduser(root)
+    if not os.path.isdir(root):
+        raise ValueError(f'{root} is not a directory.')
+    images = find_images(root, exclude)
+    index = (index or MetadataIndex()).build(images)
+    entries, weights = [], []
+    for img in images:
+        try:
+            metadata = index.get(img, validate=False)
+        except OSError:
+            # vanished since it was listed
+            continue
+        entries.append((os.path.relpath(img, root).replace(os.sep, '/'), metadata))
+        weights.append(metadata.width * metadata.height if metadata.width and metadata.height else metadata.size)
+    shards = split_shards(weights, count)
+    order = sorted(range(len(entries)), key=lambda i: (shards[i], -weights[i], entries[i][0]))
+    return [ManifestEntry(entries[i][0], entries[i][1].size, entries[i][1].width, entries[i][1].height,
+                          entries[i][1].x_resolution, f'{shards[i]}/{count}') for i in order]
+
+
+def write_manifest(path: str, entries: list):
+    """
+    Write a manifest as CSV, in one go (see write_atomic).
+
+    @param path: where to write it. respects tilde expansion
+    @param entries: ManifestEntry, e.g. from plan_shards
+    """
+    text = io.StringIO()
+    out = csv.writer(text, lineterminator='\n')
+    out.writerow(ManifestEntry._fields)
+    out.writerows(['' if value is None else value for value in entry] for entry in entries)
+    write_atomic(os.path.abspath(os.path.expanduser(path)), text.getvalue().encode())
+
+
+def read_manifest(path: str) -> list:
+    """
+    Read a manifest written by write_manifest.
+
+    @param path: the manifest. respects tilde expansion
+    @return list of ManifestEntry
+    @raise OSError if it cannot be read, ValueError if it is not a manifest
+    """
+    with open(os.path.expanduser(path), newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        if tuple(next(reader, ())) != ManifestEntry._fields:
+            raise ValueError(f'{path} is not a manifest written by ALFA.py plan.')
+        try:
+            return [ManifestEntry(path, int(size), int(width) if width else None, int(height) if height else None,
+                                  float(dpi) if dpi else None, shard)
+                    for path, size, width, height, dpi, shard in reader]
+        except ValueError:
+            raise ValueError(f'{path} is not a manifest written by ALFA.py plan.')
+
+
+def _csv_value(text: str):
+    # the values of a results CSV as they were written: empty for None, then numbers, then text
+    if text == '':
+        return None
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def read_results(path: str) -> tuple:
+    """
+    Read a CSV, JSON Lines or Parquet results file, e.g. of one shard. A last line cut short by an interrupted write
+    is left out.
+
+    @param path: the results file. respects tilde expansion
+    @return tuple of the column names, None if the file has none, and the rows, as lists of values
+    """
+    path = os.path.expanduser(path)
+    fmt = ResultWriter.FORMATS.get(os.path.splitext(path)[1].lower(), 'csv')
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Reading parquet requires pyarrow. Install it with pip install pyarrow.')
+        table = pyarrow.parquet.read_table(path)
+        return table.column_names, [list(row.values()) for row in table.to_pylist()]
+    with open(path, newline='', encoding='utf-8') as f:
+        text = f.read()
+    lines = text[:text.rfind('\n') + 1].splitlines()
+    if fmt == 'jsonl':
+        rows = [json.loads(line) for line in lines if line.strip()]
+        columns = list(rows[0]) if rows else None
+        return columns, [[row.get(column) for column in columns] for row in rows]
+    rows = list(csv.reader(lines))
+    if not rows:
+        return None, []
+    # the first column is the row number within each image; file names stay text
+    columns = rows[0][1:]
+    keep = columns.index('filename') if 'filename' in columns else None
+    return columns, [[value if i == keep else _csv_value(value) for i, value in enumerate(row[1:])]
+                     for row in rows[1:] if row]
+
+
+def merge_results(root: str, paths: list, entries: list) -> MergedResults:
+    """
+    Combine the results files of the shards of a planned run, and check them against its manifest.
+
+    The file names in the results are matched to the manifest by their path below root, or, for shards that saw the
+    directory mounted elsewhere, by the longest trailing part of the path that is in the manifest. The results of an
+    image are taken from one file only: the last one given that has them, unless they hold an error there (anything
+    but 'No Error') and not in an earlier one. Running a shard, or part of one, again and listing its results last
+    thus replaces what it had. Every image that was run has at least one row, even without leaves, so an image
+    with none is missing.
+    @param root: the planned directory. respects tilde expansion
+    @param paths: the results files, all with the same columns
+    @param entries: the ManifestEntry of the plan, see read_manifest
+    @return MergedResults
+    @raise ValueError if the files have different columns
+    """
+    root = os.path.abspath(os.path.expanduser(root))
+    planned = {entry.path for entry in entries}
+
+    def key(filename):
+        path = os.path.abspath(os.path.expanduser(filename))
+        if path.startswith(root + os.sep):
+            return os.path.relpath(path, root).replace(os.sep, '/')
+        parts = path.replace(os.sep, '/').split('/')
+        for i in range(1, len(parts)):
+            if '/'.join(parts[i:]) in planned:
+                return '/'.join(parts[i:])
+        return filename
+
+    columns, images, duplicates = None, {}, 0
+    for path in paths:
+        file_columns, rows = read_results(path)
+        if file_columns is None:
+            continue
+        if columns is None:
+            columns = file_columns
+        elif file_columns != columns:
+            raise ValueError(f'{path} has the columns {", ".join(file_columns)}, not {", ".join(columns)}. Were all '
+                             f'the shards run with the same options?')
+        filename = columns.index('filename')
+        outcome = next((columns.index(column) for column in ('Error', 'Pre-process Result') if column in columns), None)
+        found = {}
+        for row in rows:
+            found.setdefault(key(row[filename]), []).append(row)
+        for image, image_rows in found.items():
+            failed = outcome is not None and any(row[outcome] != 'No Error' for row in image_rows)
+            if image in images:
+                duplicates += 1
+                if failed and not images[image][1]:
+                    continue
+            images[image] = (image_rows, failed)
+
+    missing = [entry for entry in entries if entry.path not in images]
+    ordered = [images.pop(path)[0] for path in sorted(planned) if path in images]
+    unknown = sorted(images)
+    return MergedResults(columns or [], ordered + [images[image][0] for image in unknown], missing, unknown,
+                         duplicates)
+
+
+# the file, in a directory being sorted, that holds the moves of a sort until every one is done
+SORT_JOURNAL = '.alfa_sort_journal'
+
+
+class SortMove(NamedTuple):
+    source: str  # name of the file in the directory being sorted
+    target: str  # its path after the move, relative to that directory
+
+
+def list_files(the_dir: str) -> list:
+    """
+    List the files directly in a directory, by name.
+
+    os.scandir gets the type of each entry with the names, so unlike isfile there is no round trip per file, which
+    is what counts on network drives.
+    @param the_dir: the directory
+    @return list of file names
+    """
+    with os.scandir(the_dir) as entries:
+        return sorted(entry.name for entry in entries
+                      if entry.name not in (SORT_JOURNAL, MANIFEST) and entry.is_file())
+
+
+def sort_files(the_dir: str, command: str, plan, threads: int = 16, dry_run: bool = False) -> list:
+    """
+    Move the files of a directory into subdirectories, resuming an interrupted sort if there is one.
+
+    The moves are written to a journal in the directory before any is made, and the journal is removed once all are
+    done. If a journal is found, its moves are finished instead of planning new ones; a move whose file is gone has
+    been made already. The subdirectories are created up front, and the files are renamed by a pool of threads.
+    @param the_dir: the directory to sort
+    @param command: name of the sort, e.g. 'resolution_sort'; a journal left by another sort is not resumed
+    @param plan: function that returns the list of SortMove, called only if there is nothing to resume
+    @param threads: how many files to rename at once
+    @param dry_run: only return the moves
+    @return list of SortMove
+    @raise ValueError if another sort of the directory was interrupted, OSError if some files could not be moved
+    """
+    journal = os.path.join(the_dir, SORT_JOURNAL)
+    moves = None
+    if os.path.exists(journal):
+        with open(journal) as f:
+            header = json.loads(f.readline())
+            if header.get('command') != command:
+                raise ValueError(f"An interrupted {header.get('command')} of {the_dir} has not been finished. Run it "
+                                 f"again, or remove {journal}.")
+            moves = [SortMove(*json.loads(line)) for line in f]
+    if moves is None:
+        moves = plan()
+        if dry_run:
+            return moves
+        write_atomic(journal, ''.join(json.dumps(line) + '\n'
+                                      for line in [{'command': command}] + [list(move) for move in moves]).encode())
+    elif dry_run:
+        return moves
+
+    for directory in {os.path.dirname(move.target) for move in moves}:
+        os.makedirs(os.path.join(the_dir, directory), exist_ok=True)
+
+    def move(chunk):
+        errors = []
+        for move in chunk:
+            source = os.path.join(the_dir, move.source)
+            target = os.path.join(the_dir, move.target)
+            try:
+                # the subdirectories are on the same filesystem, so a rename will do
+                os.rename(source, target)
+            except FileNotFoundError:
+                if not os.path.exists(target):
+                    errors.append(f'{move.source}: vanished before it could be moved')
+            except OSError:
+                try:
+                    shutil.move(source, target)
+                except OSError as error:
+                    errors.append(f'{move.source}: {error}')
+        return errors
+
+    # a few chunks per thread, rather than a task per file
+    size = max(1, min(256, len(moves) // (threads * 4)))
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        errors = [error for chunk in executor.map(move, [moves[i:i + size] for i in range(0, len(moves), size)])
+                  for error in chunk]
+    if errors:
+        raise OSError(f'{len(errors)} files could not be moved; run the sort again to retry them. '
+                      f'First: {errors[0]}')
+    os.remove(journal)
+    return moves
+
+
+# the file in which a watch remembers the images it has estimated, in the watched directory unless given
+WATCH_STATE = '.alfa_watch'
+
+
+class WatchState:
+    """
+    The images a watch has estimated, with the size and modification time they had then, kept in a JSON Lines file
+    so that a restarted watch neither misses nor repeats any. An image that changes is estimated again.
+    """
+
+    def __init__(self, path: str):
+        """
+        @param path: the file. respects tilde expansion
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.done = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    # a watch killed in the middle of a write can leave half a line
+                    with contextlib.suppress(ValueError, KeyError):
+                        entry = json.loads(line)
+                        self.done[entry['path']] = (entry['size'], entry['mtime'])
+        self._file = open(self.path, 'a')
+
+    def __contains__(self, item) -> bool:
+        """@param item: tuple of the path, size and modification time of an image"""
+        path, size, mtime = item
+        return self.done.get(path) == (size, mtime)
+
+    def add(self, path: str, size: int, mtime: float):
+        self.done[path] = (size, mtime)
+        self._file.write(json.dumps({'path': path, 'size': size, 'mtime': mtime}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Inotify:
+    """
+    Files finished in, or moved into, a tree of directories, from the Linux inotify API.
+
+    Only changes made through this machine's kernel are seen, so not those made by other machines on a network drive;
+    watch polls for those.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self):
+        """@raise OSError if inotify is not available"""
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}
+
+    def add(self, directory: str):
+        """Watch a directory, not its subdirectories."""
+        import ctypes
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Cannot watch {directory}')
+        self._dirs[wd] = directory
+
+    def read(self, timeout: float) -> list:
+        """
+        Wait for events.
+
+        @param timeout: seconds to wait for the first one
+        @return list of tuples of a path and whether it is a directory; None for a path if events were lost
+        """
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, False))
+            elif wd in self._dirs and name:
+                events.append((os.path.join(self._dirs[wd], os.fsdecode(name)), bool(mask & self.IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def scan_images(root: str, exclude=()) -> dict:
+    """
+    Recursively list the images below a directory with their size and modification time.
+
+    @param root: the directory
+    @param exclude: directories to skip along with everything below them
+    @return dict of path to tuple of size and modification time
+    """
+    found = {}
+    exclude = {os.path.abspath(d) for d in exclude if d}
+    directories = [root]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError:
+            # vanished, or not readable
+            continue
+        for entry in entries:
+            with contextlib.suppress(OSError):
+                if entry.is_dir():
+                    if os.path.abspath(entry.path) not in exclude:
+                        directories.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    stat = entry.stat()
+                    found[os.path.abspath(entry.path)] = (stat.st_size, stat.st_mtime)
+    return found
+
+
+class WatchImages:
+    """
+    The images of a watch that are not done yet: those still being written, which wait until they have settled, and
+    those out with the workers, whose results come back through a queue.
+    """
+
+    def __init__(self, root: str, state: WatchState, exclude=()):
+        """
+        @param root: the directory watched
+        @param state: the images already estimated
+        @param exclude: directories to skip along with everything below them
+        """
+        import queue
+        self.root = root
+        self.state = state
+        self.exclude = exclude
+        # path to size, modification time and when either last changed, of the images not yet ready
+        self.pending = {}
+        # path to size and modification time of the images being estimated
+        self.running = {}
+        # tuples of the path and the result of each finished job, or the exception it raised
+        self.done = queue.Queue()
+        # when the whole tree was last listed
+        self.listed = time.monotonic()
+
+    def found(self, path: str, stat: tuple):
+        """
+        Note an image that may be new or changed.
+
+        @param path: absolute path to the image
+        @param stat: tuple of its size and modification time
+        """
+        if (path,) + stat in self.state or self.running.get(path) == stat:
+            return
+        if self.pending.get(path, (None, None))[:2] != stat:
+            self.pending[path] = stat + (time.monotonic(),)
+
+    def scan(self, directory: str = None):
+        """Note the images below a directory; def: the whole tree."""
+        for path, stat in scan_images(directory or self.root, self.exclude).items():
+            self.found(path, stat)
+        if directory is None:
+            self.listed = time.monotonic()
+
+    def inotify(self):
+        """
+        Watch the tree with inotify, leaving out the excluded directories.
+
+        @return Inotify, or None if it is not available
+        """
+        exclude = {os.path.abspath(e) for e in self.exclude if e}
+        inotify = None
+        try:
+            inotify = Inotify()
+            for directory, dir_names, _ in os.walk(self.root):
+                dir_names[:] = [d for d in dir_names if os.path.abspath(os.path.join(directory, d)) not in exclude]
+                inotify.add(directory)
+        except OSError:
+            if inotify is not None:
+                inotify.close()
+            return None
+        return inotify
+
+    def ready(self, settle: float) -> list:
+        """
+        Take the images whose size and modification time have not changed for settle seconds off pending.
+
+        @param settle: seconds an image must stay unchanged
+        @return list of tuples of the path, size and modification time of each image
+        """
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # gone before it was ready
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.pending[path] = (stat.st_size, stat.st_mtime, now)
+            elif now - since >= settle and size > 0 and path not in self.running:
+                del self.pending[path]
+                ready.append((path, size, mtime))
+        return ready
+
+
+# the ALFA instance each pool worker was initialised with
+_worker = None
+# and its attributes as they were then
+_worker_state = None
+
+
+# how a directory run spreads its images over the cores: worker processes, threads of this process, or none
+BACKENDS = ('process', 'thread', 'serial')
+
+
+def _init_worker(estimator):
+    global _worker, _worker_state
+    # Ctrl-C is for the parent, which decides what becomes of the jobs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker = estimator
+    _worker_state = estimator.__dict__.copy()
+
+
+def _run_job(job):
+    method, path, args, overrides = job
+    # parameters changed since the pool started come with every job
+    if overrides or _worker.__dict__ != _worker_state:
+        _worker.__dict__.update(_worker_state)
+        _worker.__dict__.update(overrides)
+    return _call(_worker, method, path, args)
+
 
 class ALFA:
     """Calculate leaf area."""
 
-    def __init__(self, red_scale: int = 0, red_scale_pixels: int = 0, mask_pixels: int = 0,
-                 mask_offset_y: int = 0, mask_offset_x: int = 0,
-                 threshold: int = 120, cut_off: int = 10000, output_dir: str = tempfile.TemporaryDirectory().name,
-                 crop: int = 0, combine: bool = True, res: int = 0,
-                 workers: int = multiprocessing.cpu_count() - 1):
+    def __init__(self, red_scale: int = 0, red_scale_pixels: int = 0, mask_pixels: int = 0,
+                 mask_offset_y: int = 0, mask_offset_x: int = 0,
+                 threshold: int = 120, cut_off: int = 10000, output_dir: str = tempfile.TemporaryDirectory().name,
+                 crop: int = 0, combine: bool = True, res: int = 0, default_res=0,
+                 workers: int = max(1, multiprocessing.cpu_count() - 1), labeller: str = 'opencv',
+                 cache: str = None, cache_key: str = 'stat', decode: str = 'color', reduce: int = 1,
+                 tile_mb: float = 0, memory_mb: float = None, output_format: str = None, output_quality: int = 95,
+                 output_compression: int = None, intermediate_dir: str = None, batch_mpx: float = 0,
+                 profile: bool = False, features: bool = False, auto_threshold: str = None,
+                 backend: str = 'process', shard=None, manifest: str = None, qa_dir: str = None,
+                 qa_size: int = 320, qa_per_page: int = 30):
+        """
+        Initiate (default) variables.
+        @param red_scale: whether or not to add a red scale
+        @param red_scale_pixels: how many pixels wide the side of the scale should be
+        @param mask_offset_x: offset for the masking window in number of pixels from top to bottom of the image
+        @param mask_offset_y: offset for the masking window in number of pixels from right to left of the image
+        @param mask_pixels: how many pixels each side of the masking window should be
+        @param threshold: value for contrast analysis
+        @param cut_off: patches below this number of pixels will not be counted
+        @param output_dir: where to save the images
+        @param crop: remove the edges of the image
+        @param combine: combine all patches into a single LA estimate T/F
+        @param res: specify resolution manually, for every image
+        @param default_res: resolution of images without one in their header; either a number, or a dict of directory
+                            to resolution, applying to the images below that directory, in which the key '' applies
+                            to all other images
+        @param workers: how many cores to use for multiprocessing; def: all but one
+        @param labeller: connected-component backend, one of LABELLERS
+        @param cache: SQLite file in which to cache estimate results, or '' for the user cache directory; def: no cache
+        @param cache_key: how the cache recognises unchanged images, 'stat' or 'hash'; see ResultCache
+        @param decode: 'color' decodes in colour and converts to grayscale; 'gray' decodes straight to grayscale,
+                       which is faster and lighter but weighs the channels slightly differently
+        @param reduce: decode at 1/2, 1/4 or 1/8 of the resolution, for quick triage runs; areas and cut_off are
+                       corrected for the scale, at some loss of precision
+        @param tile_mb: threshold and label in horizontal strips of about this many MB, to bound the memory used by
+                        very large scans; the areas are identical. def: 0, the whole image at once
+        @param memory_mb: memory a directory run may use; fewer workers are started if the largest images would not
+                          fit. def: the memory currently available. 0 turns the limit off
+        @param output_format: format of saved images, one of OUTPUT_FORMATS. def: jpg for pre-processed images, the
+                              format of the source for thresholded images. Thresholded images saved as png are stored
+                              at one bit per pixel
+        @param output_quality: JPEG quality of saved images, 0 to 100
+        @param output_compression: PNG compression level (0 to 9) or TIFF compression scheme of saved images;
+                                   def: the fast defaults of encode_image
+        @param intermediate_dir: where process saves the pre-processed images, for auditing; def: not saved
+        @param batch_mpx: estimate images of at most this many megapixels in batches, thresholding and labelling many
+                          of them at once, which saves much of the per-image overhead for thumbnails and leaf punches;
+                          the areas are identical. Not used while thresholded images are saved. def: 0, no batches
+        @param profile: time the stages of every image, in every worker, and count the bytes read and written, into
+                        profiler; see Profile. def: off, which costs next to nothing
+        @param features: return LeafRecords, with the position, outline and colour of every leaf, measured from the
+                         same labels as the areas; one per leaf, whatever combine. Scans are decoded in colour for
+                         their mean colour unless decode is 'gray', and neither tiled nor batched. def: areas only
+        @param auto_threshold: choose the threshold of every scan from its histogram, by one of THRESHOLD_METHODS, and
+                               return it with the areas (AutoThresholdRecord); threshold then only applies to scans
+                               of a single gray level. def: None, threshold for every scan
+        @param backend: how folders are spread over the workers, one of BACKENDS. 'process' starts worker
+                        processes, each with its own copy of the libraries and of this instance; 'thread' runs them
+                        in threads of this process, sharing one interpreter and passing results back without
+                        pickling, which OpenCV allows by releasing the GIL while it decodes, converts, thresholds,
+                        labels and encodes; 'serial' uses none, whatever workers. def: 'process'
+        @param shard: process only this shard of a directory, 'i/N' or (i, N), as planned by plan_shards, so that
+                      several machines sharing the directory can split it; see shard_images. def: all of it
+        @param manifest: the manifest of the plan; def: MANIFEST in the directory
+        @param qa_dir: where to write contact sheets for review: a small overlay of every image estimated, with the
+                       outline and area of every leaf counted, drawn while its labels are in memory and tiled into
+                       pages by this process, with an index; see ContactSheets. Like output_dir, this turns off the
+                       result cache, tiling and batches. def: no sheets
+        @param qa_size: longer side of each overlay, in pixels
+        @param qa_per_page: overlays per page of the contact sheets
+        """
+        self.red_scale = red_scale
+        self.red_scale_pixels = red_scale_pixels
+        self.mask_pixels = mask_pixels
+        self.mask_offset_y = mask_offset_y
+        self.mask_offset_x = mask_offset_x
+        self.threshold = threshold
+        self.cut_off = cut_off
+        self.output_dir = output_dir
+        self.crop = crop
+        self.combine = combine
+        self.res = res
+        self.default_res = default_res
+        self.workers = workers
+        self.labeller = labeller
+        self.cache = cache
+        self.cache_key = cache_key
+        self.decode = decode
+        self.reduce = reduce
+        self.tile_mb = tile_mb
+        self.memory_mb = memory_mb
+        self.output_format = output_format
+        self.output_quality = output_quality
+        self.output_compression = output_compression
+        self.intermediate_dir = intermediate_dir
+        self.batch_mpx = batch_mpx
+        self.profile = profile
+        self.features = features
+        self.auto_threshold = auto_threshold
+        self.backend = backend
+        self.shard = shard
+        self.manifest = manifest
+        self.qa_dir = qa_dir
+        self.qa_size = qa_size
+        self.qa_per_page = qa_per_page
+        self.profiler = Profile()
+        self.metadata = MetadataIndex()
+        self._pool = None
+        self._pool_state = None
+        self._cache = None
+        self._sheets = None
+        self._qa_pages = 0
+
+    def __getstate__(self):
+        # pools, database connections and open files cannot be pickled, and workers have no use for any of them
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pool_state'] = None
+        state['_cache'] = None
+        state['_sheets'] = None
+        # the index belongs to the parent process; workers read the few headers they need themselves
+        state['metadata'] = MetadataIndex()
+        state['profiler'] = Profile()
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the worker pool and close the result cache and the contact sheets, if they have been opened."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_state = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        self.close_sheets()
+
+    def contact_sheets(self):
+        """
+        Return the contact sheets, opening them on first use. The sheets of each shard are named apart, as several
+        may share qa_dir.
+
+        @return ContactSheets, or None without a qa_dir
+        """
+        if not self.qa_dir:
+            return None
+        if self._sheets is None:
+            prefix = 'qa_shard{}of{}_'.format(*parse_shard(self.shard)) if self.shard else 'qa_'
+            self._sheets = ContactSheets(self.qa_dir, self.qa_size, self.qa_per_page, prefix, self.output_quality)
+        return self._sheets
+
+    def close_sheets(self):
+        """Write the last, partly filled page of the contact sheets, if they have been opened, and close them."""
+        if self._sheets is not None:
+            self._sheets.close()
+            self._qa_pages += self._sheets.pages
+            self._sheets = None
+
+    @property
+    def qa_pages(self) -> int:
+        """How many pages of contact sheets have been written and closed so far."""
+        return self._qa_pages
+
+    def open_cache(self):
+        """
+        Return the result cache, opening it on first use.
+
+        @return ResultCache, or None if caching is off
+        """
+        if self.cache is None:
+            return None
+        if self._cache is None or self._cache.key != self.cache_key:
+            self._cache = ResultCache(self.cache or None, self.cache_key)
+        return self._cache
+
+    def cache_params(self, method: str = '_estimate_image') -> str:
+        """Serialise every parameter that affects the results of estimate or process, to key the result cache on."""
+        params = {'threshold': self.threshold, 'cut_off': self.cut_off, 'res': self.res, 'default_res': self.default_res,
+                  'combine': self.combine, 'decode': self.decode, 'reduce': self.reduce}
+        if method == '_process_image':
+            params['preprocess'] = [self.crop, self.mask_pixels, self.mask_offset_y, self.mask_offset_x,
+                                    self.red_scale, self.red_scale_pixels]
+        if self.features:
+            params['features'] = True
+        if self.auto_threshold:
+            params['auto_threshold'] = self.auto_threshold
+        return json.dumps(params, sort_keys=True)
+
+    def record_type(self) -> type:
+        """Type of the records of estimate, process and watch: LeafRecord with features, AutoThresholdRecord with
+        auto_threshold, else EstimateRecord."""
+        if self.features:
+            return LeafRecord
+        return AutoThresholdRecord if self.auto_threshold else EstimateRecord
+
+    def result_columns(self) -> tuple:
+        """Column names of the records of estimate, process and watch, as set by features and auto_threshold."""
+        return self.record_type()._fields
+
+    def _as_results(self, records: list) -> list:
+        """Give the error records of an image the type of the others, with the extra fields left empty."""
+        record_type = self.record_type()
+        return [record if isinstance(record, record_type) else record_type(*record) for record in records]
+
+    def _writes_images(self, method: str = '_estimate_image') -> bool:
+        if method == '_process_image' and self.intermediate_dir:
+            return True
+        if self.qa_dir and method in QA_METHODS:
+            return True
+        return bool(self.output_dir) and os.path.isdir(self.output_dir)
+
+    def _run_cached(self, images: list, method: str = '_estimate_image'):
+        """
+        Estimate leaf area for a list of images, taking what it can from the result cache and storing the rest.
+
+        Images are always processed when thresholded images are being saved, so that none are missing.
+        @param images: paths to the images, ideally largest first
+        @param method: '_estimate_image', or '_process_image' to pre-process them first
+        @return generator of lists of EstimateRecord, one list per image
+        """
+        cache = self.open_cache()
+        if cache is None:
+            yield from self._run_batched(method, images)
+            return
+
+        params = self.cache_params(method)
+        keys = cache.file_keys(images)
+        misses = []
+        for img in images:
+            records = None
+            if img in keys and not self._writes_images(method):
+                records = cache.get(keys[img], params, img, self.record_type())
+            if records is None:
+                misses.append(img)
+            else:
+                yield records
+
+        for records in self._run_batched(method, misses):
+            if records and records[0].filename in keys:
+                cache.put(keys[records[0].filename], params, records)
+            yield records
+
+    def _run_batched(self, method: str, images: list):
+        """
+        As _run, but estimate the images of at most batch_mpx megapixels in batches.
+
+        The larger images go first, one per job, then the batches.
+        @param method: '_estimate_image' or '_process_image'; only estimates are batched
+        @param images: paths to the images, ideally largest first
+        @return generator of lists of EstimateRecord, one list per image, in order of completion
+        """
+        if (method != '_estimate_image' or not self.batch_mpx or self._writes_images(method) or self.features
+                or len(images) < 2):
+            yield from self._run(method, images)
+            return
+
+        large, batches = self.batch_images(images)
+        yield from self._run(method, large)
+        for batch in self._run('_estimate_batch', batches):
+            yield from batch
+
+    def batch_images(self, images: list):
+        """
+        Split the images into those to estimate one by one and batches of those that may be small.
+
+        Only file sizes are looked at, as reading every header would cost about as much as decoding a thumbnail. A
+        file bigger than an uncompressed colour image of batch_mpx megapixels cannot be small; the rest are checked
+        once decoded, in _estimate_batch. There are enough batches to keep all workers busy.
+        @param images: paths to the images, largest first
+        @return tuple of the list of images to estimate one by one, and a list of tuples of images to batch
+        """
+        limit = self.batch_mpx * 1e6 * 3 + 65536
+        large, small = [], []
+        for img in images:
+            try:
+                size = os.path.getsize(img)
+            except OSError:
+                # left to _estimate_image to report
+                size = None
+            if size is not None and size <= limit:
+                small.append(img)
+            else:
+                large.append(img)
+        per_batch = max(1, min(BATCH_IMAGES, -(-len(small) // (self.workers * 4))))
+        return large, [tuple(small[i:i + per_batch]) for i in range(0, len(small), per_batch)]
+
+    def _get_pool(self, processes: int):
+        """
+        Return the worker pool, starting it on first use, and the parameters changed since it was started.
+
+        The pool outlives individual calls to estimate or preprocess. Each worker process receives a copy of this
+        instance once, when it starts; parameters changed since then are sent along with every job, so that the pool
+        only has to be restarted if the number of workers or the backend changes. Threads work on this instance
+        itself, so nothing is sent to them. Jobs are run with the function from _pool_function.
+        @param processes: number of workers
+        @return tuple of the pool and a dict of the changed attributes
+        @raise ValueError if backend is not one of BACKENDS
+        """
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {self.backend}. Choose one of {", ".join(BACKENDS)}.')
+        state = self.__getstate__()
+        state['_processes'] = processes
+        if self._pool is not None and (self._pool_state['_processes'] != processes
+                                       or self._pool_state['backend'] != self.backend):
+            self.close()
+        if self._pool is None:
+            if self.backend == 'thread':
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(processes)
+            else:
+                self._pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self,))
+            self._pool_state = state
+        if self.backend == 'thread':
+            return self._pool, {}
+        # the metadata index and the profiler are the workers' own
+        overrides = {key: value for key, value in state.items()
+                     if key not in ('metadata', 'profiler', '_processes') and self._pool_state.get(key) != value}
+        return self._pool, overrides
+
+    def _pool_function(self):
+        """The function with which the pool from _get_pool runs a job of (method, path, args, overrides)."""
+        return self._run_in_thread if self.backend == 'thread' else _run_job
+
+    def _run_in_thread(self, job):
+        method, path, args, _ = job
+        return _call(self, method, path, args)
+
+    def peak_memory_mb(self, img: str):
+        """
+        Estimate how much memory estimate needs for an image, from the dimensions in its header.
+
+        @param img: path to the image, or a tuple of paths estimated as a batch
+        @return MB, or None if the dimensions cannot be read
+        """
+        if isinstance(img, tuple):
+            # a stack, its binary copy and its labels, and the images waiting to be stacked
+            return (BATCH_MPX + self.batch_mpx) * 1e6 / (self.reduce * self.reduce) * 13 / 1024 / 1024
+        try:
+            metadata = self.metadata.get(img)
+        except OSError:
+            return None
+        if not metadata.width or not metadata.height:
+            return None
+        pixels = metadata.width * metadata.height / (self.reduce * self.reduce)
+        # the decoded image, its grayscale copy and, unless tiled, the binary image, the labels and the labeller's
+        # own working memory: about 13 bytes per pixel in colour
+        per_pixel = 3 if self.decode == 'color' else 1
+        if self.tile_mb:
+            return (pixels * (per_pixel + 1)) / 1024 / 1024 + self.tile_mb
+        return pixels * (per_pixel + 10) / 1024 / 1024
+
+    def worker_limit(self, images: list) -> int:
+        """
+        Limit the number of workers so that the largest images, which are processed first, fit in memory together.
+
+        @param images: paths to the images, or tuples of paths for batches, largest first
+        @return number of workers to start, between 1 and workers
+        """
+        budget = available_memory_mb() if self.memory_mb is None else self.memory_mb
+        if not budget:
+            return self.workers
+        # leave some room for the interpreters themselves
+        budget *= 0.8
+        self.metadata.build([img for img in images[:self.workers] if not isinstance(img, tuple)])
+        needed = 0
+        for workers, img in enumerate(images[:self.workers]):
+            needed += self.peak_memory_mb(img) or 0
+            if needed > budget:
+                return max(1, workers)
+        return self.workers
+
+    def _run(self, method: str, images: list, *args):
+        """
+        Apply one of the single-image methods to a list of images, yielding results as they complete.
+
+        @param method: name of the method, e.g. '_estimate_image'
+        @param images: paths to the images, ideally largest first
+        @param args: further arguments for the method, the same for every image
+        @return generator of the method's return values, in order of completion
+        @raise ValueError if backend is not one of BACKENDS
+        """
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {self.backend}. Choose one of {", ".join(BACKENDS)}.')
+        workers = self.worker_limit(images) if len(images) > 1 and self.backend != 'serial' else 1
+        if workers <= 1:
+            results = (_call(self, method, img, args) for img in images)
+        else:
+            # small chunks cut the dispatch overhead for large batches without leaving big scans for last
+            chunk_size = max(1, min(32, len(images) // (workers * 8)))
+            pool, overrides = self._get_pool(workers)
+            jobs = [(method, img, args, overrides) for img in images]
+            results = pool.imap_unordered(self._pool_function(), jobs, chunk_size)
+        if not self.profile and not self.qa_dir:
+            yield from results
+            return
+
+        self.profiler.workers = max(self.profiler.workers, workers)
+        start = time.perf_counter()
+        try:
+            for result in results:
+                yield self._job_result(result)
+        finally:
+            self.profiler.wall += time.perf_counter() - start
+
+    def _job_result(self, result):
+        """
+        Take the stage times and QA overlays off the result of a job (see _call), keeping the times in profiler and
+        tiling the overlays into the contact sheets.
+        """
+        if not self.profile and not self.qa_dir:
+            return result
+        result, times, overlays = result
+        if times is not None:
+            self.profiler.jobs.append(times)
+        if overlays is not None:
+            sheets = self.contact_sheets()
+            for path, overlay in overlays:
+                sheets.add(path, overlay, [record for record in result if record.filename == path])
+            # the image could not be estimated, so there is nothing to draw but its error
+            if result and result[0].filename not in {path for path, _ in overlays}:
+                sheets.add(result[0].filename, None, result)
+        return result
+
+    def estimate(self, img: str) -> 'DataFrame':
+        """
+        Estimate leaf area for a given image or directory of images.
+
+        @param img: path to the scan or images folder. respects tilde expansion
+        @return pandas DF with the file name of the input and the estimated area(s), and their features if set
+        """
+        return records_to_frame(self.iter_estimate(img), self.result_columns())
+
+    def iter_estimate(self, img: str, skip=()):
+        """
+        Estimate leaf area for a given image or directory of images, yielding the results of each image as it is done.
+
+        Unlike estimate, nothing is kept once it has been yielded, so memory stays flat however many images there are.
+        @param img: path to the scan or images folder. respects tilde expansion
+        @param skip: paths of images to leave out of a directory, e.g. those already done by an interrupted run
+        @return generator of lists of EstimateRecord, one list per image, in order of completion
+        """
+        for records in self._iter_images(img, skip, '_estimate_image'):
+            yield self._as_results(records)
+
+    def process(self, img: str) -> 'DataFrame':
+        """
+        Pre-process and estimate leaf area for a given image or directory of images in one go.
+
+        The crop, mask and red scale of preprocess are applied to the decoded scan in memory, which is then thresholded
+        straight away, so there is no intermediate JPEG to encode, write, read and decode again, and no JPEG loss.
+        The pre-processed images are only saved if intermediate_dir is set.
+        @param img: path to the scan or images folder. respects tilde expansion
+        @return pandas DF with the file name of the input and the estimated area(s), and their features if set
+        """
+        return records_to_frame(self.iter_process(img), self.result_columns())
+
+    def iter_process(self, img: str, skip=()):
+        """
+        As process, yielding the results of each image as it is done.
+
+        @param img: path to the scan or images folder. respects tilde expansion
+        @param skip: paths of images to leave out of a directory, e.g. those already done by an interrupted run
+        @return generator of lists of EstimateRecord, one list per image, in order of completion
+        """
+        for records in self._iter_images(img, skip, '_process_image'):
+            yield self._as_results(records)
+
+    def iter_watch(self, img: str, state: str = None, interval: float = 2, settle: float = 2, poll: bool = False,
+                   stop=None, redo=()):
+        """
+        Estimate leaf area for the images in a directory, then for every image that arrives in it, as soon as it has
+        been written, until stop returns True or the watch is interrupted.
+
+        An image is ready once its size and modification time have not changed for settle seconds. New images are
+        found through inotify where it is available, and otherwise, or with poll, by listing the directory every
+        interval seconds, which is the only way to see files written by other machines to a network drive. Ready
+        images go straight to the worker pool, which stays up throughout.
+        @param img: the directory. respects tilde expansion
+        @param state: file in which to remember the images estimated, so that a restarted watch skips them unless
+                      they have changed; def: WATCH_STATE in the directory
+        @param interval: seconds between listings when polling
+        @param settle: seconds an image must stay unchanged before it is estimated
+        @param poll: list the directory even if inotify is available
+        @param stop: function called between rounds; the watch ends once it returns True
+        @param redo: paths of images to estimate again even if the state has them, e.g. the last image of a results
+                     file that is appended to, which ResultWriter drops
+        @return generator of lists of EstimateRecord, one list per image, in order of completion; an image counts
+                as done once the caller has taken its records and asked for more
+        """
+        root = os.path.abspath(os.path.expanduser(img))
+        if not os.path.isdir(root):
+            yield self._as_results(
+                [EstimateRecord(img, None, None, f'Your input {img} needs to be a path to a directory.')])
+            return
+
+        state = WatchState(state or os.path.join(root, WATCH_STATE))
+        for path in redo:
+            state.done.pop(os.path.abspath(os.path.expanduser(path)), None)
+        images = WatchImages(root, state, [self.output_dir, self.qa_dir])
+        cache = self.open_cache()
+        params = self.cache_params() if cache is not None else None
+        pool, overrides = self._get_pool(self.workers) if self.workers > 1 and self.backend != 'serial' \
+            else (None, None)
+        inotify = None if poll else images.inotify()
+
+        images.scan()
+        try:
+            while not (stop and stop()):
+                # results first, so that they are out as soon as possible
+                yield from self._watch_finished(images, cache, params)
+                yield from self._watch_start(images, settle, cache, params, pool, overrides)
+                if images.done.empty():
+                    self._watch_wait(images, inotify, interval, settle)
+        except KeyboardInterrupt:
+            # images still running are estimated again by the next watch
+            if pool is not None:
+                pool.terminate()
+                self._pool = None
+                self._pool_state = None
+        finally:
+            state.close()
+            self.close_sheets()
+            if inotify is not None:
+                inotify.close()
+
+    def _watch_finished(self, images: WatchImages, cache, params):
+        """
+        Take the results of the finished jobs of a watch, storing them in the result cache and the watch state.
+
+        @param images: the images of the watch
+        @param cache: ResultCache, or None
+        @param params: the cache parameters of the watch
+        @return generator of lists of EstimateRecord, one list per image
+        """
+        while not images.done.empty():
+            path, result = images.done.get()
+            if isinstance(result, Exception):
+                records = [EstimateRecord(path, None, None, f'Error: {result}')]
+            else:
+                records = self._job_result(result)
+            size, mtime = images.running.pop(path)
+            if cache is not None:
+                keys = cache.file_keys([path])
+                if path in keys:
+                    cache.put(keys[path], params, records)
+            yield self._as_results(records)
+            images.state.add(path, size, mtime)
+
+    def _watch_start(self, images: WatchImages, settle: float, cache, params, pool, overrides):
+        """
+        Start on the images of a watch that have settled, taking what it can from the result cache.
+
+        Without a pool, each image is estimated here and its result queued.
+        @param images: the images of the watch
+        @param settle: seconds an image must stay unchanged before it is estimated
+        @param cache: ResultCache, or None
+        @param params: the cache parameters of the watch
+        @param pool: the worker pool from _get_pool, or None
+        @param overrides: the parameters to send with each job, from _get_pool
+        @return generator of lists of EstimateRecord, one list per image found in the cache
+        """
+        for path, size, mtime in images.ready(settle):
+            records = None
+            if cache is not None and not self._writes_images():
+                keys = cache.file_keys([path])
+                records = cache.get(keys[path], params, path, self.record_type()) if path in keys else None
+            if records is not None:
+                yield self._as_results(records)
+                images.state.add(path, size, mtime)
+                continue
+            images.running[path] = (size, mtime)
+            if pool is None:
+                images.done.put((path, _call(self, '_estimate_image', path, ())))
+            else:
+                pool.apply_async(self._pool_function(), (('_estimate_image', path, (), overrides),),
+                                 callback=lambda result, path=path: images.done.put((path, result)),
+                                 error_callback=lambda error, path=path: images.done.put((path, error)))
+
+    def _watch_wait(self, images: WatchImages, inotify, interval: float, settle: float):
+        """
+        Wait for news of the images of a watch: briefly while jobs are out, until the next check while images settle.
+
+        @param images: the images of the watch
+        @param inotify: Inotify on the tree, or None to list it every interval seconds
+        @param interval: seconds between listings when polling
+        @param settle: seconds an image must stay unchanged before it is estimated
+        """
+        wait = 0.1 if images.running else max(0.05, min(interval, settle)) if images.pending else interval
+        if inotify is None:
+            time.sleep(wait)
+            if time.monotonic() - images.listed >= interval:
+                images.scan()
+            return
+        for path, is_dir in inotify.read(wait):
+            if path is None:
+                # the kernel dropped events
+                images.scan()
+            elif is_dir:
+                with contextlib.suppress(OSError):
+                    inotify.add(path)
+                images.scan(path)
+            elif os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+                with contextlib.suppress(OSError):
+                    stat = os.stat(path)
+                    images.found(os.path.abspath(path), (stat.st_size, stat.st_mtime))
+
+    def _iter_images(self, img: str, skip, method: str):
+        try:
+            if os.path.isfile(os.path.abspath(os.path.expanduser(img))):
+                yield from self._run_cached([img], method)
+            elif os.path.isdir(os.path.abspath(os.path.expanduser(img))):
+
+                if os.path.abspath(os.path.expanduser(img)) == self.output_dir:
+                    return
+
+                # obtain a list of images, including those in subdirectories, and process them with the worker pool
+                exclude = [self.output_dir, self.qa_dir]
+                if method == '_process_image':
+                    exclude.append(self.intermediate_dir)
+                images = self.shard_images(img) if self.shard else find_images(img, exclude=exclude)
+                if skip:
+                    skip = {os.path.abspath(os.path.expanduser(i)) for i in skip}
+                    images = [i for i in images if os.path.abspath(i) not in skip]
+                yield from self._run_cached(images, method)
+            else:
+                #raise ValueError('Your input {img} needs to be a path to an image or a directory.')
+                yield [EstimateRecord(img, None, None,
+                                      'Your input {img} needs to be a path to an image or a directory.')]
+        finally:
+            # what was tiled so far is kept, however the run ends
+            self.close_sheets()
+
+    def shard_images(self, img: str) -> list:
+        """
+        List the images of a planned directory that belong to the shard of this instance, as the manifest has them.
+
+        The directory is not listed again, so files added since it was planned are left to a later plan, and
+        removed ones come back as errors, which merge_results keeps.
+        @param img: the planned directory. respects tilde expansion
+        @return list of paths, below img as find_images lists them, largest first
+        @raise ValueError if there is no manifest, or it was planned for another number of shards
+        """
+        index, count = parse_shard(self.shard)
+        path = manifest_path(img, self.manifest)
+        if not os.path.isfile(path):
+            raise ValueError(f'There is no manifest at {path}. Plan the run first, with ALFA.py plan.')
+        entries = read_manifest(path)
+        planned = {entry.shard.partition('/')[2] for entry in entries}
+        if planned and planned != {str(count)}:
+            raise ValueError(f'{path} was planned for {", ".join(sorted(planned))} shards, not {count}.')
+        root = os.path.expanduser(img)
+        return [os.path.join(root, *entry.path.split('/')) for entry in entries if entry.shard == f'{index}/{count}']
+
+    def _estimate_image(self, img: str) -> list:
+        """
+        Estimate leaf area for a single image.
+
+        @param img: path to the scan. respects tilde expansion
+        @return list of EstimateRecord; a single one if combine is set or something went wrong
+        """
+        # resolve the resolution of this image; never stored on the instance, as images may differ
+        resolution, error = self.resolve_resolution(img)
+        _stage_times.get().mark('metadata')
+        if error:
+            return [EstimateRecord(img, None, None, error)]
+
+        # read the scan and transfer to grayscale; features and QA overlays need the colours too
+        if self.features or self.qa_dir:
+            image, error = self._decode(img)
+            scan = self._to_gray(image) if not error else None
+        else:
+            image = None
+            scan, error = self._read_gray(img)
+        if error:
+            return [EstimateRecord(img, None, None, error)]
+
+        return self._estimate_scan(img, scan, resolution, image)
+
+    def _process_image(self, img: str) -> list:
+        """
+        Pre-process a single image in memory and estimate its leaf area.
+
+        @param img: path to the scan. respects tilde expansion
+        @return list of EstimateRecord; a single one if combine is set or something went wrong
+        """
+        import cv2
+        times = _stage_times.get()
+        resolution, error = self.resolve_resolution(img)
+        times.mark('metadata')
+        if error:
+            return [EstimateRecord(img, None, None, error)]
+
+        if self.intermediate_dir or self.features or self.qa_dir:
+            # the pre-processed image is saved as preprocess would, and features and QA overlays take the colours of
+            # the leaves, so the scan has to be decoded in colour
+            if self.reduce not in (1, 2, 4, 8):
+                return [EstimateRecord(img, None, None, f'Unknown decode mode color with reduction {self.reduce}.')]
+            scan = cv2.imread(os.path.expanduser(img), getattr(cv2, REDUCTIONS['color', self.reduce]))
+            if scan is None:
+                return [EstimateRecord(img, None, None, 'Unable to open image for processing. Check the file format.')]
+            times.mark('decode', read=img, pixels=scan.shape[0] * scan.shape[1])
+        else:
+            scan, error = self._read_gray(img)
+            if error:
+                return [EstimateRecord(img, None, None, error)]
+
+        scan, error = self._apply_preprocess(scan, self.reduce)
+        times.mark('preprocess')
+        if error:
+            return [EstimateRecord(img, None, None, error)]
+
+        if self.intermediate_dir:
+            exif = read_exif_segment(img) if self.reduce == 1 else None
+            try:
+                self._save_image(img, scan, '.jpg', resolution / self.reduce, exif, directory=self.intermediate_dir)
+            except (OSError, ValueError):
+                return [EstimateRecord(img, None, None, 'Error: Unable to write processed image.')]
+
+        image = None
+        if scan.ndim == 3:
+            image = scan if self.features or self.qa_dir else None
+            scan = self._to_gray(scan)
+
+        return self._estimate_scan(img, scan, resolution, image)
+
+    def _estimate_scan(self, img: str, scan, resolution: float, image=None) -> list:
         """
-        Initiate (default) variables.
-        @param red_scale: whether or not to add a red scale
-        @param red_scale_pixels: how many pixels wide the side of the scale should be
-        @param mask_offset_x: offset for the masking window in number of pixels from top to bottom of the image
-        @param mask_offset_y: offset for the masking window in number of pixels from right to left of the image
-        @param mask_pixels: how many pixels each side of the masking window should be
-        @param threshold: value for contrast analysis
-        @param cut_off: patches below this number of pixels will not be counted
-        @param output_dir: where to save the images
-        @param crop: remove the edges of the image
-        @param combine: combine all patches into a single LA estimate T/F
-        @param res: specify resolution manually
-        @param workers: how many cores to use for multiprocessing; def: all but one
+        Estimate leaf area in a decoded grayscale scan.
+
+        @param img: path the scan was read from, to name the results and the saved image
+        @param scan: the grayscale scan, decoded as set by reduce
+        @param resolution: resolution of the scan before any reduction, in DPI
+        @param image: the colour scan the grayscale one was converted from, for the colours of the leaves when
+                      features are on and for QA overlays; def: the grayscale scan
+        @return list of EstimateRecord; a single one if combine is set or something went wrong. LeafRecords, one
+                per leaf, if features are on, and AutoThresholdRecords with auto_threshold
         """
-        self.red_scale = red_scale
-        self.red_scale_pixels = red_scale_pixels
-        self.mask_pixels = mask_pixels
-        self.mask_offset_y = mask_offset_y
-        self.mask_offset_x = mask_offset_x
-        self.threshold = threshold
-        self.cut_off = cut_off
-        self.output_dir = output_dir
-        self.crop = crop
-        self.combine = combine
-        self.res = res
-        self.workers = workers
+        import cv2
+        times = _stage_times.get()
+        # classify leaf and background
+        error = self._parameter_error()
+        if error:
+            return [EstimateRecord(img, None, None, error)]
+        threshold = self._scan_threshold(scan)
+
+        if self.tile_mb and not self._writes_images() and not self.features:
+            # threshold and label in strips; the binary image is never held in full.
+            # a strip costs about 10 bytes per pixel: binary, labels and the labeller's working memory
+            tile_rows = self.tile_mb * 1024 * 1024 / (scan.shape[1] * 10)
+            sizes = tiled_component_areas(scan, threshold, tile_rows, self.labeller)
+            del scan
+            times.mark('label')
+        else:
+            binary = cv2.threshold(scan, threshold, 255, cv2.THRESH_BINARY_INV)[1]
+            times.mark('threshold')
+
+            # label leaflets and count the pixels in each of them, in one pass
+            components = label_components(binary, self.labeller)
+            sizes = components.areas
+            times.mark('label')
+
+        # save image
+        if self.output_dir:
+            if os.path.isdir(self.output_dir):
+                #If we are supplying the resolution, we don't don't touch the exif data.
+                #A reduced decode is saved at its own resolution, which the source EXIF would contradict
+                exif = None
+                if not self.res and self.reduce == 1:
+                    exif = read_exif_segment(img)
+                try:
+                    self._save_image(img, binary, os.path.splitext(img)[1], resolution / self.reduce, exif,
+                                     bilevel=True)
+                except (OSError, ValueError):
+                    return [EstimateRecord(img, None, None, 'Error: Unable to write thresholded image.')]
+
+        overlays = _qa_overlays.get()
+        if overlays is not None:
+            import numpy as np
+            keep = np.flatnonzero(sizes * (self.reduce * self.reduce) >= self.cut_off)
+            res = resolution / self.reduce / 2.54
+            overlays.append((img, qa_overlay(image if image is not None else scan, components, keep,
+                                             sizes[keep] / (res * res), self.qa_size)))
+            times.mark('qa')
+
+        if self.features:
+            return self._leaf_records(img, components, image if image is not None else scan, resolution, threshold)
+        return self._area_records(img, sizes, resolution, threshold)
+
+    def _scan_threshold(self, scan) -> int:
+        """The threshold of a grayscale scan: chosen from its histogram with auto_threshold, else threshold."""
+        if not self.auto_threshold:
+            return self.threshold
+        threshold = histogram_threshold(gray_histogram(scan), self.auto_threshold)
+        _stage_times.get().mark('histogram')
+        return self.threshold if threshold is None else threshold
+
+    def _parameter_error(self):
+        """Check the parameters of thresholding and labelling; return an error message if they are invalid."""
+        if self.threshold < 0 or self.threshold > 255:
+            #raise ValueError("Threshold must be an integer between 0 and 255.")
+            return 'Error: Threshold must be an integer between 0 and 255.'
+
+        if self.cut_off < 0:
+            #raise ValueError("cutoff for small specks must not be negative.")
+            return 'cutoff for small specks must not be negative.'
+
+        if self.labeller not in LABELLERS:
+            return f'Unknown labeller {self.labeller}.'
+
+        if self.auto_threshold and self.auto_threshold not in THRESHOLD_METHODS:
+            return f'Unknown threshold method {self.auto_threshold}.'
+        return None
 
-    def estimate(self, img: str) -> DataFrame:
+    def _area_records(self, img: str, sizes, resolution: float, threshold: int = None) -> list:
         """
-        Estimate leaf area for a given image or directory of images.
+        Turn the pixel counts of the components of a scan into leaf areas.
+
+        @param img: path of the scan, to name the records
+        @param sizes: number of pixels in each component, in raster order
+        @param resolution: resolution of the scan before any reduction, in DPI
+        @param threshold: the threshold the scan was thresholded at, recorded with auto_threshold
+        @return list of EstimateRecord, or AutoThresholdRecord with auto_threshold; a single one if combine is set
+                or there are no leaves
+        """
+        # remove small patches; the background is not among the components.
+        # a pixel of a reduced decode stands for reduce x reduce pixels of the scan
+        areas = sizes[sizes * (self.reduce * self.reduce) >= self.cut_off]
+
+        # convert from pixels to cm2
+        res = resolution / self.reduce / 2.54  # 2.54 cm in an inch
+        res = res * res  # pixels per cm^2
+        areas = areas / res
+
+        if self.auto_threshold:
+            extra = (threshold,)
+            record_type = AutoThresholdRecord
+        else:
+            extra = ()
+            record_type = EstimateRecord
+        if self.combine:
+            records = [record_type(img, float(areas.sum()), resolution, 'No Error', *extra)]
+        else:
+            # an image without leaves still gets a row, of no area, so that it is seen to be done
+            records = [record_type(img, float(area), resolution, 'No Error', *extra) for area in areas] or \
+                [record_type(img, 0.0, resolution, 'No Error', *extra)]
+        _stage_times.get().mark('count')
+        return records
+
+    def _leaf_records(self, img: str, components: Components, image, resolution: float, threshold: int) -> list:
+        """
+        Measure the leaves of a scan, dropping small patches as _area_records does.
+
+        @param img: path of the scan, to name the records
+        @param components: Components of the thresholded scan
+        @param image: the scan in colour, or in grayscale if decoded so
+        @param resolution: resolution of the scan before any reduction, in DPI
+        @param threshold: the threshold the scan was thresholded at
+        @return list of LeafRecord, one per leaf, in raster order; a single one of no area if there are no leaves
+        """
+        import numpy as np
+        keep = np.flatnonzero(components.areas * (self.reduce * self.reduce) >= self.cut_off)
+        if not len(keep):
+            # a single row of no area and no features, as _area_records gives
+            return [LeafRecord(img, 0.0, resolution, 'No Error', Threshold=int(threshold))]
+        features = component_features(components, keep, image)
+        _stage_times.get().mark('features')
+
+        # pixels of a reduced decode to pixels of the scan, and to cm
+        scale = self.reduce
+        res = resolution / self.reduce / 2.54
+        bboxes = components.bboxes[keep] * scale
+        # centroids are those of the reduced pixels' centres; shift them to the scan's
+        centroids = (components.centroids[keep] + 0.5) * scale - 0.5
+        blue, green, red = features['color'].T
+        total = blue + green + red
+        greenness = np.divide(green, total, out=np.zeros_like(green), where=total > 0)
+        columns = zip(components.areas[keep] / (res * res), centroids[:, 0], centroids[:, 1], *bboxes.T,
+                      features['perimeter'] / res, features['convex_area'] / (res * res), blue, green, red, greenness)
+        return [LeafRecord(img, float(area), resolution, 'No Error', float(x), float(y), int(left), int(top),
+                           int(width), int(height), float(perimeter), float(convex), float(b), float(g), float(r),
+                           float(gi), int(threshold))
+                for area, x, y, left, top, width, height, perimeter, convex, b, g, r, gi in columns]
+
+    def _estimate_batch(self, images: tuple) -> list:
+        """
+        Estimate leaf area for a batch of small images, thresholding and labelling those of the same width together.
+
+        Images of more than batch_mpx megapixels once decoded are estimated on their own.
+        @param images: paths to the images
+        @return list of lists of EstimateRecord, one list per image, in the order given
+        """
+        error = self._parameter_error()
+        if error:
+            return [[EstimateRecord(img, None, None, error)] for img in images]
+
+        times = _stage_times.get()
+        limit = self.batch_mpx * 1e6 / (self.reduce * self.reduce)
+        results = {}
+        # decoded images waiting to be stacked, by width
+        waiting = {}
+        pixels = 0
+        for img in images:
+            resolution, error = self.resolve_resolution(img)
+            times.mark('metadata')
+            if not error:
+                scan, error = self._read_gray(img)
+            if error:
+                results[img] = [EstimateRecord(img, None, None, error)]
+            elif scan.size > limit:
+                results[img] = self._estimate_scan(img, scan, resolution)
+            else:
+                waiting.setdefault(scan.shape[1], []).append((img, scan, resolution))
+                pixels += scan.size
+                if pixels > BATCH_MPX * 1e6:
+                    for group in waiting.values():
+                        results.update(self._estimate_stack(group))
+                    waiting, pixels = {}, 0
+        for group in waiting.values():
+            results.update(self._estimate_stack(group))
+        return [results[img] for img in images]
+
+    def _estimate_stack(self, group: list) -> dict:
+        """
+        Threshold and label grayscale images of the same width as one.
+
+        The images are stacked one above the other, each followed by a row of background, so that a single call to
+        threshold and a single call to label serve them all. No component can cross a background row, and
+        components are labelled in raster order, so each image gets the areas, in the order, it would on its own.
+        @param group: list of tuples of the path, the grayscale image and the resolution
+        @return dict of path to list of EstimateRecord
+        """
+        import numpy as np
+        import cv2
+        heights = [scan.shape[0] + 1 for _, scan, _ in group]
+        offsets = np.cumsum([0] + heights)
+        thresholds = [self._scan_threshold(scan) for _, scan, _ in group]
+        times = _stage_times.get()
+        stack = np.empty((offsets[-1], group[0][1].shape[1]), dtype=np.uint8)
+        if self.auto_threshold:
+            # every image has a threshold of its own, so each is thresholded as it is stacked
+            for (_, scan, _), top, threshold in zip(group, offsets, thresholds):
+                stack[top:top + scan.shape[0]] = cv2.threshold(scan, threshold, 255, cv2.THRESH_BINARY_INV)[1]
+            binary = stack
+        else:
+            for (_, scan, _), top in zip(group, offsets):
+                stack[top:top + scan.shape[0]] = scan
+            times.mark('stack')
+            binary = cv2.threshold(stack, self.threshold, 255, cv2.THRESH_BINARY_INV)[1]
+        del stack
+        binary[offsets[1:] - 1] = 0
+        times.mark('threshold')
+        components = label_components(binary, self.labeller)
+        del binary
+        times.mark('label')
+
+        # the image each component lies in, from the top of its bounding box; the components of each image are
+        # consecutive
+        owner = np.searchsorted(offsets, components.bboxes[:, 1], side='right') - 1
+        bounds = np.searchsorted(owner, np.arange(len(group) + 1))
+        return {img: self._area_records(img, components.areas[bounds[i]:bounds[i + 1]], resolution, thresholds[i])
+                for i, (img, _, resolution) in enumerate(group)}
 
-        TO DO: filter images only in the folder - ask the user for extension?
+    def _save_image(self, img: str, image, ext: str, res: float = None, exif: bytes = None, bilevel: bool = False,
+                    directory: str = None):
+        """
+        Save a processed version of an image in output_dir, encoded in memory and written once.
+
+        @param img: path to the source image; the saved image takes its name
+        @param image: the processed image
+        @param ext: extension to save with unless output_format is set
+        @param res: resolution to record in the saved image, in DPI
+        @param exif: EXIF segment of the source, to carry over
+        @param bilevel: the image holds nothing but 0 and 255
+        @param directory: where to save it instead of output_dir
+        @return path of the saved image
+        @raise OSError if the image cannot be written, ValueError if it cannot be encoded
+        """
+        if self.output_format:
+            ext = OUTPUT_FORMATS[self.output_format]
+        name = os.path.splitext(os.path.basename(os.path.abspath(os.path.expanduser(img))))[0] + ext
+        path = os.path.join(os.path.abspath(os.path.expanduser(directory or self.output_dir)), name)
+        data = encode_image(image, ext, res, exif, self.output_quality, self.output_compression, bilevel)
+        write_atomic(path, data)
+        _stage_times.get().mark('write', written=len(data))
+        return path
+
+    def estimate_sweep(self, img: str, thresholds, cut_offs) -> 'DataFrame':
+        """
+        Estimate leaf area for every combination of threshold and cut_off, e.g. to calibrate a new scanner.
 
+        Each image is decoded and converted to grayscale once and labelled once per distinct threshold; every
+        cut_off is then applied to the same component sizes.
         @param img: path to the scan or images folder. respects tilde expansion
-        @return pandas DF with the file name of the input and the estimated area(s)
+        @param thresholds: values between 0 (black) and 255 (white) for classification of background and leaf pixels
+        @param cut_offs: numbers of pixels below which patches are not counted
+        @return pandas DF in long format, with one row per image, threshold and cut_off (and leaf, unless combined)
+        """
+        return records_to_frame(self.iter_sweep(img, thresholds, cut_offs), SWEEP_COLUMNS)
+
+    def iter_sweep(self, img: str, thresholds, cut_offs):
         """
+        As estimate_sweep, yielding the results of each image as it is done.
 
+        @return generator of lists of SweepRecord, one list per image, in order of completion
+        """
+        thresholds, cut_offs = tuple(thresholds), tuple(cut_offs)
         if os.path.isfile(os.path.abspath(os.path.expanduser(img))):
-            # read the image resolution
-            if not self.res:
-                with open(os.path.expanduser(img), 'rb') as image_meta:
-                    try:
-                        metadata = ef.Image(image_meta)
-                    except:
-                        return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'Unable to access EXIF Data for image.'})
-
-                if (not metadata.has_exif) or not(hasattr(metadata, 'x_resolution') or hasattr(metadata, 'Xresolution')):
-                    #raise ValueError("Image of unknown resolution. Please specify the res argument in dpi.")
-                    return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'Image of unknown resolution. Please specify the res argument in dpi.'})
-                
-                if hasattr(metadata, 'x_resolution'):
-                    if not metadata.x_resolution == metadata.y_resolution:
-                        #raise ValueError( "X and Y resolutions differ in Image. This is unusual, and may indicate a problem.")
-                        return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'X and Y resolutions differ in Image. This is unusual, and may indicate a problem.'})
-                    else:
-                        self.res = metadata.x_resolution
-                elif hasattr(metadata, 'Xresolution'):
-                    if not metadata.Xresolution == metadata.Yresolution:
-                        #raise ValueError( "X and Y resolutions differ in Image. This is unusual, and may indicate a problem.")
-                        return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'X and Y resolutions differ in Image. This is unusual, and may indicate a problem.'})
-                    else:
-                        self.res = metadata.Xresolution
+            yield from self._run('_sweep_image', [img], thresholds, cut_offs)
+        elif os.path.isdir(os.path.abspath(os.path.expanduser(img))):
+            if os.path.abspath(os.path.expanduser(img)) == self.output_dir:
+                return
+            yield from self._run('_sweep_image', find_images(img, exclude=self.output_dir), thresholds, cut_offs)
+        else:
+            yield [SweepRecord(img, None, None, None, None, 'Your input {img} needs to be a path to an image or a directory.')]
+
+    def _sweep_image(self, img: str, thresholds: tuple, cut_offs: tuple) -> list:
+        """
+        Estimate leaf area for a single image for every combination of threshold and cut_off.
+
+        @return list of SweepRecord, ordered by threshold, then cut_off, as given
+        """
+        import numpy as np
+        import cv2
+        def failed(error):
+            return [SweepRecord(img, None, None, None, None, error)]
+
+        if not thresholds or not cut_offs:
+            return failed('At least one threshold and one cut_off are needed.')
+        if min(thresholds) < 0 or max(thresholds) > 255:
+            return failed('Error: Threshold must be an integer between 0 and 255.')
+        if min(cut_offs) < 0:
+            return failed('cutoff for small specks must not be negative.')
+        if self.labeller not in LABELLERS:
+            return failed(f'Unknown labeller {self.labeller}.')
+
+        times = _stage_times.get()
+        res, error = self.resolve_resolution(img)
+        times.mark('metadata')
+        if error:
+            return failed(error)
+
+        # decode once
+        scan, error = self._read_gray(img)
+        if error:
+            return failed(error)
 
+        # pixels at or below the threshold are leaf, so two thresholds give the same binary image
+        # unless some pixels have a value above the lower one and at or below the higher one
+        histogram = np.cumsum(cv2.calcHist([scan], [0], None, [256], [0, 256]).ravel())
+
+        sizes = {}
+        previous = None
+        for threshold in sorted(set(thresholds)):
+            if previous is not None and histogram[threshold] == histogram[previous]:
+                sizes[threshold] = sizes[previous]
+            else:
+                binary = cv2.threshold(scan, threshold, 255, cv2.THRESH_BINARY_INV)[1]
+                sizes[threshold] = label_components(binary, self.labeller).areas
+                del binary
+            previous = threshold
+        times.mark('label')
+
+        pixels_per_cm2 = (res / self.reduce / 2.54) * (res / self.reduce / 2.54)
+        cut_off_array = np.asarray(cut_offs) / (self.reduce * self.reduce)
+        records = []
+        for threshold in thresholds:
+            # one row per cut_off, one column per component
+            areas = sizes[threshold] / pixels_per_cm2
+            keep = sizes[threshold][None, :] >= cut_off_array[:, None]
+            for cut_off, kept in zip(cut_offs, keep):
+                if self.combine:
+                    records.append(SweepRecord(img, threshold, cut_off, float(areas[kept].sum()), res, 'No Error'))
                 else:
-                    if not metadata.XResolution == metadata.YResolution:
-                        #raise ValueError( "X and Y resolutions differ in Image. This is unusual, and may indicate a problem.")
-                        return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'X and Y resolutions differ in Image. This is unusual, and may indicate a problem.'})
-                    else:
-                        self.res = metadata.XResolution
+                    records.extend(SweepRecord(img, threshold, cut_off, float(area), res, 'No Error')
+                                   for area in areas[kept])
+        times.mark('count')
+        return records
 
-            # read the scan
-            try:
-                scan = cv2.imread(os.path.expanduser(img))
-            except:
-                return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'Unable to open image for processing. Check the file format.'})
-        
-            if scan is None:
-                return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'Unable to open image for processing. Check the file format.'})
+    def resolve_resolution(self, img: str):
+        """
+        Resolution of an image: the explicit res if given, else the one in its header, else the default for its
+        directory.
 
-            # transfer to grayscale
-            scan = cv2.cvtColor(scan, cv2.COLOR_BGR2GRAY)
+        Headers are read through the metadata index, so each file is parsed at most once while it is unchanged.
+        @param img: path to the image. respects tilde expansion
+        @return tuple of the resolution in DPI and None, or of None and an error message
+        """
+        if self.res:
+            return self.res, None
+        res, error = self._read_resolution(img)
+        if error and error.startswith('Image of unknown resolution'):
+            default = self.default_resolution(img)
+            if default:
+                return default, None
+        return res, error
+
+    def default_resolution(self, img: str):
+        """
+        Default resolution of an image, from default_res.
+
+        @param img: path to the image. respects tilde expansion
+        @return the resolution in DPI of the closest directory above the image with a default, or 0 if there is none
+        """
+        if not isinstance(self.default_res, dict):
+            return self.default_res
+        defaults = {os.path.abspath(os.path.expanduser(d)): res for d, res in self.default_res.items() if d}
+        directory = os.path.dirname(os.path.abspath(os.path.expanduser(img)))
+        while True:
+            if directory in defaults:
+                return defaults[directory]
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return self.default_res.get('', 0)
+            directory = parent
 
-            # classify leaf and background
-            if self.threshold < 0 or self.threshold > 255:
-                #raise ValueError("Threshold must be an integer between 0 and 255.")
-                return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'Error: Threshold must be an integer between 0 and 255.'})
+    def _read_resolution(self, img: str):
+        """
+        Read the resolution of an image from its EXIF tags or, failing those, its JFIF density.
 
-            scan = cv2.threshold(scan, self.threshold, 255, cv2.THRESH_BINARY_INV)[1]
+        @param img: path to the image. respects tilde expansion
+        @return tuple of the resolution in DPI and None, or of None and an error message
+        """
+        try:
+            metadata = self.metadata.get(img)
+        except OSError:
+            return None, 'Unable to access EXIF Data for image.'
 
-            # label leaflets
-            leaflets = measure.label(scan, background=0)
+        if not metadata.x_resolution:
+            #raise ValueError("Image of unknown resolution. Please specify the res argument in dpi.")
+            return None, 'Image of unknown resolution. Please specify the res argument in dpi.'
 
-            # count number of pixels in each label
-            leaflets = np.unique(leaflets, return_counts=True)
+        if metadata.y_resolution and metadata.x_resolution != metadata.y_resolution:
+            #raise ValueError( "X and Y resolutions differ in Image. This is unusual, and may indicate a problem.")
+            return None, 'X and Y resolutions differ in Image. This is unusual, and may indicate a problem.'
 
-            # create mask to remove dirt and background
-            mask = np.ones(len(leaflets[1]), dtype=bool)
+        return metadata.x_resolution, None
 
-            # remove small patches
-            if self.cut_off < 0:
-                #raise ValueError("cutoff for small specks must not be negative.")
-                return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'cutoff for small specks must not be negative.'})
-            
-            mask[leaflets[1] < self.cut_off] = False
+    def _read_gray(self, img: str):
+        """
+        Read an image and convert it to grayscale, as set by decode and reduce. Uncompressed TIFFs at full resolution
+        are mapped from the file rather than decoded (see read_tiff_gray).
 
-            # remove background pixels
-            mask[leaflets[0] == 0] = False  # background is labeled as 0
+        @param img: path to the image. respects tilde expansion
+        @return tuple of the grayscale image and None, or of None and an error message
+        """
+        if (self.decode, self.reduce) not in REDUCTIONS:
+            return None, f'Unknown decode mode {self.decode} with reduction {self.reduce}.'
 
-            # apply mask
-            areas = leaflets[1][mask]
+        # uncompressed TIFFs are mapped from the file, using the header already read for their resolution
+        if self.reduce == 1 and os.path.splitext(img)[1].lower() in ('.tif', '.tiff'):
+            try:
+                metadata = self.metadata.get(img)
+                if metadata.strips is not None:
+                    scan = read_tiff_gray(img, metadata)
+                    _stage_times.get().mark('decode', read=img, pixels=scan.shape[0] * scan.shape[1])
+                    return scan, None
+            except (OSError, ValueError):
+                pass
 
-            # convert from pixels to cm2
-            res = self.res / 2.54  # 2.54 cm in an inch
-            res = res * res  # pixels per cm^2
-            areas = areas / res
+        scan, error = self._decode(img)
+        if error:
+            return None, error
+        return self._to_gray(scan), None
 
-            # save image
-            if self.output_dir:
-                if os.path.isdir(self.output_dir):
-                    write_to = os.path.join(os.path.expanduser(self.output_dir), os.path.basename(img))
-                    cv2.imwrite(write_to, scan)
-                    if not self.res:
-                        #If we are supplying the resolution, we don't don't touch the exif data
-                        piexif.transplant(os.path.abspath(os.path.expanduser(img)), write_to)
+    def _decode(self, img: str):
+        """
+        Decode an image as set by decode and reduce: in BGR colour or straight to grayscale.
 
-            if self.combine:
-                return pd.DataFrame(data={'filename': [img], 'Area': [areas.sum()], 'Resolution': self.res, 'Error' : 'No Error'})
-            else:
-                return pd.DataFrame(data={'filename': [img] * areas.shape[0], 'Area': areas, 'Resolution': self.res, 'Error' : 'No Error'})
-        elif os.path.isdir(os.path.abspath(os.path.expanduser(img))):
-            
-            if os.path.abspath(os.path.expanduser(img)) == self.output_dir:
-                return None
-            
-            # obtain a list of images
-            images = os.listdir(os.path.abspath(os.path.expanduser(img)))
-            images = [os.path.join(img, i) for i in images]
-            # print(self.workers)
-            # create a workers pool and start processing
-            pool = multiprocessing.Pool(self.workers)
-            results = pool.map(self.estimate, images)
-            pool.close()
-            pool.join()
-
-            # unify the results into a single dataframe
-            return pd.concat(results)
-        else:
-            #raise ValueError('Your input {img} needs to be a path to an image or a directory.')
-            return pd.DataFrame(data={'filename': [img], 'Area': None, 'Resolution': None, 'Error' : 'Your input {img} needs to be a path to an image or a directory.'})
+        @param img: path to the image. respects tilde expansion
+        @return tuple of the image and None, or of None and an error message
+        """
+        import cv2
+        if (self.decode, self.reduce) not in REDUCTIONS:
+            return None, f'Unknown decode mode {self.decode} with reduction {self.reduce}.'
+
+        try:
+            scan = cv2.imread(os.path.expanduser(img), getattr(cv2, REDUCTIONS[self.decode, self.reduce]))
+        except:
+            return None, 'Unable to open image for processing. Check the file format.'
+    
+        if scan is None:
+            return None, 'Unable to open image for processing. Check the file format.'
+        _stage_times.get().mark('decode', read=img, pixels=scan.shape[0] * scan.shape[1])
+        return scan, None
+
+    @staticmethod
+    def _to_gray(scan):
+        """Transfer a decoded scan to grayscale, unless it already is."""
+        import cv2
+        if scan.ndim == 3:
+            scan = cv2.cvtColor(scan, cv2.COLOR_BGR2GRAY)
+            _stage_times.get().mark('grayscale')
+        return scan
 
-    def preprocess(self, img):
+    def preprocess(self, img: str) -> 'DataFrame':
         """
         Pre-processes an image by cropping its edges, adding a red scale, masking existing scales and converting to jpg.
 
         @param img: path to the image or folder of images to process
-        @return None
+        @return pandas DF with the file name of each input and the outcome of pre-processing it
         """
-        if os.path.isfile(os.path.abspath(os.path.expanduser(img))):
-            #if not self.output_dir:
-            #    output_dir = f'{os.path.split(os.path.isfile(os.path.abspath(os.path.expanduser(img))))[0]}/preprocessed'
-            #    os.makedirs(output_dir)
-
-            if os.path.split(os.path.abspath(os.path.expanduser(img)))[0] == self.output_dir:
-                #raise ValueError(
-                #    'You have provided identical paths for the source and destination images.' +
-                #    'This would cause your file to be overwritten. Execution has been halted.')
-                return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: You have provided identical paths for the source and destination image.'})
-            # read the image
-            try:
-                scan = cv2.imread(os.path.abspath(os.path.expanduser(img)))
-            except:
-                return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: Unable to open source file.'})
-
-            #Check for error state
-            if scan is None:
-                return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: Unable to open source file.'})
-
-
-            dims = scan.shape
-
-            # crop the edges
-            if self.crop:
-                if self.crop < 0:
-                    #print(f'You have attempted to crop a negative number of pixels.')
-                    #raise ValueError('You have attempted to crop a negative number of pixels.')
-                    return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: You have attempted to crop a negative number of pixels.'})
-                if self.crop > dims[0] or self.crop > dims[1]:
-                    #raise ValueError('You have attempted to crop away more pixels than are available in the image.')
-                    return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: You have attempted to crop away more pixels than are available in the image.'})
-                scan = scan[self.crop:dims[0] - self.crop, self.crop:dims[1] - self.crop]
-
-            # mask scale
-            if self.mask_pixels:
-                if self.mask_offset_y < 0 or self.mask_offset_x < 0 or self.mask_pixels < 0:
-                    #raise ValueError("You have attempted to mask a negative number of pixels.")
-                    return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: You have attempted to mask a negative number of pixels.'})
-
-                if self.mask_offset_y + self.mask_pixels > dims[0] or self.mask_offset_x + self.mask_pixels > dims[1]:
-                    #raise ValueError("You have attempted to mask more pixels than are available in the image.")
-                    return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: You have attempted to mask more pixels than are available in the image.'})
-
-                scan[self.mask_offset_y:self.mask_offset_y + self.mask_pixels,
-                     self.mask_offset_x:self.mask_offset_x + self.mask_pixels,
-                     0] = 255  # b channel
-                scan[self.mask_offset_y:self.mask_offset_y + self.mask_pixels,
-                     self.mask_offset_x:self.mask_offset_x + self.mask_pixels,
-                     1] = 255  # g channel
-                scan[self.mask_offset_y:self.mask_offset_y + self.mask_pixels,
-                     self.mask_offset_x:self.mask_offset_x + self.mask_pixels,
-                     2] = 255  # r channel
-
-            # add scale
-            if self.red_scale:
-                if self.red_scale_pixels > dims[0] or self.red_scale_pixels > dims[1]:
-                    #raise ValueError("You have attempted to place a scale bar beyond the margins of the image.")
-                    return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: You have attempted to place a scale bar beyond the margins of the image.'})
-                scan[0:self.red_scale_pixels, 0:self.red_scale_pixels, 0] = 0  # b channel
-                scan[0:self.red_scale_pixels, 0:self.red_scale_pixels, 1] = 0  # g channel
-                scan[0:self.red_scale_pixels, 0:self.red_scale_pixels, 2] = 255  # red channel
-
-            # file name
-            file_name = os.path.basename(os.path.abspath(os.path.expanduser(img)))
-            file_name = f'{os.path.splitext(file_name)[0]}.jpg'
-            file_name = os.path.join(os.path.abspath(os.path.expanduser(self.output_dir)), file_name)
-
-            # save as jpg
-            try:
-                metadata = ef.Image(os.path.abspath(os.path.expanduser(img)))
-            except:
-                #Image write failure
-                cv2.imwrite(file_name, scan)
-                return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: EXIF data could not be loaded from source image.'})
-
-            #Create the processed image (even if EXIF data isn't viable)
-            cv2.imwrite(file_name, scan)
-            
-            #if (not metadata.has_exif) or not(hasattr(metadata, 'x_resolution') or hasattr(metadata, 'Xresolution')):
-
-            if (not metadata.has_exif) or not(hasattr(metadata, 'x_resolution') or hasattr(metadata, 'Xresolution')):
-                # EXIF has no resolution data present
-                return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: EXIF Resolution Data Not transferred to Pre-processed image.'})
-            else:
-                try:
-                    piexif.transplant(os.path.abspath(os.path.expanduser(img)), file_name)
-                except:
-                    #Return a data frame to the caller to indicate success 
-                    return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Error: Unable to copy EXIF data to processed image.'})
+        return records_to_frame(self.iter_preprocess(img), PREPROCESS_COLUMNS)
 
-                #Return a data frame to the caller to indicate success 
-                return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'No Error'})
-                
+    def iter_preprocess(self, img: str):
+        """
+        Pre-process an image or folder of images, yielding the outcome for each image as it is done.
 
+        @param img: path to the image or folder of images to process
+        @return generator of lists of PreprocessRecord, one list per image, in order of completion
+        """
+        if os.path.isfile(os.path.abspath(os.path.expanduser(img))):
+            yield from self._run('_preprocess_image', [img])
         elif os.path.isdir(os.path.abspath(os.path.expanduser(img))):
-            
-            if os.path.abspath(os.path.expanduser(img)) == self.output_dir:
-                return None
-            
-            images = os.listdir(os.path.abspath(os.path.expanduser(img)))
-            images = [os.path.join(os.path.abspath(os.path.expanduser(img)), i) for i in images]
 
-            # create a workers pool and start processing
-            pool = multiprocessing.Pool(self.workers)
-            results = pool.map(self.preprocess, images)
-            pool.close()
-            pool.join()
+            if os.path.abspath(os.path.expanduser(img)) == self.output_dir:
+                return
 
-            return pd.concat(results)
+            images = self.shard_images(os.path.abspath(os.path.expanduser(img))) if self.shard else \
+                find_images(os.path.abspath(os.path.expanduser(img)), exclude=self.output_dir)
+            yield from self._run('_preprocess_image', images)
         else:
-            #os.rmdir(output_dir)
-            return pd.DataFrame(data={'filename': [img], 'Pre-process Result' : 'Unable to open file or directory.'})
             #raise ValueError(f'Your input {img} needs to be either a file or a directory')
-    
-    
-    def resolution_sort_image_files(self,the_dir='./'):
-        if os.path.isdir(os.path.abspath(os.path.expanduser(the_dir))):
-            the_dir = os.path.expanduser(the_dir)
-            file_list = [f for f in listdir(the_dir) if isfile(join(the_dir, f))]
-            for current_file in file_list:
-                current_file_path = os.path.abspath(os.path.join(the_dir,current_file))
-                if os.path.isfile(current_file_path):
-                    with open(current_file_path, 'rb') as image_meta:
-                        # Sort by resolution
-                        # Check if we are working with an image file with exif information
-                        try: 
-                            metadata = ef.Image(image_meta)
-                            if  metadata.has_exif:
-                                #EXIF Resolution variants
-                                if hasattr(metadata, 'x_resolution'): 
-                                    dir_name = 'resolution_'+str(round(metadata.x_resolution))
-                                elif hasattr(metadata, 'Xresolution'):
-                                    dir_name = 'resolution_'+str(round(metadata.Xresolution))
-                                else:
-                                    #EXIF with no recognised resolution attribute
-                                    dir_name = 'resolution_NA'
-                            else:
-                                #No reported EXIF on file
-                                dir_name = 'resolution_NA'         
-                        except:
-                            #Unaccessible EXIF or different file type
-                            dir_name = 'resolution_NA'
-
-                        dir_name = os.path.abspath(os.path.join(the_dir,dir_name))
-                        if not(os.path.exists(dir_name) & isdir(dir_name)):
-                            # Create the directory for the resolution
-                            os.mkdir(dir_name)
-                            
-                        # Move the image to the directory 
-                        new_file_path = os.path.abspath(dir_name+'/'+current_file)
-                        image_meta.close()
-                        shutil.move(current_file_path, new_file_path)
+            yield [PreprocessRecord(img, 'Unable to open file or directory.')]
 
-        else:
+    def _preprocess_image(self, img: str) -> list:
+        """
+        Pre-process a single image and save the result in output_dir.
+
+        @param img: path to the image
+        @return list holding a single PreprocessRecord
+        """
+        import cv2
+        #if not self.output_dir:
+        #    output_dir = f'{os.path.split(os.path.isfile(os.path.abspath(os.path.expanduser(img))))[0]}/preprocessed'
+        #    os.makedirs(output_dir)
+
+        if os.path.split(os.path.abspath(os.path.expanduser(img)))[0] == self.output_dir:
+            #raise ValueError(
+            #    'You have provided identical paths for the source and destination images.' +
+            #    'This would cause your file to be overwritten. Execution has been halted.')
+            return [PreprocessRecord(img, 'Error: You have provided identical paths for the source and destination image.')]
+        # read the image
+        try:
+            scan = cv2.imread(os.path.abspath(os.path.expanduser(img)))
+        except:
+            return [PreprocessRecord(img, 'Error: Unable to open source file.')]
+
+        #Check for error state
+        if scan is None:
+            return [PreprocessRecord(img, 'Error: Unable to open source file.')]
+        times = _stage_times.get()
+        times.mark('decode', read=img, pixels=scan.shape[0] * scan.shape[1])
+
+        scan, error = self._apply_preprocess(scan)
+        times.mark('preprocess')
+        if error:
+            return [PreprocessRecord(img, error)]
+
+        # save as jpg, carrying the source resolution and EXIF in a single write
+        try:
+            metadata = self.metadata.get(img)
+            exif = read_exif_segment(img)
+        except OSError:
+            metadata, exif = None, None
+        times.mark('metadata')
+
+        #Create the processed image (even if EXIF data isn't viable)
+        try:
+            self._save_image(img, scan, '.jpg', metadata and metadata.x_resolution, exif)
+        except (OSError, ValueError):
+            return [PreprocessRecord(img, 'Error: Unable to write processed image.')]
+
+        if metadata is None:
+            return [PreprocessRecord(img, 'Error: EXIF data could not be loaded from source image.')]
+        if not metadata.x_resolution:
+            # EXIF has no resolution data present
+            return [PreprocessRecord(img, 'Error: EXIF Resolution Data Not transferred to Pre-processed image.')]
+
+        #Return a record to the caller to indicate the outcome
+        return [PreprocessRecord(img, 'No Error')]
+
+    def _apply_preprocess(self, scan, scale: int = 1):
+        """
+        Crop the edges of a scan, mask existing scales and add a red scale, as set up for preprocess.
+
+        @param scan: the scan, in colour or grayscale; it is modified in place
+        @param scale: the scan was decoded at 1/scale of its resolution, so the pixel counts are divided by it
+        @return tuple of the processed scan, a view of the input, and None, or of None and an error message
+        """
+        import numpy as np
+        import cv2
+        dims = scan.shape
+        crop, mask_pixels, mask_offset_y, mask_offset_x, red_scale_pixels = (
+            v // scale for v in (self.crop, self.mask_pixels, self.mask_offset_y, self.mask_offset_x,
+                                 self.red_scale_pixels))
+
+        # crop the edges
+        if self.crop:
+            if self.crop < 0:
+                #print(f'You have attempted to crop a negative number of pixels.')
+                #raise ValueError('You have attempted to crop a negative number of pixels.')
+                return None, 'Error: You have attempted to crop a negative number of pixels.'
+            if crop > dims[0] or crop > dims[1]:
+                #raise ValueError('You have attempted to crop away more pixels than are available in the image.')
+                return None, 'Error: You have attempted to crop away more pixels than are available in the image.'
+            scan = scan[crop:dims[0] - crop, crop:dims[1] - crop]
+
+        # mask scale
+        if self.mask_pixels:
+            if self.mask_offset_y < 0 or self.mask_offset_x < 0 or self.mask_pixels < 0:
+                #raise ValueError("You have attempted to mask a negative number of pixels.")
+                return None, 'Error: You have attempted to mask a negative number of pixels.'
+
+            if mask_offset_y + mask_pixels > dims[0] or mask_offset_x + mask_pixels > dims[1]:
+                #raise ValueError("You have attempted to mask more pixels than are available in the image.")
+                return None, 'Error: You have attempted to mask more pixels than are available in the image.'
+
+            # white in every channel
+            scan[mask_offset_y:mask_offset_y + mask_pixels, mask_offset_x:mask_offset_x + mask_pixels] = 255
+
+        # add scale
+        if self.red_scale:
+            if red_scale_pixels > dims[0] or red_scale_pixels > dims[1]:
+                #raise ValueError("You have attempted to place a scale bar beyond the margins of the image.")
+                return None, 'Error: You have attempted to place a scale bar beyond the margins of the image.'
+            red = np.array([[[0, 0, 255]]], dtype=np.uint8)  # b, g and r channels
+            if scan.ndim == 2:
+                red = cv2.cvtColor(red, cv2.COLOR_BGR2GRAY)
+            scan[0:red_scale_pixels, 0:red_scale_pixels] = red[0, 0]
+
+        return scan, None
+
+    def resolution_sort_image_files(self, the_dir='./', dry_run: bool = False, threads: int = 16) -> list:
+        """
+        Move the images of a directory into subdirectories by resolution, e.g. resolution_300, or resolution_NA for
+        files without one in their header. The headers are read by a pool of threads; see sort_files.
+
+        @param the_dir: the directory. respects tilde expansion
+        @param dry_run: only return the moves
+        @param threads: how many files to read and move at once
+        @return list of SortMove
+        """
+        if not os.path.isdir(os.path.abspath(os.path.expanduser(the_dir))):
             raise ValueError('Could not find directory to sort')
+        the_dir = os.path.abspath(os.path.expanduser(the_dir))
 
-    def num_file_sort_image_files(self,the_dir='./', num_img_per_dir = 2):
-        if os.path.isdir(os.path.abspath(os.path.expanduser(the_dir))):
-            the_dir = os.path.abspath(os.path.expanduser(the_dir))
-            file_list = [f for f in listdir(the_dir) if isfile(join(the_dir, f))]
-            cur_file_count = 0
-            dir_count = 1
-            new_dir_name = os.path.join(the_dir,'images_'+str(dir_count))
-            if len(file_list) > 0:
-                if not (os.path.exists(new_dir_name)):
-                    os.mkdir(new_dir_name)
-                    dir_count = dir_count + 1
-
-            for curent_file in file_list:
-                current_file_path = os.path.join(the_dir,curent_file)
-                if os.path.isfile(current_file_path):
-
-                    if cur_file_count >= num_img_per_dir:
-                        new_dir_name = os.path.join(the_dir,'images_'+str(dir_count))
-                        if not (os.path.exists(new_dir_name)):
-                            os.mkdir(new_dir_name)
-                        dir_count = dir_count + 1
-                        cur_file_count = 0
-
-                    new_file_path = os.path.join(new_dir_name,curent_file)
-                    shutil.move(current_file_path, new_file_path)
-                    cur_file_count = cur_file_count + 1
-        else:
+        def plan():
+            file_list = list_files(the_dir)
+            # read all the headers in one pass
+            index = MetadataIndex(threads).build([os.path.join(the_dir, f) for f in file_list])
+            moves = []
+            for current_file in file_list:
+                # Sort by resolution
+                try:
+                    metadata = index.get(os.path.join(the_dir, current_file), validate=False)
+                    if metadata.x_resolution:
+                        dir_name = 'resolution_'+str(round(metadata.x_resolution))
+                    else:
+                        #No resolution in the header
+                        dir_name = 'resolution_NA'
+                except OSError:
+                    #Unaccessible file
+                    dir_name = 'resolution_NA'
+                moves.append(SortMove(current_file, os.path.join(dir_name, current_file)))
+            return moves
+
+        return sort_files(the_dir, 'resolution_sort', plan, threads, dry_run)
+
+    def num_file_sort_image_files(self, the_dir='./', num_img_per_dir=2, dry_run: bool = False,
+                                  threads: int = 16) -> list:
+        """
+        Move the files of a directory, by name, into subdirectories images_1, images_2, ... of num_img_per_dir each.
+
+        @param the_dir: the directory. respects tilde expansion
+        @param num_img_per_dir: number of files per subdirectory
+        @param dry_run: only return the moves
+        @param threads: how many files to move at once
+        @return list of SortMove
+        """
+        if not os.path.isdir(os.path.abspath(os.path.expanduser(the_dir))):
             raise ValueError('Could not find Directory to sort')
+        the_dir = os.path.abspath(os.path.expanduser(the_dir))
+
+        def plan():
+            per_dir = max(1, num_img_per_dir)
+            return [SortMove(current_file, os.path.join('images_'+str(i // per_dir + 1), current_file))
+                    for i, current_file in enumerate(list_files(the_dir))]
+
+        return sort_files(the_dir, 'number_sort', plan, threads, dry_run)
+
+# requests the server runs: the ALFA method that runs them and the columns of its records
+SERVE_COMMANDS = {
+    'estimate': ('iter_estimate', ESTIMATE_COLUMNS),
+    'process': ('iter_process', ESTIMATE_COLUMNS),
+    'preprocess': ('iter_preprocess', PREPROCESS_COLUMNS),
+    'sweep': ('iter_sweep', SWEEP_COLUMNS),
+}
+
+
+class ALFAServer:
+    """
+    Run jobs for local clients, such as the R interface, over a socket, keeping the imports and the worker pool of a
+    single ALFA instance warm between them.
+
+    A client may send any number of requests over one connection, each a single line of JSON, e.g.
+    {"command": "estimate", "input": "~/scans", "options": {"threshold": 110, "combine": true}, "format": "csv"}.
+    options sets ALFA parameters for that request only, checked against the types and choices of the
+    matching command line arguments; sweep also takes "thresholds" and "cut_offs". Besides the
+    SERVE_COMMANDS, "ping" checks that the server is up and "shutdown" stops it.
+    Each reply is a line 'OK <n>' or 'ERROR <n>' followed by n bytes: the results as JSON, {"columns": [...],
+    "rows": [[...], ...]}, or as CSV in the layout printed by the command line (format "csv"), or an error message.
+    Jobs run one at a time.
+    """
+
+    def __init__(self, estimator, host: str = '127.0.0.1', port: int = 0, socket_path: str = None):
+        """
+        @param estimator: the ALFA instance to run the jobs with
+        @param host: address to listen on; keep it local, as there is no authentication
+        @param port: TCP port to listen on; def: any free port
+        @param socket_path: listen on this Unix socket instead of TCP
+        """
+        import socketserver
+        self.estimator = estimator
+        self.lock = threading.Lock()
+        # request options may set these, but nothing internal
+        self.options = {key for key in estimator.__dict__
+                        if not key.startswith('_') and key not in ('metadata', 'profiler')}
+        # the types and choices of the matching command line options, to check request options against
+        self.option_types = {key: option for key, option in build_parser().option_types.items()
+                             if key in self.options}
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    ok, payload = server.handle(line)
+                    self.wfile.write(f"{'OK' if ok else 'ERROR'} {len(payload)}\n".encode() + payload)
+                    self.wfile.flush()
+                    if payload == b'shutting down':
+                        threading.Thread(target=self.server.shutdown).start()
+                        return
+
+        if socket_path:
+            socket_path = os.path.abspath(os.path.expanduser(socket_path))
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(socket_path)
+            self.server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        else:
+            self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def address(self) -> str:
+        """Where the server listens: host:port, or the path of the Unix socket."""
+        address = self.server.server_address
+        return address if isinstance(address, str) else f'{address[0]}:{address[1]}'
+
+    def serve_forever(self):
+        """Serve requests until a client sends shutdown, then close the worker pool."""
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.estimator.close()
+
+    def parse_option(self, key: str, value):
+        """
+        Check a request option as the command line would check its argument.
+
+        @param key: name of the option
+        @param value: its value, as decoded from JSON
+        @return the value, converted to the argument's type
+        """
+        option = self.option_types.get(key)
+        if option is None or value is None:
+            return value
+        if option.flag:
+            if not isinstance(value, bool):
+                raise ValueError(f'Option {key} must be true or false, not {value!r}.')
+            return value
+        if option.type is not None:
+            if isinstance(value, (bool, list, dict)):
+                raise ValueError(f'Option {key} must be a single {option.type.__name__} value, not {value!r}.')
+            try:
+                value = option.type(value if isinstance(value, str) else str(value))
+            except argparse.ArgumentTypeError as error:
+                raise ValueError(f'Option {key}: {str(error).rstrip(".")}.')
+            except (TypeError, ValueError):
+                raise ValueError(f'Option {key} must be {option.type.__name__}, not {value!r}.')
+        if option.choices is not None and value not in option.choices:
+            raise ValueError(f'Option {key} must be one of {", ".join(map(str, option.choices))}, not {value!r}.')
+        return value
+
+    def handle(self, line: bytes):
+        """
+        Run a single request.
+
+        @param line: the request, as a line of JSON
+        @return tuple of whether it succeeded and the payload of the reply
+        """
+        try:
+            request = json.loads(line)
+            command = request['command']
+        except (ValueError, KeyError, TypeError):
+            return False, b'A request must be a JSON object with a command.'
+        if command == 'ping':
+            return True, b'pong'
+        if command == 'shutdown':
+            return True, b'shutting down'
+        if command not in SERVE_COMMANDS:
+            return False, f'Unknown command {command}.'.encode()
+
+        options = request.get('options') or {}
+        if not isinstance(options, dict):
+            return False, b'options must be a JSON object.'
+        unknown = set(options) - self.options
+        if unknown:
+            return False, f'Unknown options: {", ".join(sorted(unknown))}.'.encode()
+        try:
+            options = {key: self.parse_option(key, value) for key, value in options.items()}
+        except ValueError as error:
+            return False, str(error).encode()
+        method, columns = SERVE_COMMANDS[command]
+        args = ()
+        if command == 'sweep':
+            # a single value may come as a number rather than a list
+            args = tuple(values if isinstance(values, list) else [values]
+                         for values in (request.get('thresholds') or [], request.get('cut_offs') or []))
+
+        with self.lock:
+            # each request profiles only itself, so that the times do not pile up for as long as the server runs
+            self.estimator.profiler = Profile()
+            saved = {key: getattr(self.estimator, key) for key in options}
+            try:
+                for key, value in options.items():
+                    setattr(self.estimator, key, value)
+                if options.get('output_dir'):
+                    os.makedirs(os.path.expanduser(options['output_dir']), exist_ok=True)
+                results = list(getattr(self.estimator, method)(request.get('input', ''), *args))
+                if columns == ESTIMATE_COLUMNS:
+                    columns = self.estimator.result_columns()
+            except Exception as error:
+                return False, f'{type(error).__name__}: {error}'.encode()
+            finally:
+                for key, value in saved.items():
+                    setattr(self.estimator, key, value)
+
+        if request.get('format') == 'csv':
+            text = io.StringIO()
+            out = csv.writer(text, lineterminator='\n')
+            out.writerow([''] + list(columns))
+            for records in results:
+                out.writerows([i] + list(record) for i, record in enumerate(records))
+            return True, text.getvalue().encode()
+        rows = [list(record) for records in results for record in records]
+        return True, json.dumps({'columns': list(columns), 'rows': rows}, default=float).encode()
+
 
 class ErrorParser(argparse.ArgumentParser):
     def error(self, message):
@@ -377,101 +3620,379 @@ class ErrorParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
-# Parse arguments
-parser = ErrorParser(prog='ALFA.py')
-subparsers = parser.add_subparsers(dest='command')
-subparsers.required = True
-
-pre_processing_parser = subparsers.add_parser('preprocess',
-                                              help='Pre-process images of leaves so that their areas can be assessed.')
-pre_processing_parser.add_argument("-c", "--crop", type=int, default=0,
-                                   help="Number of pixels to crop off the margins of the image? Cropping occurs before "
-                                        "the other operations, so that they are performed on the cropped image.")
-pre_processing_parser.add_argument("--red_scale", type=int, default=0,
-                                   help="How many pixels wide should the side of the scale should be?")
-pre_processing_parser.add_argument("--mask_pixels", type=int, default=0,
-                                   help="How many pixels should each side of the masking window be?")
-pre_processing_parser.add_argument("--mask_offset_x", type=int, default=0,
-                                   help="Offset for positioning the masking window in number of pixels from right to "
-                                        "left of the image")
-pre_processing_parser.add_argument("--mask_offset_y", type=int, default=0,
-                                   help="Offset for positioning the masking window in number of pixels from top to "
-                                        "bottom of the image")
-pre_processing_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd)')
-
-estimate_parser = subparsers.add_parser('estimate', help='Assess images of leaves to determine their areas.')
-estimate_parser.add_argument("-t", "--threshold", type=int, default=120,
-                             help="a value between 0 (black) and 255 (white) for classification of background "
-                                  "and leaf pixels. Default = 120")
-estimate_parser.add_argument("--cut_off", type=int, default=10000,
-                             help="Clusters with fewer pixels than this value will be discarded. Default is 10000",)
-estimate_parser.add_argument("-c", "--combine", action='store_true',
-                             help="If true the total area will be returned; otherwise each segment will "
-                                  "be returned separately")
-estimate_parser.add_argument("--res", type=int, default=0,
-                             help="image resolution, in dots per inch (DPI); if False the resolution will be "
-                                  "read from the exif tag")
-estimate_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd)')
-
-resolution_sort_parser = subparsers.add_parser('resolution_sort', help='Sort images into sub directories by resolution')
-resolution_sort_parser.add_argument("input", type=str, help="Path to image or folder with images. Respects tilde expansion.")
-
-number_sort_parser = subparsers.add_parser('number_sort', help='Sort images into sub directories by number of images')
-number_sort_parser.add_argument("--fileno", type=int, default=2,
-                                   help="Number of images per sub directory")
-number_sort_parser.add_argument("input", type=str, help="Path to image or folder with images. Respects tilde expansion.")
-
-
-
-
-for p in [pre_processing_parser, estimate_parser]:
-    p.add_argument("input", type=str, help="Path to image or folder with images. Respects tilde expansion.")
-    p.add_argument("--output_dir", type=str, help="Where to save the output. Respects tilde expansion.")
-    p.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count() - 1,
+def default_res_argument(value: str):
+    """Parse a --default_res entry, either DPI for every image or DIR=DPI for the images below DIR."""
+    directory, _, res = value.rpartition('=')
+    try:
+        res = float(res)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not DPI or DIR=DPI')
+    return directory, res
+
+
+def shard_argument(value: str):
+    """Parse a --shard, i/N, keeping it as text."""
+    try:
+        index, count = parse_shard(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return f'{index}/{count}'
+
+
+class OptionType(NamedTuple):
+    """How a command line option that sets an ALFA parameter is parsed, see build_parser."""
+    type: type  # converts the text of the value, e.g. int; None for flags
+    choices: tuple  # the values allowed, or None for any
+    flag: bool  # store_true: the value is true or false
+
+
+def build_parser() -> ErrorParser:
+    """Build the command line parser."""
+    parser = ErrorParser(prog='ALFA.py')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    # name to OptionType of the options that set an ALFA parameter, for the server to check request options against
+    parser.option_types = {}
+
+    def add_option(p, *flags, **kwargs):
+        action = p.add_argument(*flags, **kwargs)
+        parser.option_types[action.dest] = OptionType(kwargs.get('type'), kwargs.get('choices'),
+                                                      kwargs.get('action') == 'store_true')
+
+    pre_processing_parser = subparsers.add_parser('preprocess',
+                                                  help='Pre-process images of leaves so that their areas can be assessed.')
+    pre_processing_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd)')
+
+    estimate_parser = subparsers.add_parser('estimate', help='Assess images of leaves to determine their areas.')
+    estimate_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd)')
+
+    process_parser = subparsers.add_parser('process', help='Pre-process images of leaves in memory and assess their '
+                                                           'areas, without writing the pre-processed images.')
+    add_option(process_parser, "--intermediate_dir", type=str,
+               help="Save the pre-processed images here, for auditing. Respects tilde expansion.")
+    process_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd)')
+
+    watch_parser = subparsers.add_parser('watch', help='Assess the images in a folder, then every image added to it '
+                                                       'as soon as it is written, until interrupted.')
+    watch_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd); appended to')
+    watch_parser.add_argument("--state", type=str,
+                              help="File in which to remember the images assessed, so that a restarted watch skips "
+                                   "them. Default is .alfa_watch in the watched folder. Respects tilde expansion.")
+    watch_parser.add_argument("--interval", type=float, default=2,
+                              help="Seconds between listings of the folder when polling. Default is 2")
+    watch_parser.add_argument("--settle", type=float, default=2,
+                              help="Seconds an image must stay unchanged before it is assessed, so that it is not "
+                                   "read half written. Default is 2")
+    watch_parser.add_argument("--poll", action='store_true',
+                              help="List the folder every --interval seconds instead of relying on inotify, which "
+                                   "misses files written by other machines to a network drive")
+
+    for p in [pre_processing_parser, process_parser]:
+        # -c is --combine for process, as for estimate
+        crop_flags = ["-c", "--crop"] if p is pre_processing_parser else ["--crop"]
+        add_option(p, *crop_flags, type=int, default=0,
+                   help="Number of pixels to crop off the margins of the image? Cropping occurs before "
+                        "the other operations, so that they are performed on the cropped image.")
+        add_option(p, "--red_scale", type=int, default=0,
+                   help="How many pixels wide should the side of the scale should be?")
+        add_option(p, "--mask_pixels", type=int, default=0,
+                   help="How many pixels should each side of the masking window be?")
+        add_option(p, "--mask_offset_x", type=int, default=0,
+                   help="Offset for positioning the masking window in number of pixels from right to "
+                        "left of the image")
+        add_option(p, "--mask_offset_y", type=int, default=0,
+                   help="Offset for positioning the masking window in number of pixels from top to "
+                        "bottom of the image")
+
+    for p in [estimate_parser, process_parser, watch_parser]:
+        add_option(p, "-t", "--threshold", type=int, default=120,
+                   help="a value between 0 (black) and 255 (white) for classification of background "
+                        "and leaf pixels. Default = 120")
+        add_option(p, "--auto_threshold", type=str, choices=THRESHOLD_METHODS,
+                   help="Choose the threshold of every image from its histogram: otsu, triangle, or valley, the "
+                        "lowest point between the two peaks. The threshold chosen is added to the results as "
+                        "a Threshold column. -t then only applies to images of a single gray level. triangle "
+                        "suits a dominant dark background peak; on white-background scans it can pick thresholds "
+                        "near white and overestimate leaf area more than threefold, as on some bundled images")
+        add_option(p, "--cut_off", type=int, default=10000,
+                   help="Clusters with fewer pixels than this value will be discarded. Default is 10000",)
+        add_option(p, "-c", "--combine", action='store_true',
+                   help="If true the total area will be returned; otherwise each segment will "
+                        "be returned separately")
+        add_option(p, "--res", type=int, default=0,
+                   help="image resolution, in dots per inch (DPI); if False the resolution will be "
+                        "read from the exif tag")
+        add_option(p, "--labeller", type=str, default='opencv', choices=LABELLERS,
+                   help="Connected-component backend. Both give identical areas. Default is opencv")
+        add_option(p, "--tile_mb", type=float, default=0,
+                   help="Threshold and label very large scans in strips of about this many MB, to bound "
+                        "memory use. Areas are unchanged. Default is 0, the whole image at once")
+        add_option(p, "--batch_mpx", type=float, default=0,
+                   help="Estimate images of at most this many megapixels in batches, thresholding and "
+                        "labelling many at once. Areas are unchanged. Not used with an output directory. "
+                        "Default is 0, one image at a time")
+        add_option(p, "--memory_mb", type=float,
+                   help="Memory the run may use. Fewer workers are started if the largest images would not "
+                        "fit. Default is the memory currently available; 0 turns the limit off")
+        add_option(p, "--features", action='store_true',
+                   help="One row per leaf, whatever --combine, with its centroid, bounding box, perimeter, "
+                        "convex hull area and mean colour and greenness, measured in the same pass as the area")
+        add_option(p, "--qa_dir", type=str,
+                   help="Write contact sheets for review here: a small overlay of every image, with the outline "
+                        "and area of every leaf, tiled into numbered JPEG pages, and qa_index.csv, which tells "
+                        "the page of each image. Respects tilde expansion.")
+        add_option(p, "--qa_size", type=int, default=320,
+                   help="Longer side of each overlay on the contact sheets, in pixels. Default is 320")
+        add_option(p, "--qa_per_page", type=int, default=30,
+                   help="Overlays per page of the contact sheets. Default is 30")
+        p.add_argument("--cache", type=str, nargs='?', const='',
+                       help="Cache results in this SQLite file, or in the user cache directory if no file is "
+                            "given, so that unchanged images are not processed again. Respects tilde expansion.")
+        add_option(p, "--cache_key", type=str, default='stat', choices=('stat', 'hash'),
+                   help="Recognise unchanged images by path, size and modification time (stat) or by a "
+                        "hash of their content (hash). Default is stat")
+        p.add_argument("--cache_max_age", type=float,
+                       help="Before running, drop cached results not used for this many days")
+        p.add_argument("--cache_max_mb", type=float,
+                       help="Before running, drop the least recently used results until the cache fits in "
+                            "this many MB")
+        p.add_argument("--resume", action='store_true',
+                       help="Resume an interrupted run: skip images already in the --csv or --results file, "
+                            "append to it, and accept an existing --output_dir")
+
+    sweep_parser = subparsers.add_parser('sweep', help='Assess images of leaves for every combination of several '
+                                                        'thresholds and cut-offs, e.g. to calibrate a scanner.')
+    sweep_parser.add_argument("-t", "--thresholds", type=int, nargs='+', required=True,
+                              help="values between 0 (black) and 255 (white) for classification of background and leaf "
+                                   "pixels")
+    sweep_parser.add_argument("--cut_offs", type=int, nargs='+', required=True,
+                              help="Clusters with fewer pixels than each of these values will be discarded")
+    sweep_parser.add_argument("-c", "--combine", action='store_true',
+                              help="If true the total area will be returned; otherwise each segment will "
+                                   "be returned separately")
+    sweep_parser.add_argument("--res", type=int, default=0,
+                              help="image resolution, in dots per inch (DPI); if False the resolution will be "
+                                   "read from the exif tag")
+    sweep_parser.add_argument("--labeller", type=str, default='opencv', choices=LABELLERS,
+                              help="Connected-component backend. Both give identical areas. Default is opencv")
+    sweep_parser.add_argument('--csv', type=str, help='name of output csv (to be saved in pwd)')
+
+    resolution_sort_parser = subparsers.add_parser('resolution_sort', help='Sort images into sub directories by resolution')
+    resolution_sort_parser.add_argument("input", type=str, help="Path to image or folder with images. Respects tilde expansion.")
+
+    number_sort_parser = subparsers.add_parser('number_sort', help='Sort images into sub directories by number of images')
+    number_sort_parser.add_argument("--fileno", type=int, default=2,
+                                       help="Number of images per sub directory")
+    number_sort_parser.add_argument("input", type=str, help="Path to image or folder with images. Respects tilde expansion.")
+
+    for p in [resolution_sort_parser, number_sort_parser]:
+        p.add_argument("--dry_run", action='store_true',
+                       help="Print the moves as CSV without making them")
+        p.add_argument("--threads", type=int, default=16,
+                       help="How many files to read and move at once; on network drives more hide the latency. "
+                            "An interrupted sort is finished when run again. Default is 16")
+
+    for p in [pre_processing_parser, estimate_parser, process_parser]:
+        add_option(p, "--shard", type=shard_argument,
+                   help="Process only this shard of a folder planned with ALFA.py plan, given as i/N, e.g. 2/4, "
+                        "so that several machines, or processes, sharing the folder can split it. An existing "
+                        "--output_dir is accepted, as the shards share it")
+        add_option(p, "--manifest", type=str,
+                   help="The manifest written by ALFA.py plan. Default is alfa_manifest.csv in the folder. "
+                        "Respects tilde expansion.")
+
+    for p in [estimate_parser, process_parser, watch_parser, sweep_parser]:
+        p.add_argument("--default_res", type=default_res_argument, nargs='+', default=[],
+                       help="Resolution of images without one in their header, in dpi: either DPI for every image, or "
+                            "DIR=DPI, repeatable, for the images below DIR. An explicit --res takes precedence over "
+                            "the header, which takes precedence over this")
+        add_option(p, "--decode", type=str, default='color', choices=DECODES,
+                   help="Decode in colour and convert to grayscale, or decode straight to grayscale, which is "
+                        "faster and lighter. Default is color")
+        add_option(p, "--reduce", type=int, default=1, choices=(1, 2, 4, 8),
+                   help="Decode at 1/2, 1/4 or 1/8 of the resolution, for quick triage. Areas are corrected for "
+                        "the scale. Default is 1")
+
+    for p in [pre_processing_parser, estimate_parser, process_parser, watch_parser, sweep_parser]:
+        p.add_argument("input", type=str, help="Path to image or folder with images. Respects tilde expansion.")
+        if p is not sweep_parser:
+            add_option(p, "--output_dir", type=str, help="Where to save the output. Respects tilde expansion.")
+            add_option(p, "--output_format", type=str, choices=OUTPUT_FORMATS,
+                       help="Format of the saved images. Default is jpg for preprocess and the format of the "
+                            "source for estimate. Thresholded images saved as png take one bit per pixel")
+            p.add_argument("--quality", type=int, default=95, help="JPEG quality of the saved images. Default is 95")
+            p.add_argument("--compression", type=int,
+                           help="PNG compression level (0-9, default 1) or TIFF compression scheme (default 8, "
+                                "deflate) of the saved images")
+        p.add_argument("--results", type=str,
+                       help="File to stream the results to as each image is finished. The format (csv, jsonl or "
+                            "parquet) is taken from the extension. Respects tilde expansion.")
+        add_option(p, "-w", "--workers", type=int, default=max(1, multiprocessing.cpu_count() - 1),
                    help="How many cores to use? Default is to use all available minus one. "
                         "Only relevant when assessing a folder, ignored otherwise.")
+        add_option(p, "--backend", type=str, default='process', choices=BACKENDS,
+                   help="Run the workers as processes, as threads of one process, which share a single copy "
+                        "of the libraries, or not at all (serial). Default is process")
+        p.add_argument("--profile", type=str, nargs='?', const='',
+                       help="Time every stage of every image and print a summary when done, and save it with the "
+                            "times of each image as JSON in this file, if given. Respects tilde expansion.")
 
 
-where_parser = subparsers.add_parser('example', help='Print the directory where example images are saved.')
+    plan_parser = subparsers.add_parser('plan', help='List the images of a folder with their size, dimensions and '
+                                                     'resolution, and split them into shards of about equal pixels, '
+                                                     'to run with --shard on several machines.')
+    plan_parser.add_argument("input", type=str, help="Path to the folder with images. Respects tilde expansion.")
+    plan_parser.add_argument("--shards", type=int, required=True, help="How many shards to split the folder into")
+    plan_parser.add_argument("--threads", type=int, default=16,
+                             help="How many headers to read at once; on network drives more hide the latency. "
+                                  "Default is 16")
 
-args = parser.parse_args()
+    merge_parser = subparsers.add_parser('merge', help='Combine the results of the shards of a planned folder, and '
+                                                       'check that every image in its manifest has results.')
+    merge_parser.add_argument("input", type=str, help="Path to the planned folder. Respects tilde expansion.")
+    merge_parser.add_argument("results", type=str, nargs='+',
+                              help="The --csv or --results files of the shards (csv, jsonl or parquet). An image in "
+                                   "several is taken from the last, unless it has an error there and not before")
+    merge_parser.add_argument("--output", type=str,
+                              help="File to write the merged results to, as csv, jsonl or parquet by its extension. "
+                                   "Respects tilde expansion.")
+    merge_parser.add_argument("--allow_missing", action='store_true',
+                              help="Succeed even if images of the manifest have no results")
 
+    for p in [plan_parser, merge_parser]:
+        p.add_argument("--manifest", type=str,
+                       help="The manifest. Default is alfa_manifest.csv in the folder. Respects tilde expansion.")
 
-if __name__ == '__main__':
+    where_parser = subparsers.add_parser('example', help='Print the directory where example images are saved.')
+
+    serve_parser = subparsers.add_parser('serve', help='Run jobs sent over a local socket, e.g. by the R interface, '
+                                                       'keeping the worker pool warm between them.')
+    serve_parser.add_argument("--host", type=str, default='127.0.0.1',
+                              help="Address to listen on. There is no authentication, so keep it local. "
+                                   "Default is 127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=0, help="TCP port to listen on. Default is any free port")
+    serve_parser.add_argument("--socket", type=str, help="Listen on this Unix socket instead of TCP")
+    serve_parser.add_argument("-w", "--workers", type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                              help="How many cores to use for folders? Default is to use all available minus one.")
+    serve_parser.add_argument("--backend", type=str, default='process', choices=BACKENDS,
+                              help="Run the workers as processes, as threads of the server, or not at all (serial). "
+                                   "Default is process")
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Run the command line interface.
+
+    @param argv: command line arguments; def: sys.argv
+    """
+    args = build_parser().parse_args(argv)
     estimator = ALFA()
+    profile = args.command in ('estimate', 'process', 'watch', 'preprocess', 'sweep') and args.profile is not None
+    estimator.profile = profile
+    if args.command in ('estimate', 'process', 'watch', 'preprocess'):
+        estimator.output_format = args.output_format
+        estimator.output_quality = args.quality
+        estimator.output_compression = args.compression
+
+    if args.command in ('preprocess', 'process'):
+        estimator.crop = args.crop
+        estimator.red_scale = args.red_scale
+        estimator.red_scale_pixels = args.red_scale
+        estimator.mask_pixels = args.mask_pixels
+        estimator.mask_offset_x = args.mask_offset_x
+        estimator.mask_offset_y = args.mask_offset_y
 
-    if args.command == 'estimate':
+    if args.command in ('estimate', 'process', 'watch'):
         output_dir = None
         if args.output_dir:
             output_dir = os.path.abspath(os.path.expanduser(args.output_dir))
-           
+
             if os.path.split(os.path.abspath(os.path.expanduser(args.input)))[0] == output_dir:
                 raise NameError(
                     'You have provided identical paths for the source and destination directories. '
                     'This would cause your files to be overwritten. Execution has been halted. ')
-            
+
             estimator.output_dir = output_dir
             if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
+                # shards started together may all create it
+                os.makedirs(output_dir, exist_ok=True)
                 print(f'directory {output_dir} created')
-            else:
+            elif not args.resume and args.command != 'watch' and not args.shard:
                 raise NameError("Output directory already exists. Output files may overwrite existing files. "
                                 "Please choose a different output directory.")
         estimator.res = args.res
+        estimator.default_res = dict(args.default_res) if any(d for d, _ in args.default_res) else \
+            dict(args.default_res).get('', 0)
         estimator.workers = args.workers
+        estimator.backend = args.backend
         estimator.combine = args.combine
         estimator.cut_off = args.cut_off
         estimator.threshold = args.threshold
+        estimator.labeller = args.labeller
+        estimator.decode = args.decode
+        estimator.reduce = args.reduce
+        estimator.tile_mb = args.tile_mb
+        estimator.batch_mpx = args.batch_mpx
+        estimator.features = args.features
+        estimator.auto_threshold = args.auto_threshold
+        estimator.qa_dir = os.path.abspath(os.path.expanduser(args.qa_dir)) if args.qa_dir else None
+        estimator.qa_size = args.qa_size
+        estimator.qa_per_page = args.qa_per_page
+        estimator.memory_mb = args.memory_mb
+        estimator.cache = args.cache
+        estimator.cache_key = args.cache_key
+        if args.command != 'watch':
+            estimator.shard = args.shard
+            estimator.manifest = args.manifest
+        if args.command == 'process' and args.intermediate_dir:
+            estimator.intermediate_dir = os.path.abspath(os.path.expanduser(args.intermediate_dir))
+            os.makedirs(estimator.intermediate_dir, exist_ok=True)
+
+        # images that already have results, when resuming an interrupted run
+        done = set()
+        if args.resume:
+            for path in (args.csv, args.results):
+                if path:
+                    done |= ResultWriter.completed(path)
+
+        cache = estimator.open_cache()
+        if cache is not None and (args.cache_max_age is not None or args.cache_max_mb is not None):
+            cache.evict(args.cache_max_age, args.cache_max_mb)
+
+        # stream the results out as each image is done, so that an interrupted run keeps what it has
+        # a watch adds to the results of the previous one. appending drops the rows of the last image, in case it was
+        # interrupted, so that image is estimated again
+        redo = [ResultWriter.last_image(path) for path in (args.csv, args.results) if path] \
+            if args.command == 'watch' else []
+
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(path, estimator.result_columns(),
+                                                        append=args.resume or args.command == 'watch'))
+                       for path in (args.csv, args.results) if path]
+            stack.callback(estimator.close)
+            if args.command == 'watch':
+                results = estimator.iter_watch(args.input, args.state, args.interval, args.settle, args.poll,
+                                               redo=[path for path in redo if path])
+            else:
+                run = estimator.iter_process if args.command == 'process' else estimator.iter_estimate
+                results = run(args.input, skip=done)
+            images = stream_results(results, estimator.result_columns(), writers)
 
-        output = estimator.estimate(args.input)
-        print('###Data###')
-        print(output[['filename','Area', 'Resolution','Error']].to_csv(sep=',')) #quoting=csv.QUOTE_NONE)
-        if args.csv:
-            output[['filename','Area', 'Resolution','Error']].to_csv(args.csv)
+            # keep stdout for the data, which the R interface parses
+            summary = f'{images} images processed'
+            if done:
+                summary += f', {len(done)} already done'
+            if cache is not None:
+                summary += f'; cache: {cache.hits} hits, {cache.misses} misses'
+            if estimator.qa_pages:
+                summary += f'; contact sheets in {estimator.qa_dir}'
+            print(summary, file=sys.stderr)
 
         #Check that there actually were some images successfully processed.
-        #If not, delete the the output directory.
-        if output_dir is not None:
+        #If not, delete the the output directory, unless other shards may still write to it.
+        if output_dir is not None and not estimator.shard:
             file_list = [f for f in listdir(output_dir) if isfile(join(output_dir, f))]
             if len(file_list) == 0:
                 os.rmdir(output_dir)
@@ -487,13 +4008,14 @@ if __name__ == '__main__':
                 output_dir = os.path.join(os.path.abspath(os.path.expanduser(args.input)),'preprocessed')
             else:
                 output_dir = os.path.join(os.path.split(os.path.abspath(os.path.expanduser(args.input)))[0],'preprocessed')
-            
-        
+
+
+        estimator.output_dir = output_dir
         if not os.path.exists(output_dir):
-            estimator.output_dir = output_dir
-            os.makedirs(output_dir)
+            # shards started together may all create it
+            os.makedirs(output_dir, exist_ok=True)
             print(f'directory {output_dir} created')
-        else:
+        elif not args.shard:
             raise NameError(
                 "Output directory already exists. Output files may overwrite existing files. "
                 "Please choose a different output directory.")
@@ -503,30 +4025,97 @@ if __name__ == '__main__':
                 'You have provided identical paths for the source and destination directories. '
                 'This would cause your files to be overwritten. Execution has been halted. ')
 
-        estimator.crop = args.crop
-        estimator.red_scale = args.red_scale
-        estimator.mask_pixels = args.mask_pixels
-        estimator.mask_offset_x = args.mask_offset_x
-        estimator.mask_offset_y = args.mask_offset_y
         estimator.workers = args.workers
+        estimator.backend = args.backend
+        estimator.shard = args.shard
+        estimator.manifest = args.manifest
 
-        output =  estimator.preprocess(args.input)
-        print('###Data###')
-        print(output[['filename','Pre-process Result']].to_csv(sep=',')) #quoting=csv.QUOTE_NONE)
-        if args.csv:
-            output[['filename','Pre-process Result']].to_csv(os.path.join(output_dir,args.csv))
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(path, PREPROCESS_COLUMNS))
+                       for path in (args.csv and os.path.join(output_dir, args.csv), args.results) if path]
+            stack.callback(estimator.close)
+            stream_results(estimator.iter_preprocess(args.input), PREPROCESS_COLUMNS, writers)
 
         #Check that there actually were some images sucessfully processed.
-        #If not, delete the the output directory.
+        #If not, delete the the output directory, unless other shards may still write to it.
         file_list = [f for f in listdir(output_dir) if isfile(join(output_dir, f))]
-        if len(file_list) == 0:
+        if len(file_list) == 0 and not args.shard:
             os.rmdir(output_dir)
 
-    elif args.command == 'resolution_sort':
-        estimator.resolution_sort_image_files(args.input)
+    elif args.command == 'sweep':
+        estimator.res = args.res
+        estimator.default_res = dict(args.default_res) if any(d for d, _ in args.default_res) else \
+            dict(args.default_res).get('', 0)
+        estimator.workers = args.workers
+        estimator.backend = args.backend
+        estimator.combine = args.combine
+        estimator.labeller = args.labeller
+        estimator.decode = args.decode
+        estimator.reduce = args.reduce
+
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(path, SWEEP_COLUMNS)) for path in (args.csv, args.results) if path]
+            stack.callback(estimator.close)
+            stream_results(estimator.iter_sweep(args.input, args.thresholds, args.cut_offs), SWEEP_COLUMNS, writers)
+
+    elif args.command in ('resolution_sort', 'number_sort'):
+        if args.command == 'resolution_sort':
+            moves = estimator.resolution_sort_image_files(args.input, args.dry_run, args.threads)
+        else:
+            moves = estimator.num_file_sort_image_files(args.input, args.fileno, args.dry_run, args.threads)
+        if args.dry_run:
+            out = csv.writer(sys.stdout, lineterminator='\n')
+            out.writerow(SortMove._fields)
+            out.writerows(moves)
+        else:
+            print(f'{len(moves)} files moved into {len({os.path.dirname(move.target) for move in moves})} '
+                  f'directories', file=sys.stderr)
+
+    elif args.command == 'plan':
+        entries = plan_shards(args.input, args.shards, MetadataIndex(args.threads))
+        path = manifest_path(args.input, args.manifest)
+        write_manifest(path, entries)
+        for i in range(1, args.shards + 1):
+            shard = [entry for entry in entries if entry.shard == f'{i}/{args.shards}']
+            pixels = sum(entry.width * entry.height for entry in shard if entry.width and entry.height)
+            print(f'shard {i}/{args.shards}: {len(shard)} images, {pixels / 1e6:.1f} Mpx', file=sys.stderr)
+        print(f'{len(entries)} images planned in {path}', file=sys.stderr)
+
+    elif args.command == 'merge':
+        merged = merge_results(args.input, args.results, read_manifest(manifest_path(args.input, args.manifest)))
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(args.output, merged.columns))] if args.output else []
+            images = stream_results(merged.images, merged.columns, writers)
 
-    elif args.command == 'number_sort':
-        estimator.num_file_sort_image_files(args.input,args.fileno)
+        summary = f'{images} images merged from {len(args.results)} files'
+        if merged.duplicates:
+            summary += f', {merged.duplicates} duplicate results dropped'
+        if merged.unknown:
+            summary += f'; {len(merged.unknown)} not in the manifest'
+        print(summary, file=sys.stderr)
+        if merged.missing:
+            print(f'{len(merged.missing)} images of the manifest have no results:', file=sys.stderr)
+            for entry in merged.missing:
+                print(f'  {entry.path} (shard {entry.shard})', file=sys.stderr)
+            if not args.allow_missing:
+                sys.exit(1)
 
     elif args.command == 'example':
-        print(static)
+        print(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extdata'))
+
+    elif args.command == 'serve':
+        estimator.workers = args.workers
+        estimator.backend = args.backend
+        server = ALFAServer(estimator, args.host, args.port, args.socket)
+        # the first line tells clients, such as the R interface, where to connect
+        print(f'listening on {server.address}', flush=True)
+        server.serve_forever()
+
+    if profile:
+        print(estimator.profiler.format(), file=sys.stderr)
+        if args.profile:
+            estimator.profiler.write(args.profile)
+
+
+if __name__ == '__main__':
+    main()
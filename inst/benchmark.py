@@ -0,0 +1,785 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the ALFA hot paths.
+
+Every measurement runs in a freshly spawned process, so that the peak resident set size reported for it
+belongs to that measurement alone.
+"""
+
+import sys
+import os
+import argparse
+import json
+import zlib
+import time
+import resource
+import statistics
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+PREPARED = os.path.join(here, 'extdata', 'prepared')
+RAW = os.path.join(here, 'extdata', 'raw')
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the calling process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak / 1024 if sys.platform != 'darwin' else peak / 1024 / 1024
+
+
+def _run_isolated(target, *args) -> dict:
+    """Run target(*args) in a spawned process and return the dictionary it reports."""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_report, args=(queue, target) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _report(queue, target, *args):
+    queue.put(target(*args))
+
+
+def _upscaled_binary(img: str, megapixels: float, threshold: int):
+    """Read a scan as grayscale, upscale it to the requested size and threshold it, as estimate does."""
+    import cv2
+    scan = cv2.imread(img, cv2.IMREAD_GRAYSCALE)
+    scale = (megapixels * 1e6 / scan.size) ** 0.5
+    if scale > 1:
+        scan = cv2.resize(scan, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    return cv2.threshold(scan, threshold, 255, cv2.THRESH_BINARY_INV)[1]
+
+
+def _label_once(img: str, labeller: str, megapixels: float, threshold: int) -> dict:
+    import numpy as np
+    binary = _upscaled_binary(img, megapixels, threshold)
+    before = peak_rss_mb()
+
+    start = time.perf_counter()
+    if labeller == 'skimage':
+        # the original implementation of estimate
+        from skimage import measure
+        leaflets = np.unique(measure.label(binary, background=0), return_counts=True)
+        areas = leaflets[1][leaflets[0] != 0]
+    else:
+        from ALFA import label_components
+        areas = label_components(binary, labeller).areas
+    seconds = time.perf_counter() - start
+
+    return {'image': os.path.basename(img), 'labeller': labeller, 'megapixels': binary.size / 1e6,
+            'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'labelling_rss_mb': peak_rss_mb() - before,
+            'components': int(areas.size), 'areas_checksum': int((areas * np.arange(1, areas.size + 1)).sum())}
+
+
+def labelling(args) -> list:
+    """Compare the original measure.label + np.unique path with the label_components backends."""
+    images = sorted(os.path.join(args.images, f) for f in os.listdir(args.images) if f.lower().endswith('.jpg'))
+    # scikit-image is no longer a dependency; without it, the backends are compared with each other
+    try:
+        import skimage
+        labellers = ('skimage', 'opencv', 'bincount')
+    except ImportError:
+        labellers = ('opencv', 'bincount')
+    results = []
+    for img in images:
+        rows = [_run_isolated(_label_once, img, labeller, args.megapixels, args.threshold) for labeller in labellers]
+        for row in rows:
+            row['identical_areas'] = row['areas_checksum'] == rows[0]['areas_checksum']
+            row['speedup'] = rows[0]['seconds'] / row['seconds']
+            row['rss_saving_mb'] = rows[0]['peak_rss_mb'] - row['peak_rss_mb']
+            print(f"{row['image']:>10} {row['labeller']:>9} {row['megapixels']:6.1f} Mpx "
+                  f"{row['seconds']:7.3f} s  x{row['speedup']:5.1f}  peak {row['peak_rss_mb']:7.0f} MB "
+                  f"(labelling +{row['labelling_rss_mb']:6.0f} MB)  identical areas: {row['identical_areas']}")
+        results.extend(rows)
+    return results
+
+
+def _estimate_once(img: str, decode: str, reduce: int, repeats: int) -> dict:
+    from ALFA import ALFA
+    estimator = ALFA(decode=decode, reduce=reduce, workers=1)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        record = estimator._estimate_image(img)[0]
+    seconds = (time.perf_counter() - start) / repeats
+    return {'image': os.path.basename(img), 'decode': decode, 'reduce': reduce, 'seconds': seconds,
+            'peak_rss_mb': peak_rss_mb(), 'estimate_rss_mb': peak_rss_mb() - before, 'area': record.Area,
+            'error': record.Error}
+
+
+def decoding(args) -> list:
+    """Time, peak memory and area error of the decode modes of estimate, against a full colour decode."""
+    images = sorted(os.path.join(args.images, f) for f in os.listdir(args.images) if f.lower().endswith('.jpg'))
+    modes = [('color', 1), ('gray', 1)] + [(decode, reduce) for reduce in (2, 4, 8) for decode in ('color', 'gray')]
+    results = []
+    for img in images:
+        rows = [_run_isolated(_estimate_once, img, decode, reduce, args.repeats) for decode, reduce in modes]
+        for row in rows:
+            row['speedup'] = rows[0]['seconds'] / row['seconds']
+            row['area_error_pct'] = 100 * (row['area'] - rows[0]['area']) / rows[0]['area']
+            print(f"{row['image']:>10} {row['decode']:>5} 1/{row['reduce']}  {row['seconds']:6.3f} s  "
+                  f"x{row['speedup']:5.1f}  peak {row['peak_rss_mb']:5.0f} MB  area {row['area']:8.3f} cm2 "
+                  f"({row['area_error_pct']:+.2f} %)")
+        results.extend(rows)
+    return results
+
+
+def _tiled_once(img: str, megapixels: float, threshold: int, tile_mb: float) -> dict:
+    import cv2
+    import numpy as np
+    from ALFA import label_components, tiled_component_areas
+    scan = cv2.imread(img, cv2.IMREAD_GRAYSCALE)
+    scale = (megapixels * 1e6 / scan.size) ** 0.5
+    scan = cv2.resize(scan, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    before = peak_rss_mb()
+
+    start = time.perf_counter()
+    if tile_mb:
+        areas = tiled_component_areas(scan, threshold, tile_mb * 1024 * 1024 / (scan.shape[1] * 10))
+    else:
+        areas = label_components(cv2.threshold(scan, threshold, 255, cv2.THRESH_BINARY_INV)[1]).areas
+    seconds = time.perf_counter() - start
+
+    return {'image': os.path.basename(img), 'tile_mb': tile_mb, 'megapixels': scan.size / 1e6, 'seconds': seconds,
+            'peak_rss_mb': peak_rss_mb(), 'labelling_rss_mb': peak_rss_mb() - before,
+            'areas_checksum': int((areas * np.arange(1, areas.size + 1)).sum())}
+
+
+def tiling(args) -> list:
+    """Peak memory and time of whole-image against tiled thresholding and labelling of a very large scan."""
+    results = []
+    rows = [_run_isolated(_tiled_once, args.image, args.megapixels, args.threshold, tile_mb)
+            for tile_mb in [0] + args.tile_mb]
+    for row in rows:
+        row['identical_areas'] = row['areas_checksum'] == rows[0]['areas_checksum']
+        print(f"{row['image']:>10} {row['megapixels']:6.1f} Mpx tiles {row['tile_mb'] or 'off':>5} MB "
+              f"{row['seconds']:7.3f} s  labelling +{row['labelling_rss_mb']:6.0f} MB  "
+              f"identical areas: {row['identical_areas']}")
+        results.append(row)
+    return results
+
+
+def _read_headers(images: list, reader: str) -> dict:
+    from ALFA import MetadataIndex
+    if reader == 'exif':
+        # the original resolution lookup, a full EXIF parse per file. exif is no longer a dependency
+        try:
+            import exif
+        except ImportError:
+            return None
+
+    start = time.perf_counter()
+    if reader == 'exif':
+        for img in images:
+            with open(img, 'rb') as image_meta:
+                exif.Image(image_meta).get('x_resolution')
+    else:
+        MetadataIndex().build(images)
+    seconds = time.perf_counter() - start
+    return {'reader': reader, 'files': len(images), 'seconds': seconds, 'files_per_second': len(images) / seconds}
+
+
+def metadata(args) -> list:
+    """Resolution lookup over many files: the exif package against the header-only metadata index."""
+    images = sorted(os.path.join(args.images, f) for f in os.listdir(args.images) if f.lower().endswith('.jpg'))
+    images = (images * (args.files // len(images) + 1))[:args.files]
+    results = []
+    for reader in ('exif', 'index'):
+        row = _run_isolated(_read_headers, images, reader)
+        if row is None:
+            continue
+        print(f"{row['reader']:>6} {row['files']} files {row['seconds']:7.3f} s  {row['files_per_second']:8.0f} files/s")
+        results.append(row)
+    return results
+
+
+def _thumbnails(img: str, directory: str, files: int, size: int) -> list:
+    """Write copies of a scan, shrunk to size pixels on its long side and shifted a little each, as many JPEGs."""
+    import cv2
+    import numpy as np
+    scan = cv2.imread(img)
+    scale = size / max(scan.shape[:2])
+    scan = cv2.resize(scan, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    images = []
+    for i in range(files):
+        path = os.path.join(directory, f'thumb{i:06d}.jpg')
+        cv2.imwrite(path, np.roll(scan, i % scan.shape[1], axis=1))
+        images.append(path)
+    return images
+
+
+def _batch_once(directory: str, batch_mpx: float) -> dict:
+    import cv2
+    from ALFA import ALFA
+    estimator = ALFA(output_dir='', workers=1, batch_mpx=batch_mpx, combine=False, cut_off=100)
+    start = time.perf_counter()
+    if batch_mpx is None:
+        # the decodes alone, the floor for any estimate
+        for entry in os.scandir(directory):
+            cv2.imread(entry.path, cv2.IMREAD_COLOR)
+        areas = []
+    else:
+        areas = sorted(estimator.estimate(directory).itertuples(index=False, name=None))
+    seconds = time.perf_counter() - start
+    return {'batch_mpx': batch_mpx, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'areas': len(areas),
+            'areas_checksum': zlib.crc32(repr(areas).encode())}
+
+
+def batching(args) -> list:
+    """Time of estimating many thumbnails one by one and in batches, against decoding them alone."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        images = _thumbnails(args.image, directory, args.files, args.size)
+        rows = [_run_isolated(_batch_once, directory, batch_mpx) for batch_mpx in [None, 0] + args.batch_mpx]
+    for row in rows:
+        row['images_per_second'] = len(images) / row['seconds']
+        row['decode_share'] = rows[0]['seconds'] / row['seconds']
+        if row['batch_mpx'] is not None:
+            row['identical_areas'] = row['areas_checksum'] == rows[1]['areas_checksum']
+        label = 'decode only' if row['batch_mpx'] is None else f"batches {row['batch_mpx'] or 'off':>4}"
+        print(f"{label:>13} {len(images)} images {row['seconds']:7.3f} s  {row['images_per_second']:7.0f} images/s  "
+              f"decoding {100 * row['decode_share']:3.0f} % of the time"
+              + (f"  identical areas: {row['identical_areas']}" if 'identical_areas' in row else ''))
+        results.append(row)
+    for row in results:
+        del row['areas_checksum']
+    return results
+
+
+def _peak_rss_of(pid: int) -> float:
+    """Peak resident set size of another process, in MB, from /proc on Linux; 0 where there is no /proc."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _backend_once(directory: str, backend: str, workers: int) -> dict:
+    from ALFA import ALFA
+    # no memory limit, so that every backend runs with all the workers asked for
+    estimator = ALFA(output_dir='', workers=workers, backend=backend, memory_mb=0)
+    start = time.perf_counter()
+    areas = sorted(estimator.estimate(directory).itertuples(index=False, name=None))
+    seconds = time.perf_counter() - start
+    # the worker processes are still up, so their peaks can be read; shared pages count in each of them
+    workers_rss = sum(_peak_rss_of(process.pid) for process in estimator._pool._pool) \
+        if backend == 'process' and estimator._pool is not None else 0
+    estimator.close()
+    return {'backend': backend, 'workers': workers, 'images': len({area[0] for area in areas}), 'seconds': seconds,
+            'peak_rss_mb': peak_rss_mb(), 'workers_rss_mb': workers_rss,
+            'total_rss_mb': peak_rss_mb() + workers_rss, 'areas_checksum': zlib.crc32(repr(areas).encode())}
+
+
+def backends(args) -> list:
+    """Time and memory of the process, thread and serial backends on many small images and on a few large scans."""
+    results = []
+    with tempfile.TemporaryDirectory() as work:
+        small = os.path.join(work, 'small')
+        os.makedirs(small)
+        _run_isolated(_thumbnails, args.image, small, args.files, args.size)
+        large = os.path.join(work, 'large')
+        _run_isolated(generate_scans, large, args.scans, args.megapixels, 300, 12, 50)
+        for name, directory in (('small', small), ('large', large)):
+            rows = [_run_isolated(_backend_once, directory, backend, workers)
+                    for workers in args.workers for backend in ('process', 'thread', 'serial')
+                    if backend != 'serial' or workers == args.workers[0]]
+            reference = rows[0]['areas_checksum']
+            for row in rows:
+                row['images_per_second'] = row['images'] / row['seconds']
+                row['identical_areas'] = row.pop('areas_checksum') == reference
+                row['scans'] = name
+                print(f"{name:>5} {row['backend']:>7} {row['workers']:3d} workers  {row['seconds']:7.3f} s "
+                      f"{row['images_per_second']:7.1f} images/s  memory {row['total_rss_mb']:6.0f} MB "
+                      f"(parent {row['peak_rss_mb']:5.0f}, workers {row['workers_rss_mb']:5.0f})  "
+                      f"identical areas: {row['identical_areas']}")
+                results.append(row)
+    return results
+
+
+def _import_times(stderr: str) -> dict:
+    """Cumulative import time in ms of each module, from the output of python -X importtime."""
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, module = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative) / 1000
+    return times
+
+
+def startup(args) -> list:
+    """Wall time and import time of starting ALFA, as R does for every call to the script."""
+    script = os.path.join(here, 'ALFA.py')
+    image = os.path.join(PREPARED, 'img1.jpg')
+    commands = {'import': ['-c', 'import ALFA'],
+                'example': [script, 'example'],
+                'estimate': [script, 'estimate', image, '-w', '1']}
+    results = []
+    failed = False
+    for name, command in commands.items():
+        seconds, imports = [], {}
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            run = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=here, capture_output=True,
+                                 text=True)
+            seconds.append(time.perf_counter() - start)
+            imports = _import_times(run.stderr)
+        alfa_ms = imports.get('ALFA', imports.get('__main__', 0))
+        heaviest = sorted(((ms, module) for module, ms in imports.items() if '.' not in module and module != 'ALFA'),
+                          reverse=True)[:5]
+        row = {'command': name, 'seconds': statistics.median(seconds), 'alfa_import_ms': alfa_ms,
+               'heaviest_imports': {module: ms for ms, module in heaviest}}
+        print(f"{name:>9} {row['seconds']:6.3f} s  ALFA import {alfa_ms:6.1f} ms  heaviest: "
+              + ', '.join(f'{module} {ms:.0f} ms' for ms, module in heaviest))
+        if name == 'import' and args.max_import_ms and alfa_ms > args.max_import_ms:
+            print(f'importing ALFA took {alfa_ms:.1f} ms, more than {args.max_import_ms} ms', file=sys.stderr)
+            failed = True
+        results.append(row)
+    if failed:
+        sys.exit(1)
+    return results
+
+
+def _exif_resolution(dpi: float) -> bytes:
+    """A minimal EXIF APP1 segment holding nothing but the resolution, as scanners write it."""
+    import struct
+    entries = [(0x011A, 5, 1, 50), (0x011B, 5, 1, 58), (0x0128, 3, 1, 2)]
+    ifd = struct.pack('<H', len(entries)) + b''.join(struct.pack('<HHII', *entry) for entry in entries)
+    ifd += struct.pack('<I', 0)
+    # both rationals follow the IFD, at offsets 50 and 58 from the start of the TIFF header
+    tiff = b'II*\0' + struct.pack('<I', 8) + ifd + struct.pack('<IIII', round(dpi * 100), 100, round(dpi * 100), 100)
+    payload = b'Exif\0\0' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def synthetic_scan(megapixels: float = 8, dpi: float = 300, leaves: int = 12, specks: float = 50, seed: int = 0):
+    """
+    Draw a scan of leaves of known area: dark green ellipses, each in its own cell of a grid, on a noisy white
+    background, with small dark specks that estimate's default cut_off discards.
+
+    @param megapixels: size of the scan, in the proportions of an A4 page
+    @param dpi: resolution the scan stands for
+    @param leaves: number of leaves
+    @param specks: number of specks per megapixel
+    @param seed: seed of the random layout
+    @return tuple of the BGR image and the true leaf area in cm2
+    """
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    height = round((megapixels * 1e6 * 2 ** 0.5) ** 0.5)
+    width = round(megapixels * 1e6 / height)
+    image = np.clip(rng.normal(232, 4, (height, width, 1)), 0, 255).astype(np.uint8).repeat(3, axis=2)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    columns = max(1, round((leaves * width / height) ** 0.5))
+    rows = -(-leaves // columns)
+    cell_w, cell_h = width // columns, height // rows
+    for i in range(leaves):
+        centre = ((i % columns) * cell_w + cell_w // 2, (i // columns) * cell_h + cell_h // 2)
+        # an ellipse no longer than 0.45 of the smaller side of its cell stays inside it, whatever its angle
+        long = int(min(cell_w, cell_h) * rng.uniform(0.3, 0.45))
+        axes = (long, int(long * rng.uniform(0.35, 0.7)))
+        cv2.ellipse(mask, centre, axes, float(rng.uniform(0, 180)), 0, 360, 255, -1)
+    leaf = mask > 0
+    image[leaf] = np.clip(rng.normal((45, 115, 40), 6, (int(leaf.sum()), 3)), 0, 255).astype(np.uint8)
+
+    # specks only where they cannot touch a leaf
+    clear = cv2.dilate(mask, np.ones((9, 9), np.uint8)) == 0
+    for x, y in zip(rng.integers(0, width, int(specks * megapixels)), rng.integers(0, height, int(specks * megapixels))):
+        if clear[y, x]:
+            cv2.circle(image, (int(x), int(y)), int(rng.integers(1, 4)), (60, 60, 60), -1)
+
+    pixels_per_cm2 = (dpi / 2.54) ** 2
+    return image, float(leaf.sum() / pixels_per_cm2)
+
+
+def generate_scans(directory: str, files: int, megapixels: float, dpi: float, leaves: int, specks: float,
+                   exif: bool = True) -> dict:
+    """
+    Write synthetic scans as JPEGs, with their resolution in EXIF, or in no header at all.
+
+    @return dict of path to true leaf area in cm2
+    """
+    from ALFA import encode_image, write_atomic
+    os.makedirs(directory, exist_ok=True)
+    truth = {}
+    for i in range(files):
+        image, area = synthetic_scan(megapixels, dpi, leaves, specks, seed=i)
+        path = os.path.join(directory, f'scan{i:04d}.jpg')
+        write_atomic(path, encode_image(image, '.jpg', dpi if exif else None, _exif_resolution(dpi) if exif else None))
+        truth[path] = area
+    with open(os.path.join(directory, 'ground_truth.csv'), 'w') as out:
+        out.write('filename,dpi,megapixels,leaves,area_cm2\n')
+        for path, area in truth.items():
+            out.write(f'{os.path.basename(path)},{dpi},{megapixels},{leaves},{area:.6f}\n')
+    return truth
+
+
+def generate(args) -> list:
+    """Write a folder of synthetic scans and their true areas, in ground_truth.csv."""
+    truth = generate_scans(args.directory, args.files, args.megapixels, args.dpi, args.leaves, args.specks,
+                           not args.no_exif)
+    print(f'{len(truth)} scans of {args.megapixels} Mpx at {args.dpi} DPI written to {args.directory}')
+    return [{'filename': os.path.basename(path), 'area_cm2': area} for path, area in truth.items()]
+
+
+def _format_once(path: str, tile_mb: float) -> dict:
+    import cv2
+    import numpy as np
+    from ALFA import ALFA
+    estimator = ALFA(workers=1, tile_mb=tile_mb)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    records = estimator._estimate_image(path)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'estimate_rss_mb': peak_rss_mb() - before,
+            'area': sum(record.Area or 0 for record in records), 'error': records[0].Error}
+
+
+# formats the tiff benchmark writes the scan in: name, extension, grayscale, options of encode_image
+_TIFF_FORMATS = [('jpeg', '.jpg', False, {}), ('tiff deflate', '.tif', False, {}),
+                 ('tiff rgb', '.tif', False, {'compression': 1}), ('tiff gray', '.tif', True, {'compression': 1})]
+
+
+def _write_formats(directory: str, megapixels: float, dpi: float) -> dict:
+    import cv2
+    from ALFA import encode_image, write_atomic
+    image, truth = synthetic_scan(megapixels, dpi)
+    paths = []
+    for i, (name, ext, gray, options) in enumerate(_TIFF_FORMATS):
+        path = os.path.join(directory, f'scan{i}{ext}')
+        pixels = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if gray else image
+        exif = _exif_resolution(dpi) if ext == '.jpg' else None
+        write_atomic(path, encode_image(pixels, ext, dpi, exif, **options))
+        paths.append(path)
+    return {'paths': paths, 'truth': truth}
+
+
+def tiff(args) -> list:
+    """Time and peak memory of estimating a scan from an uncompressed TIFF, mapped from the file, against JPEG."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # written in a process of its own, which keeps the scan out of the peak memory of the measurements
+        written = _run_isolated(_write_formats, directory, args.megapixels, args.dpi)
+        truth = written['truth']
+        # the files were just written, so they are in the page cache, as a scan read a second time would be
+        for (name, *_), path in zip(_TIFF_FORMATS, written['paths']):
+            for tile_mb in [0] + args.tile_mb:
+                row = _run_isolated(_format_once, path, tile_mb)
+                row.update({'format': name, 'file_mb': os.path.getsize(path) / 1e6, 'tile_mb': tile_mb,
+                            'megapixels': args.megapixels, 'area_error_pct': 100 * (row['area'] - truth) / truth})
+                print(f"{name:>12} {row['file_mb']:6.1f} MB  tiles {tile_mb or 'off':>4}  {row['seconds']:6.3f} s  "
+                      f"estimate +{row['estimate_rss_mb']:5.0f} MB  area {row['area']:8.3f} cm2 "
+                      f"({row['area_error_pct']:+.2f} %){'  ' + row['error'] if row['error'] != 'No Error' else ''}")
+                results.append(row)
+    return results
+
+
+def _directory_mb(directory: str) -> tuple:
+    """Number of files below a directory and their total size in MB."""
+    sizes = [os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(directory) for name in names]
+    return len(sizes), sum(sizes) / 1e6
+
+
+def _qa_once(directory: str, output: str, workers: int) -> dict:
+    from ALFA import ALFA
+    estimator = ALFA(output_dir='', workers=workers, memory_mb=0)
+    target = None
+    if output:
+        target = tempfile.mkdtemp()
+        setattr(estimator, output, target)
+    start = time.perf_counter()
+    areas = sorted(estimator.estimate(directory).itertuples(index=False, name=None))
+    seconds = time.perf_counter() - start
+    estimator.close()
+    files, written = _directory_mb(target) if target else (0, 0)
+    if target:
+        shutil.rmtree(target)
+    return {'output': output or 'none', 'seconds': seconds, 'files_written': files, 'written_mb': written,
+            'areas_checksum': zlib.crc32(repr(areas).encode())}
+
+
+def qa(args) -> list:
+    """Time and bytes written of reviewing a run through contact sheets against saving every thresholded image."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        _run_isolated(generate_scans, directory, args.files, args.megapixels, 300, 12, 50)
+        rows = [_run_isolated(_qa_once, directory, output, args.workers) for output in (None, 'output_dir', 'qa_dir')]
+    reference = rows[0]['areas_checksum']
+    for row in rows:
+        row['identical_areas'] = row.pop('areas_checksum') == reference
+        row['overhead'] = row['seconds'] / rows[0]['seconds'] - 1
+        print(f"{row['output']:>10} {args.files} scans {row['seconds']:7.3f} s ({100 * row['overhead']:+5.1f} %)  "
+              f"{row['files_written']:4d} files {row['written_mb']:8.2f} MB  identical areas: {row['identical_areas']}")
+        results.append(row)
+    return results
+
+
+def _stages_once(images: list, res: float, threshold: int, cut_off: int, directory: str) -> dict:
+    import cv2
+    from ALFA import ALFA, label_components, encode_image, write_atomic
+    estimator = ALFA(res=res, threshold=threshold, cut_off=cut_off, combine=True)
+    stages = {stage: [] for stage in ('decode', 'grayscale', 'threshold', 'label', 'count', 'write')}
+    before = peak_rss_mb()
+    for img in images:
+        start = time.perf_counter()
+        scan = cv2.imread(img, cv2.IMREAD_COLOR)
+        decoded = time.perf_counter()
+        scan = cv2.cvtColor(scan, cv2.COLOR_BGR2GRAY)
+        gray = time.perf_counter()
+        scan = cv2.threshold(scan, threshold, 255, cv2.THRESH_BINARY_INV)[1]
+        thresholded = time.perf_counter()
+        sizes = label_components(scan, estimator.labeller).areas
+        labelled = time.perf_counter()
+        estimator._area_records(img, sizes, res)
+        counted = time.perf_counter()
+        write_atomic(os.path.join(directory, os.path.basename(img) + '.png'),
+                     encode_image(scan, '.png', res, bilevel=True))
+        written = time.perf_counter()
+        for stage, seconds in zip(stages, (decoded - start, gray - decoded, thresholded - gray,
+                                           labelled - thresholded, counted - labelled, written - counted)):
+            stages[stage].append(seconds)
+    return {'stages': {stage: statistics.median(seconds) for stage, seconds in stages.items()},
+            'peak_rss_mb': peak_rss_mb(), 'stages_rss_mb': peak_rss_mb() - before}
+
+
+def _command_once(command: str, directory: str, workers: int, output_dir: str, res: float) -> dict:
+    from ALFA import ALFA
+    estimator = ALFA(output_dir=output_dir, workers=workers, combine=True, crop=100, res=res)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    areas = {}
+    if command == 'estimate':
+        for records in estimator.iter_estimate(directory):
+            areas[records[0].filename] = records[0].Area
+    elif command == 'preprocess':
+        list(estimator.iter_preprocess(directory))
+    elif command == 'resolution_sort':
+        estimator.resolution_sort_image_files(directory)
+    elif command == 'number_sort':
+        estimator.num_file_sort_image_files(directory, 10)
+    seconds = time.perf_counter() - start
+    estimator.close()
+    # the largest worker, once the pool has been joined
+    workers_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    workers_peak = workers_peak / 1024 if sys.platform != 'darwin' else workers_peak / 1024 / 1024
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'command_rss_mb': peak_rss_mb() - before,
+            'worker_peak_rss_mb': workers_peak, 'areas': areas}
+
+
+def _linked_copies(images: list, directory: str, files: int):
+    """Fill a directory with files linked to the images, cheap copies for the sort commands to move."""
+    os.makedirs(directory)
+    for i in range(files):
+        img = images[i % len(images)]
+        target = os.path.join(directory, f'{i:06d}_{os.path.basename(img)}')
+        try:
+            os.link(img, target)
+        except OSError:
+            shutil.copyfile(img, target)
+
+
+def suite(args) -> list:
+    """
+    Per-stage timings and peak memory of estimate, time and peak memory of estimate, preprocess and the sort
+    commands, and estimate across numbers of workers, on synthetic scans of known leaf area.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work:
+        scans = os.path.join(work, 'scans')
+        # in a process of its own, as a child's peak resident set size starts from that of its parent
+        truth = _run_isolated(generate_scans, scans, args.files, args.megapixels, args.dpi, args.leaves, args.specks,
+                              not args.no_exif)
+        images = sorted(truth)
+        pixels = len(images) * args.megapixels
+        # scans without EXIF have no resolution to read; it is given, as a user would
+        res = args.dpi if args.no_exif else 0
+
+        out = os.path.join(work, 'stages')
+        os.makedirs(out)
+        row = _run_isolated(_stages_once, images, args.dpi, 120, 10000, out)
+        for stage, seconds in row['stages'].items():
+            print(f"{'stage':>8} {stage:>15} {seconds * 1000:9.2f} ms per image")
+            results.append({'benchmark': 'stage', 'name': stage, 'seconds': seconds})
+        results.append({'benchmark': 'stage', 'name': 'all', 'seconds': sum(row['stages'].values()),
+                        'peak_rss_mb': row['peak_rss_mb']})
+
+        for command in ('estimate', 'preprocess', 'resolution_sort', 'number_sort'):
+            directory = scans
+            files = len(images)
+            if command.endswith('sort'):
+                files = args.sort_files
+                directory = os.path.join(work, command)
+                _linked_copies(images, directory, files)
+            output_dir = os.path.join(work, command + '_out')
+            os.makedirs(output_dir)
+            row = _run_isolated(_command_once, command, directory, 1, output_dir if command == 'preprocess' else '',
+                                res)
+            row.update({'benchmark': 'command', 'name': command, 'files': files,
+                        'files_per_second': files / row['seconds']})
+            areas = row.pop('areas')
+            if command == 'estimate':
+                errors = [100 * abs(areas[img] - area) / area for img, area in truth.items() if areas.get(img)]
+                row['max_area_error_pct'] = max(errors) if len(errors) == len(truth) else None
+                row['megapixels_per_second'] = pixels / row['seconds']
+            print(f"{'command':>8} {command:>15} {files:6d} files {row['seconds']:8.3f} s  "
+                  f"{row['files_per_second']:8.1f} files/s  peak {row['peak_rss_mb']:6.0f} MB"
+                  + (f"  area error < {row['max_area_error_pct']:.2f} %" if row.get('max_area_error_pct') is not None
+                     else ''))
+            results.append(row)
+
+        for workers in args.workers:
+            row = _run_isolated(_command_once, 'estimate', scans, workers, '', res)
+            del row['areas']
+            row.update({'benchmark': 'workers', 'name': f'estimate -w {workers}', 'workers': workers,
+                        'files_per_second': len(images) / row['seconds'],
+                        'megapixels_per_second': pixels / row['seconds']})
+            print(f"{'workers':>8} {workers:>15} {row['seconds']:8.3f} s  {row['megapixels_per_second']:8.1f} Mpx/s  "
+                  f"peak {row['peak_rss_mb']:6.0f} MB, largest worker {row['worker_peak_rss_mb']:6.0f} MB")
+            results.append(row)
+    return results
+
+
+def compare(args) -> list:
+    """
+    Compare the timings of two runs of the suite, e.g. of two releases, and flag whatever has become slower.
+    """
+    def load(path):
+        with open(path) as f:
+            return {(row['benchmark'], row['name']): row for row in json.load(f)['results']}
+    before, after = load(args.before), load(args.after)
+    results = []
+    slower = False
+    for key in before.keys() & after.keys():
+        ratio = after[key]['seconds'] / before[key]['seconds']
+        results.append({'benchmark': key[0], 'name': key[1], 'before': before[key]['seconds'],
+                        'after': after[key]['seconds'], 'ratio': ratio})
+    for row in sorted(results, key=lambda row: (row['benchmark'], row['name'])):
+        flag = row['ratio'] > 1 + args.tolerance
+        slower |= flag
+        print(f"{row['benchmark']:>10} {row['name']:>15} {row['before']:9.4f} s -> {row['after']:9.4f} s  "
+              f"x{row['ratio']:5.2f}{'  SLOWER' if flag else ''}")
+    if slower:
+        sys.exit(1)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--json', type=str, help='Where to save the results as JSON')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    labelling_parser = subparsers.add_parser('labelling', help='Time and peak memory of the labelling backends')
+    labelling_parser.add_argument('--images', type=str, default=PREPARED, help='Folder of scans to label')
+    labelling_parser.add_argument('--megapixels', type=float, default=35,
+                                  help='Upscale every scan to this size. Default is 35, an A4 page at 600 DPI')
+    labelling_parser.add_argument('-t', '--threshold', type=int, default=120)
+    labelling_parser.set_defaults(run=labelling)
+
+    decoding_parser = subparsers.add_parser('decoding', help='Time, peak memory and area error of the decode modes')
+    decoding_parser.add_argument('--images', type=str, default=PREPARED, help='Folder of scans to estimate')
+    decoding_parser.add_argument('--repeats', type=int, default=3, help='Average the time over this many runs')
+    decoding_parser.set_defaults(run=decoding)
+
+    tiling_parser = subparsers.add_parser('tiling', help='Peak memory of tiled against whole-image labelling')
+    tiling_parser.add_argument('--image', type=str, default=os.path.join(PREPARED, 'img1.jpg'))
+    tiling_parser.add_argument('--megapixels', type=float, default=140,
+                               help='Upscale the scan to this size. Default is 140, an A4 page at 1200 DPI')
+    tiling_parser.add_argument('--tile_mb', type=float, nargs='+', default=[64, 256])
+    tiling_parser.add_argument('-t', '--threshold', type=int, default=120)
+    tiling_parser.set_defaults(run=tiling)
+
+    metadata_parser = subparsers.add_parser('metadata', help='Time of resolution lookup over many files')
+    metadata_parser.add_argument('--images', type=str, default=PREPARED, help='Folder of scans to read')
+    metadata_parser.add_argument('--files', type=int, default=5000, help='Read the scans repeatedly up to this many')
+    metadata_parser.set_defaults(run=metadata)
+
+    batching_parser = subparsers.add_parser('batching', help='Time of estimating thumbnails in batches')
+    batching_parser.add_argument('--image', type=str, default=os.path.join(RAW, '2AgL.jpg'),
+                                 help='Scan to make the thumbnails from')
+    batching_parser.add_argument('--files', type=int, default=5000, help='Number of thumbnails')
+    batching_parser.add_argument('--size', type=int, default=160, help='Long side of the thumbnails, in pixels')
+    batching_parser.add_argument('--batch_mpx', type=float, nargs='+', default=[1])
+    batching_parser.set_defaults(run=batching)
+
+    backends_parser = subparsers.add_parser('backends', help='Time and memory of the process, thread and serial '
+                                                             'backends on small and large scans')
+    backends_parser.add_argument('--image', type=str, default=os.path.join(RAW, '2AgL.jpg'),
+                                 help='Scan to make the small images from')
+    backends_parser.add_argument('--files', type=int, default=2000, help='Number of small images')
+    backends_parser.add_argument('--size', type=int, default=320, help='Long side of the small images, in pixels')
+    backends_parser.add_argument('--scans', type=int, default=8, help='Number of large scans')
+    backends_parser.add_argument('--megapixels', type=float, default=35, help='Size of the large scans')
+    backends_parser.add_argument('--workers', type=int, nargs='+',
+                                 default=sorted({2, max(2, multiprocessing.cpu_count())}),
+                                 help='Numbers of workers to compare the backends at')
+    backends_parser.set_defaults(run=backends)
+
+    startup_parser = subparsers.add_parser('startup', help='Wall time and import time of starting ALFA.py')
+    startup_parser.add_argument('--repeats', type=int, default=5, help='Take the median over this many runs')
+    startup_parser.add_argument('--max_import_ms', type=float,
+                                help='Exit with an error if importing ALFA takes longer than this. '
+                                     'Nothing runs this automatically; run it by hand before a release')
+    startup_parser.set_defaults(run=startup)
+
+    tiff_parser = subparsers.add_parser('tiff', help='Time and peak memory of uncompressed TIFF against JPEG input')
+    tiff_parser.add_argument('--megapixels', type=float, default=35,
+                             help='Size of the synthetic scan. Default is 35, an A4 page at 600 DPI')
+    tiff_parser.add_argument('--dpi', type=float, default=600, help='Resolution of the scan')
+    tiff_parser.add_argument('--tile_mb', type=float, nargs='*', default=[64], help='Also estimate in tiles of these')
+    tiff_parser.set_defaults(run=tiff)
+
+    qa_parser = subparsers.add_parser('qa', help='Time and bytes written of contact sheets against saving the '
+                                                 'thresholded images')
+    qa_parser.add_argument('--files', type=int, default=60, help='Number of synthetic scans')
+    qa_parser.add_argument('--megapixels', type=float, default=8, help='Size of each scan. Default is 8, A4 at 300 DPI')
+    qa_parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() - 1))
+    qa_parser.set_defaults(run=qa)
+
+    generate_parser = subparsers.add_parser('generate', help='Write synthetic scans of known leaf area')
+    generate_parser.add_argument('directory', type=str, help='Where to write them')
+    suite_parser = subparsers.add_parser('suite', help='Per-stage timings, commands and worker scaling on synthetic '
+                                                       'scans; save with --json and diff with compare')
+    for p in [generate_parser, suite_parser]:
+        p.add_argument('--files', type=int, default=8, help='Number of scans')
+        p.add_argument('--megapixels', type=float, default=8, help='Size of each scan. Default is 8, A4 at 300 DPI')
+        p.add_argument('--dpi', type=float, default=300, help='Resolution of the scans')
+        p.add_argument('--leaves', type=int, default=12, help='Leaves per scan')
+        p.add_argument('--specks', type=float, default=50, help='Specks per megapixel, below the default cut_off')
+        p.add_argument('--no_exif', action='store_true', help='Leave the resolution out of the files')
+    generate_parser.set_defaults(run=generate)
+    suite_parser.add_argument('--sort_files', type=int, default=2000, help='Number of files for the sort commands')
+    suite_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                              help='Numbers of workers to estimate with')
+    suite_parser.set_defaults(run=suite)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two runs of the suite saved with --json')
+    compare_parser.add_argument('before', type=str)
+    compare_parser.add_argument('after', type=str)
+    compare_parser.add_argument('--tolerance', type=float, default=0.1,
+                                help='Exit with an error if anything is slower by more than this fraction')
+    compare_parser.set_defaults(run=compare)
+
+    args = parser.parse_args(argv)
+    results = args.run(args)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'command': args.command, 'results': results}, out, indent=1)
+
+
+if __name__ == '__main__':
+    main()